@@ -0,0 +1,254 @@
+"""
+batchbuild.py - builds many mdx and mdd files on one pool of worker processes, keeping their total memory use under a limit.
+
+Building each dictionary of a release in its own process either starts too many
+builds at once, which together run out of memory, or too few, which leaves the
+machine idle. build_all() takes a list of BuildSpec objects, and runs them on a
+shared pool of processes:
+
+    from batchbuild import BuildSpec, build_all
+    from sqlitesource import SQLiteSource
+    import functools
+
+    specs = [
+        BuildSpec("en-de.mdx", functools.partial(SQLiteSource, "en-de.db"), "English-German", ""),
+        BuildSpec("en-de.mdd", functools.partial(SQLiteSource, "en-de-media.db"), "English-German", "",
+                  is_mdd=True),
+        ...
+    ]
+    for result in build_all(specs, memory_limit=8 * 1024 ** 3):
+        print(result["output"], result["error"])
+
+Each build has two stages, which both run on the pool. First, unless its memory
+use is given in the BuildSpec, the memory use is estimated by MDictWriter.plan()
+(see buildplan.py). Then it is built, once there is memory for it: the running
+tasks, by their estimates, never take up more than memory_limit together (except
+that a build estimated to need more than memory_limit on its own runs when no other
+task is running). An estimate holds all the entries of its dictionary, and is
+counted as plan_memory. Of the builds that are ready, the smallest are started
+first, so small dictionaries do not wait for large ones, and while a large build
+waits for memory, smaller ones take the free processes.
+
+Each task runs in a new worker process, so that the memory of a finished build is
+returned to the system. If a worker process dies during a task (e.g. because the
+system ran out of memory and killed it), the task is reported as failed.
+"""
+
+from __future__ import unicode_literals
+
+import bisect, collections, os, sys, time, traceback
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+from writemdict import MDictWriter
+
+# How often build_all() checks that the workers running its tasks are alive, in
+# seconds.
+_POLL_INTERVAL = 1.0
+
+# How long a task whose worker has exited may still deliver its result, in seconds,
+# before it is reported as lost.
+_LOST_TASK_GRACE = 5.0
+
+class BuildSpec(object):
+
+	def __init__(self, output, source, title, description, memory=None, **kwargs):
+		"""
+		Describes a file to build with build_all().
+
+		output is the name of the file to write.
+
+		source is a function without arguments, which returns the entries, as the
+		  parameter d of MDictWriter. It is called in a worker process (once for the
+		  estimate, and once for the build), so it must be picklable, e.g. a function
+		  defined at the top level of a module, or a functools.partial of one. It
+		  should load the entries when called, rather than hold them.
+
+		title and description are as for MDictWriter.
+
+		memory is the number of bytes the build needs, or None to estimate it with
+		  MDictWriter.plan().
+
+		Any other keyword arguments are passed on to MDictWriter.
+		"""
+		self.output = output
+		self.source = source
+		self.title = title
+		self.description = description
+		self.memory = memory
+		self.kwargs = kwargs
+
+# In a worker process, the queue on which the tasks report that they have started.
+_started = None
+
+def _init_worker(started):
+	global _started
+	_started = started
+
+def _run_stage(args):
+	# Worker function: runs one stage ("plan" or "build") of the BuildSpec with
+	# index i, and returns (result, error), where error is None or a formatted
+	# traceback.
+	i, stage, spec = args
+	_started.put((i, stage, os.getpid()))
+	try:
+		if stage == "plan":
+			compression_type = spec.kwargs.get("compression_type", 2)
+			plan = MDictWriter.plan(spec.source(), spec.title, spec.description,
+			    sample_fraction=0.01, compression_types=[compression_type], **spec.kwargs)
+			return plan["compression"][compression_type], None
+		start = time.time()
+		writer = MDictWriter(spec.source(), spec.title, spec.description, **spec.kwargs)
+		tmp_name = "{0}.{1}.tmp".format(spec.output, os.getpid())
+		f = open(tmp_name, "wb")
+		try:
+			writer.write(f)
+		finally:
+			f.close()
+		getattr(os, "replace", os.rename)(tmp_name, spec.output)
+		return {"build_time": time.time() - start, "peak_rss": _peak_rss()}, None
+	except Exception:
+		return None, traceback.format_exc()
+
+def _peak_rss():
+	# Returns the peak resident memory of this process in bytes, or None if unknown.
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == "darwin" else peak * 1024
+
+def build_all(specs, processes=None, memory_limit=None, plan_memory=None):
+	"""
+	Builds the files described by specs, a list of BuildSpec objects.
+
+	processes is the number of worker processes, by default the number of CPUs.
+
+	memory_limit is the number of bytes that the running tasks may use together,
+	  according to their estimates, or None for no limit.
+
+	plan_memory is the number of bytes counted for each running estimate, which
+	  holds all the entries of its dictionary. By default, memory_limit divided by
+	  processes.
+
+	Returns a list with a dictionary for each spec, in the same order, with the
+	following entries:
+
+	  output: the name of the file.
+	  memory: the memory the build was estimated (or given) to need, in bytes.
+	  build_time: the time the build took, in seconds.
+	  peak_rss: the peak resident memory of the process that built the file, in
+	    bytes, if known.
+	  error: None, or the traceback of the exception that made the build fail (or
+	    a message that its worker process died), as a string. A failed build does
+	    not stop the others.
+	"""
+	import multiprocessing
+	specs = list(specs)
+	if processes is None:
+		from verifymdict import _cpu_count
+		processes = _cpu_count()
+	if plan_memory is None:
+		plan_memory = 0 if memory_limit is None else memory_limit // processes
+	results = [{"output": s.output, "memory": s.memory, "build_time": None, "peak_rss": None,
+	            "error": None} for s in specs]
+	to_plan = collections.deque(i for i, s in enumerate(specs) if s.memory is None)
+	# Builds that are ready to start, as a sorted list of (memory, index).
+	ready = sorted((s.memory, i) for i, s in enumerate(specs) if s.memory is not None)
+	# Maps the index of each running task to its stage and the memory reserved for it.
+	running = {}
+	used = 0
+	finished = queue.Queue()
+	# A SimpleQueue writes to its pipe at once, so the message is not lost if the
+	# worker is killed right after.
+	started = multiprocessing.SimpleQueue()
+	# Maps the index of each running task that has started to the process ID of its
+	# worker, and the index of each task whose worker has exited to the time when
+	# this was noticed.
+	worker_pids = {}
+	exited = {}
+	# The worker processes seen so far, by process ID.
+	workers = {}
+	lost = False
+	pool = multiprocessing.Pool(processes, _init_worker, (started,), maxtasksperchild=1)
+	try:
+		while to_plan or ready or running:
+			while len(running) < processes:
+				if to_plan and (memory_limit is None or used + plan_memory <= memory_limit or not running):
+					i = to_plan.popleft()
+					stage, memory = "plan", plan_memory
+				elif ready and (memory_limit is None or used + ready[0][0] <= memory_limit or not running):
+					memory, i = ready.pop(0)
+					stage = "build"
+				else:
+					break
+				running[i] = (stage, memory)
+				used += memory
+				pool.apply_async(_run_stage, ((i, stage, specs[i]),),
+				    callback=lambda result, i=i, stage=stage: finished.put((i, stage, result)),
+				    error_callback=lambda e, i=i, stage=stage: finished.put(
+				        (i, stage, (None, "".join(traceback.format_exception_only(type(e), e))))))
+			try:
+				i, stage, (result, error) = finished.get(timeout=_POLL_INTERVAL)
+			except queue.Empty:
+				for i, stage, error in _lost_tasks(running, started, worker_pids, exited, workers):
+					finished.put((i, stage, (None, error)))
+					lost = True
+				continue
+			if running.get(i, (None,))[0] != stage:
+				continue # reported as lost before
+			used -= running.pop(i)[1]
+			worker_pids.pop(i, None)
+			exited.pop(i, None)
+			if error is not None:
+				results[i]["error"] = error
+			elif stage == "plan":
+				results[i]["memory"] = result["peak_memory"]
+				bisect.insort(ready, (result["peak_memory"], i))
+			else:
+				results[i].update(result)
+	finally:
+		if lost:
+			# The pool waits for the results of lost tasks forever when closed. No
+			# other tasks are left.
+			pool.terminate()
+		else:
+			pool.close()
+		pool.join()
+	return results
+
+def _lost_tasks(running, started, worker_pids, exited, workers):
+	# Returns (index, stage, error) for each running task whose worker process has
+	# exited more than _LOST_TASK_GRACE seconds ago without its result. The other
+	# parameters are as in build_all(), and are updated.
+	import multiprocessing
+	while not started.empty():
+		i, stage, pid = started.get()
+		if running.get(i, (None,))[0] == stage:
+			worker_pids[i] = pid
+	alive = set()
+	for p in multiprocessing.active_children():
+		workers[p.pid] = p
+		alive.add(p.pid)
+	now = time.time()
+	lost = []
+	for i, pid in list(worker_pids.items()):
+		if pid in alive:
+			continue
+		if now - exited.setdefault(i, now) < _LOST_TASK_GRACE:
+			continue
+		stage = running[i][0]
+		exitcode = workers[pid].exitcode if pid in workers else None
+		if exitcode is None:
+			how = "exited"
+		elif exitcode < 0:
+			how = "was killed by signal {0}".format(-exitcode)
+		else:
+			how = "exited with code {0}".format(exitcode)
+		lost.append((i, stage, "Worker process {0} {1} during the {2} stage, e.g. because the "
+		    "system ran out of memory\n".format(pid, how, stage)))
+		del worker_pids[i]
+	return lost
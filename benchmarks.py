@@ -0,0 +1,174 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals, print_function, absolute_import, division
+
+# Performance benchmarks for the writemdict library.
+#
+# Run all of them with "python benchmarks.py", or some of them with
+# "python benchmarks.py import_time ...". Each benchmark prints its measurements,
+# and the script exits with a nonzero status if any of them misses its budget.
+
+import os, subprocess, sys, time
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+_benchmarks = []
+
+def _benchmark(f):
+	# Registers f as a benchmark. f returns True if it met its budget.
+	_benchmarks.append(f)
+	return f
+
+def _median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def _run_python(code):
+	# Runs code in a new Python process, with this directory on the path, and returns
+	# (wall clock time, output).
+	start = time.time()
+	output = subprocess.check_output([sys.executable, "-c", code], cwd=_here)
+	return time.time() - start, output.decode("ascii")
+
+### Import time.
+# Short-lived worker processes pay for importing writemdict on every start. The
+# modules in LAZY_MODULES must not be imported until encryption or LZO is used.
+IMPORT_TIME_BUDGET = 0.003 # seconds, for "import writemdict" alone
+LAZY_MODULES = ["ripemd128", "pureSalsa20", "lzo", "cgi"]
+IMPORT_RUNS = 15
+
+@_benchmark
+def import_time():
+	code = ("import sys, time\n"
+	        "start = time.time()\n"
+	        "import writemdict\n"
+	        "print(time.time() - start)\n"
+	        "print(' '.join(m for m in {0!r} if m in sys.modules))\n").format(LAZY_MODULES)
+	# Make sure the measurement does not include compiling to bytecode.
+	import compileall
+	compileall.compile_file(os.path.join(_here, "writemdict.py"), quiet=1)
+	import_times = []
+	startup_times = []
+	baseline_times = []
+	for i in range(IMPORT_RUNS):
+		wall, output = _run_python(code)
+		lines = output.splitlines()
+		import_times.append(float(lines[0]))
+		startup_times.append(wall)
+		loaded = lines[1].split() if len(lines) > 1 else []
+		baseline_times.append(_run_python("pass")[0])
+	import_time = _median(import_times)
+	print("import writemdict:      {0:.1f} ms (budget {1:.1f} ms)".format(
+	    import_time * 1000, IMPORT_TIME_BUDGET * 1000))
+	print("process startup:        {0:.1f} ms (bare interpreter {1:.1f} ms)".format(
+	    _median(startup_times) * 1000, _median(baseline_times) * 1000))
+	if loaded:
+		print("imported eagerly:       " + " ".join(loaded))
+	return import_time <= IMPORT_TIME_BUDGET and not loaded
+
+### Serialization of key blocks and block indexes.
+# Building the uncompressed key blocks from the offset table must not be dominated
+# by per-entry Python overhead.
+SERIALIZATION_ENTRIES = 200000
+SERIALIZATION_BUDGET = 2000000 # entries per second, at least
+
+@_benchmark
+def serialization():
+	from writemdict import _OffsetTableEntry, _MdxKeyBlock
+	offset_table = [
+	    _OffsetTableEntry(key=b"key%07d" % i, key_null=b"key%07d\0" % i, key_len=10,
+	                      offset=i * 100, record_null=b"")
+	    for i in range(SERIALIZATION_ENTRIES)]
+	times = []
+	for i in range(5):
+		start = time.time()
+		_MdxKeyBlock._block_data(offset_table, "2.0")
+		times.append(time.time() - start)
+	rate = SERIALIZATION_ENTRIES / _median(times)
+	print("key block serialization: {0:.2f} M entries/s (budget {1:.2f} M entries/s)".format(
+	    rate / 1e6, SERIALIZATION_BUDGET / 1e6))
+	return rate >= SERIALIZATION_BUDGET
+
+### Autocompletion with a prefix index.
+# Completing a prefix must stay well under a millisecond, so that it can run on
+# every keystroke.
+AUTOCOMPLETE_ENTRIES = 200000
+AUTOCOMPLETE_QUERIES = 2000
+AUTOCOMPLETE_BUDGET = 0.001 # seconds per query, on average
+
+@_benchmark
+def autocomplete():
+	import random, tempfile
+	from writemdict import MDictWriter
+	from prefixindex import PrefixIndex
+	rng = random.Random(0)
+	letters = "abcdefghijklmnopqrstuvwxyz"
+	d = {}
+	while len(d) < AUTOCOMPLETE_ENTRIES:
+		d["".join(rng.choice(letters) for j in range(rng.randint(3, 12)))] = ""
+	writer = MDictWriter(d, "Benchmark", "")
+	fd, filename = tempfile.mkstemp(suffix=".pfx")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			writer.write_prefix_index(f)
+		keys = list(d)
+		prefixes = [k[:rng.randint(1, 4)] for k in rng.sample(keys, AUTOCOMPLETE_QUERIES)]
+		with PrefixIndex(filename) as index:
+			start = time.time()
+			for prefix in prefixes:
+				index.complete(prefix, 10)
+			latency = (time.time() - start) / len(prefixes)
+		size = os.path.getsize(filename)
+	finally:
+		os.remove(filename)
+	print("prefix completion:      {0:.3f} ms per query (budget {1:.3f} ms)".format(
+	    latency * 1000, AUTOCOMPLETE_BUDGET * 1000))
+	print("prefix index size:      {0:.1f} bytes per key".format(size / AUTOCOMPLETE_ENTRIES))
+	return latency <= AUTOCOMPLETE_BUDGET
+
+### Full scan of all entries.
+# scan_mdict() must stream the entries of a file at this rate or better, with the
+# default number of processes (the number of CPUs). The rate with one process is
+# shown for comparison.
+SCAN_ENTRIES = 200000
+SCAN_BUDGET = 200000 # entries per second, at least
+
+@_benchmark
+def full_scan():
+	import random, tempfile
+	from writemdict import MDictWriter
+	from scanmdict import scan_mdict
+	from verifymdict import _cpu_count
+	rng = random.Random(0)
+	d = dict(("w%07d" % i, "<p>" + "lorem ipsum dolor " * rng.randint(1, 20) + "</p>")
+	         for i in range(SCAN_ENTRIES))
+	fd, filename = tempfile.mkstemp(suffix=".mdx")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			MDictWriter(d, "Benchmark", "").write(f)
+		rates = {}
+		for processes in sorted(set([1, _cpu_count()])):
+			start = time.time()
+			n = sum(1 for entry in scan_mdict(filename, processes=processes))
+			rates[processes] = n / (time.time() - start)
+	finally:
+		os.remove(filename)
+	for processes in sorted(rates):
+		print("full scan, {0} process(es): {1:.0f} k entries/s".format(processes, rates[processes] / 1000))
+	rate = rates[_cpu_count()]
+	print("budget:                 {0:.0f} k entries/s".format(SCAN_BUDGET / 1000))
+	return rate >= SCAN_BUDGET
+
+def main(names):
+	ok = True
+	for f in _benchmarks:
+		if names and f.__name__ not in names:
+			continue
+		print("== {0}".format(f.__name__))
+		if not f():
+			print("BUDGET EXCEEDED")
+			ok = False
+	return ok
+
+if __name__ == "__main__":
+	sys.exit(0 if main(sys.argv[1:]) else 1)
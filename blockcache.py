@@ -0,0 +1,241 @@
+"""
+blockcache.py - a cache of decompressed blocks in shared memory, shared by several processes.
+
+Requires Python 3.8 or later.
+
+When several worker processes serve lookups from the same mdx and mdd files, each
+of them would otherwise decompress (and cache) the same popular blocks. A
+SharedBlockCache keeps decompressed blocks in one multiprocessing.shared_memory
+segment, which all the processes attach to, so that a block decompressed by one
+process can be used by all others. It is used by passing it to MDictReader:
+
+    from blockcache import SharedBlockCache
+    from readmdict import MDictReader
+
+    # In the parent process, before starting the workers:
+    cache = SharedBlockCache("mdict-cache", create=True, size=256 * 1024 * 1024)
+
+    # In each worker:
+    cache = SharedBlockCache("mdict-cache")
+    reader = MDictReader("dictionary.mdx", cache=cache)
+
+    # In the parent process, after the workers have finished:
+    cache.close()
+    cache.unlink()
+
+The segment is divided into slots of slot_size bytes, each holding one block.
+Blocks are identified by the file (its device, inode, size and modification time)
+and their offset in it. Each block can only be stored in one of a small set of
+slots (determined by a hash of its identity), and when all of them are in use, the
+least recently used one is replaced, as seen by all processes.
+
+Reads do not take a lock. Each slot has a sequence number, which a writer makes
+odd while it changes the slot, and a checksum of its data. A reader copies the
+data, and only uses it if the sequence number was even and unchanged, and the
+checksum matches; otherwise it treats the lookup as a miss, and decompresses the
+block itself. So a process never sees a partly written block. Writes are rare (one
+per miss), and are serialized by a lock on a file next to the segment's name in the
+temporary directory, so that two writes of the same slot never overlap.
+"""
+
+import hashlib, os, struct, tempfile, threading, zlib
+from multiprocessing import shared_memory
+
+from writemdict import ParameterError
+
+MAGIC = b"MDXCACHE"
+
+# Segment header: magic, number of sets, slots per set, slot size, padding, clock.
+_header = struct.Struct("<8sLLLLQ")
+# Slot header: sequence number, file id, offset, length, checksum, last used.
+_slot_header = struct.Struct("<QQQLLQ")
+_seq = struct.Struct("<Q")
+
+def file_id(filename=None, data=None):
+	"""
+	Returns the 64-bit number identifying a file in the cache: either the file
+	called filename (by its device, inode, size and modification time), or the
+	file contained in the bytes-like object data (by its contents).
+	"""
+	if filename is not None:
+		st = os.stat(filename)
+		identity = "{0}:{1}:{2}:{3}".format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns).encode("ascii")
+		digest = hashlib.blake2b(identity, digest_size=8).digest()
+	else:
+		digest = hashlib.blake2b(data, digest_size=8).digest()
+	# 0 marks an empty slot.
+	return struct.unpack("<Q", digest)[0] or 1
+
+class SharedBlockCache(object):
+
+	def __init__(self, name, create=False, size=64 * 1024 * 1024, slot_size=128 * 1024, ways=4):
+		"""
+		Attaches to the shared memory cache called name, or, if create is true,
+		creates it.
+
+		The other parameters are only used when creating the cache:
+
+		size is the total size of the cache, in bytes.
+
+		slot_size is the largest decompressed block that can be cached. Each cached
+		  block takes up this much space. The default leaves room for the blocks
+		  written by MDictWriter with its default block_size, which may exceed
+		  block_size by up to one entry.
+
+		ways is the number of slots each block can be stored in. Larger values make
+		  the cache use its space better, but make lookups slower.
+		"""
+		if create:
+			slot_total = _slot_header.size + slot_size
+			num_sets = (size - _header.size) // (slot_total * ways)
+			if num_sets < 1:
+				raise ParameterError("Cache size too small")
+			self._shm = shared_memory.SharedMemory(
+			    name, create=True, size=_header.size + num_sets * ways * slot_total)
+			self._shm.buf[:_header.size] = _header.pack(MAGIC, num_sets, ways, slot_size, 0, 0)
+		else:
+			self._shm = _attach(name)
+			if bytes(self._shm.buf[:8]) != MAGIC:
+				self._shm.close()
+				raise ParameterError("Not a block cache: {0}".format(name))
+		self.name = name
+		# Serializes put() between processes, and between the threads of this one.
+		self._lock_file = open(_lock_file_name(name), "a+b")
+		self._thread_lock = threading.Lock()
+		self._buf = self._shm.buf
+		_, self._num_sets, self._ways, self._slot_size, _, _ = _header.unpack_from(self._buf, 0)
+		self._slot_total = _slot_header.size + self._slot_size
+		# Statistics for this process.
+		self.hits = 0
+		self.misses = 0
+
+	def close(self):
+		"""
+		Detaches from the cache. The cache still exists until unlink() is called.
+		"""
+		self._buf = None
+		self._shm.close()
+		self._lock_file.close()
+
+	def unlink(self):
+		"""
+		Deletes the cache. Should be called once, by the process that created it.
+		"""
+		self._shm.unlink()
+		try:
+			os.remove(_lock_file_name(self.name))
+		except OSError:
+			pass
+
+	def _slots(self, file_id, offset):
+		# Returns the positions of the slots that may hold block (file_id, offset).
+		h = ((file_id ^ (offset * 0x9E3779B97F4A7C15)) & 0xffffffffffffffff) % self._num_sets
+		start = _header.size + h * self._ways * self._slot_total
+		return range(start, start + self._ways * self._slot_total, self._slot_total)
+
+	def _tick(self):
+		# Advances the shared clock used for the least recently used policy, and
+		# returns it. Concurrent updates may be lost, which only makes the policy
+		# slightly less exact.
+		pos = _header.size - 8
+		clock = _seq.unpack_from(self._buf, pos)[0] + 1
+		_seq.pack_into(self._buf, pos, clock)
+		return clock
+
+	def get(self, file_id, offset):
+		"""
+		Returns the cached data of the block at offset in the file identified by
+		file_id (see file_id()), or None if it is not in the cache.
+		"""
+		buf = self._buf
+		for pos in self._slots(file_id, offset):
+			seq, slot_file, slot_offset, length, checksum, _ = _slot_header.unpack_from(buf, pos)
+			if slot_file != file_id or slot_offset != offset or seq & 1:
+				continue
+			data_pos = pos + _slot_header.size
+			data = bytes(buf[data_pos:data_pos+length])
+			if _seq.unpack_from(buf, pos)[0] != seq or zlib.adler32(data) & 0xffffffff != checksum:
+				break # being rewritten
+			_seq.pack_into(buf, pos + _slot_header.size - 8, self._tick())
+			self.hits += 1
+			return data
+		self.misses += 1
+		return None
+
+	def put(self, file_id, offset, data):
+		"""
+		Stores data, the decompressed data of the block at offset in the file
+		identified by file_id, in the cache. Blocks larger than slot_size are not
+		stored.
+		"""
+		if len(data) > self._slot_size:
+			return
+		with self._thread_lock:
+			_lock(self._lock_file)
+			try:
+				self._put(file_id, offset, data)
+			finally:
+				_unlock(self._lock_file)
+
+	def _put(self, file_id, offset, data):
+		# Implements put(), with the lock held.
+		buf = self._buf
+		victim = None
+		oldest = None
+		for pos in self._slots(file_id, offset):
+			seq, slot_file, slot_offset, length, checksum, last_used = _slot_header.unpack_from(buf, pos)
+			if slot_file == file_id and slot_offset == offset and not seq & 1:
+				return # already cached, maybe by another process
+			if oldest is None or last_used < oldest:
+				victim = pos
+				oldest = last_used
+		# An odd sequence number here means a process died while writing the slot.
+		seq = _seq.unpack_from(buf, victim)[0] & ~1
+		_seq.pack_into(buf, victim, seq + 1)
+		data_pos = victim + _slot_header.size
+		buf[data_pos:data_pos+len(data)] = data
+		_slot_header.pack_into(buf, victim, seq + 1, file_id, offset, len(data),
+		    zlib.adler32(data) & 0xffffffff, self._tick())
+		_seq.pack_into(buf, victim, seq + 2)
+
+def _lock_file_name(name):
+	# Returns the name of the lock file of the cache called name.
+	return os.path.join(tempfile.gettempdir(), "{0}.lock".format(name.lstrip("/")))
+
+def _lock(f):
+	# Locks the open file f, waiting until no other process holds the lock.
+	try:
+		import fcntl
+	except ImportError:
+		import msvcrt
+		f.seek(0)
+		msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+	else:
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+def _unlock(f):
+	try:
+		import fcntl
+	except ImportError:
+		import msvcrt
+		f.seek(0)
+		msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+	else:
+		fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _attach(name):
+	# Attaches to an existing shared memory segment, without registering it with
+	# the resource tracker, which would otherwise delete it when this process exits.
+	try:
+		return shared_memory.SharedMemory(name, track=False)
+	except TypeError: # before Python 3.13
+		from multiprocessing import resource_tracker
+		register = resource_tracker.register
+		def register_except_shared_memory(name, rtype):
+			if rtype != "shared_memory":
+				register(name, rtype)
+		resource_tracker.register = register_except_shared_memory
+		try:
+			return shared_memory.SharedMemory(name)
+		finally:
+			resource_tracker.register = register
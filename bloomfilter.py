@@ -0,0 +1,101 @@
+"""
+bloomfilter.py - a Bloom filter of the keys of an mdx or mdd file, for answering failed lookups quickly.
+
+A lookup of a key that is not in the dictionary still costs a search of the key
+block index and the decompression of a key block. MDictWriter can write a Bloom
+filter of its keys to a separate file, which tells for most such keys, without
+reading the dictionary file, that they are not in it:
+
+    writer = MDictWriter(dictionary, "Example", "With Bloom filter")
+    writer.write(open("dictionary.mdx", "wb"))
+    writer.write_bloom_filter(open("dictionary.bloom", "wb"), false_positive_rate=0.01)
+
+    from bloomfilter import BloomFilter
+    from readmdict import MDictReader
+    reader = MDictReader("dictionary.mdx", bloom_filter=BloomFilter("dictionary.bloom"))
+    reader.lookup("dooe")   # [], usually without decompressing anything
+
+A Bloom filter never claims that a key of the dictionary is missing, but for a
+fraction false_positive_rate of the keys not in it, it cannot tell, and the lookup
+proceeds as usual. The filter is read through an mmap, and takes about 1.2 bytes
+per key for a false positive rate of 1%.
+
+File layout:
+
+    magic            8 bytes  b"MDXBLOOM"
+    num_bits         8 bytes, big-endian
+    num_hashes       4 bytes, big-endian
+    encoding         16 bytes: the Python name of the encoding of the keys, in
+                     ASCII, padded with null bytes
+    bits             (num_bits + 7) // 8 bytes; bit i is bit i % 8 of byte i // 8
+
+Bit positions for a key are (h1 + i * h2) % num_bits for i < num_hashes, where h1
+and h2 are the two little-endian 64-bit halves of the 16-byte BLAKE2b hash of the
+encoded key.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib, math, mmap, struct
+
+MAGIC = b"MDXBLOOM"
+
+_header = struct.Struct(b">8sQL16s")
+
+def _hashes(key):
+	# Returns (h1, h2) for the encoded key.
+	return struct.unpack(b"<QQ", hashlib.blake2b(key, digest_size=16).digest())
+
+def _write_bloom_filter(outfile, keys, encoding, false_positive_rate):
+	# Writes a Bloom filter of keys, a list of encoded keys, to outfile. encoding
+	# is the Python name of their encoding.
+	n = max(len(keys), 1)
+	num_bits = max(8, int(math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)))
+	num_hashes = max(1, int(round(float(num_bits) / n * math.log(2))))
+	bits = bytearray((num_bits + 7) // 8)
+	for key in keys:
+		h1, h2 = _hashes(key)
+		for i in range(num_hashes):
+			bit = (h1 + i * h2) % num_bits
+			bits[bit >> 3] |= 1 << (bit & 7)
+	outfile.write(_header.pack(MAGIC, num_bits, num_hashes, encoding.encode("ascii")))
+	outfile.write(bytes(bits))
+
+class BloomFilter(object):
+
+	def __init__(self, filename):
+		"""
+		Opens a Bloom filter written by MDictWriter.write_bloom_filter().
+		"""
+		f = open(filename, "rb")
+		try:
+			self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		magic, self._num_bits, self._num_hashes, encoding = _header.unpack_from(self._data, 0)
+		if magic != MAGIC:
+			self.close()
+			raise ValueError("Not a Bloom filter")
+		self.encoding = encoding.rstrip(b"\0").decode("ascii")
+
+	def close(self):
+		self._data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def might_contain(self, key):
+		"""
+		Returns False if key (a (unicode) string) is certainly not a key of the
+		dictionary, and True if it may be.
+		"""
+		h1, h2 = _hashes(key.encode(self.encoding))
+		data = self._data
+		for i in range(self._num_hashes):
+			bit = (h1 + i * h2) % self._num_bits
+			if not ord(data[_header.size + (bit >> 3):_header.size + (bit >> 3) + 1]) & (1 << (bit & 7)):
+				return False
+		return True
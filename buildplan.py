@@ -0,0 +1,248 @@
+"""
+buildplan.py - estimates the size, memory use and time of building an mdx or mdd file, without building it.
+
+MDictWriter.plan() takes the same arguments as the MDictWriter constructor, and
+reads all entries, but only compresses a sample of the blocks:
+
+    plan = MDictWriter.plan(dictionary, "Example", "Planned", block_size=65536)
+    print(plan["record_blocks"], plan["compression"][2]["output_size"])
+
+The number of entries, key blocks and record blocks, and the uncompressed sizes of
+the blocks and of the key block index, are exact, since the entries are split
+into blocks by the same rules as in a real build. Compressed sizes and times are
+extrapolated from every n-th key block and record block, where n is about
+1 / sample_fraction, compressed with each compression type. The memory estimate
+counts the objects MDictWriter keeps until the file is written: the table of all
+encoded keys and records, and all compressed blocks. It does not count the input
+itself.
+"""
+
+from __future__ import unicode_literals
+
+import io, itertools, operator, sys, time
+
+from writemdict import (ParameterError, _OffsetTableEntry, _MdxRecordBlock, _MdxKeyBlock,
+    _BlockSplitter, _encode_all, _mdx_compress, _lzo, _long_struct, _short_struct,
+    _long_short_struct, _long_pair_struct, _ENCODE_BATCH_SIZE)
+
+def _plan(cls, d, title, description, sample_fraction, compression_types, kwargs):
+	# Implements MDictWriter.plan(); cls is the writer class.
+	if not 0 < sample_fraction <= 1:
+		raise ParameterError("sample_fraction must be between 0 and 1")
+	kwargs.pop("checkpoint_dir", None)
+	kwargs.pop("fulltext_index", None)
+	# A writer without entries checks the parameters, transforms the records as
+	# in a real build, and gives the header.
+	template = cls([], title, description, **kwargs)
+	if compression_types is None:
+		compression_types = [0, 2] if _lzo() is None else [0, 1, 2]
+	planner = _Planner(template, int(round(1.0 / sample_fraction)), compression_types)
+	return planner.run(d)
+
+def _object_size(*objects):
+	# Returns the memory used by objects, not counting the objects they refer to.
+	return sum(sys.getsizeof(o) for o in objects)
+
+class _Planner(object):
+
+	def __init__(self, template, step, compression_types):
+		self._template = template
+		self._version = template._version
+		self._block_size = template._block_size
+		self._python_encoding = template._python_encoding
+		self._encoding_length = template._encoding_length
+		self._is_mdd = template._is_mdd
+		self._key_block_fanout = template._key_block_fanout
+		self._step = max(1, step)
+		self._compression_types = compression_types
+		# Per block type ("key" or "record"): number of blocks, total uncompressed
+		# size, and for the sampled blocks, uncompressed size, and per compression
+		# type, compressed size and time.
+		self._blocks = {}
+		for block_type in ("key", "record"):
+			self._blocks[block_type] = {
+				"count": 0,
+				"decomp_size": 0,
+				"sampled_size": 0,
+				"sampled_comp_size": dict((c, 0) for c in compression_types),
+				"sampled_time": dict((c, 0.0) for c in compression_types),
+			}
+		self._keyb_index = []
+		# The entries of the key block being grouped, for key_block_fanout.
+		self._group = []
+		self._group_size = 0
+		self._group_fanout = 0
+		self._key_splitter = _BlockSplitter(_MdxKeyBlock, self._block_size)
+		self._key_block = []
+		empty_block = _MdxRecordBlock([], 0, self._version)
+		self._block_overhead = _object_size(empty_block, vars(empty_block), empty_block.get_block())
+
+	def run(self, d):
+		start = time.time()
+		if hasattr(d, "items"):
+			items = list(d.items())
+			items.sort(key=operator.itemgetter(0))
+			memory = _object_size(items) + len(items) * _object_size(items[0]) if items else 0
+		else:
+			items = d
+			memory = 0
+		null = "\0".encode(self._python_encoding)
+		record_splitter = _BlockSplitter(_MdxRecordBlock, self._block_size)
+		record_block = []
+		num_entries = 0
+		offset = 0
+		items = iter(items)
+		batches = iter(lambda: list(itertools.islice(items, _ENCODE_BATCH_SIZE)), [])
+		if self._template._minify_html:
+			batches = self._template._minify_batches(batches)
+		if self._template._extract_stylesheet:
+			from stylesheet import _compact_batches
+			batches = _compact_batches(batches, self._template)
+		for batch in batches:
+			keys_enc = _encode_all([key for key, record in batch], self._python_encoding)
+			if not self._is_mdd:
+				records_enc = _encode_all([record for key, record in batch], self._python_encoding)
+			for i, (key, record) in enumerate(batch):
+				key_enc = keys_enc[i]
+				record_null = record if self._is_mdd else records_enc[i] + null
+				t = _OffsetTableEntry(
+				    key=key_enc,
+				    key_null=key_enc + null,
+				    key_len=len(key_enc) // self._encoding_length,
+				    record_null=record_null,
+				    offset=offset)
+				memory += 8 + _object_size(t, t.key, t.key_null, t.record_null, t.offset)
+				if record_splitter.starts_block(t):
+					self._add_record_block(record_block)
+					record_block = []
+				record_block.append(t)
+				offset += len(record_null)
+				num_entries += 1
+		if record_block:
+			self._add_record_block(record_block)
+		if self._key_block_fanout is None:
+			if self._key_block:
+				self._add_key_block(self._key_block)
+		elif self._group_fanout > 0:
+			self._add_key_block(self._group)
+		scan_time = time.time() - start - sum(
+		    sum(b["sampled_time"].values()) for b in self._blocks.values())
+
+		header = io.BytesIO()
+		self._template._write_header(header)
+		header_size = len(header.getvalue())
+		keys = self._blocks["key"]
+		records = self._blocks["record"]
+		keyb_index = b"".join(self._keyb_index)
+		long_size = _long_struct[self._version].size
+		plan = {
+			"num_entries": num_entries,
+			"key_blocks": keys["count"],
+			"record_blocks": records["count"],
+			"key_data_size": keys["decomp_size"],
+			"record_data_size": records["decomp_size"],
+			"key_index_size": len(keyb_index),
+			"scan_time": scan_time,
+			"compression": {},
+		}
+		for c in self._compression_types:
+			comp_sizes = dict((name, self._estimate_comp_size(b, c)) for name, b in self._blocks.items())
+			if self._version == "2.0":
+				keyb_index_size = len(_mdx_compress(keyb_index, c))
+				key_sect_header = 5 * long_size + 4
+			else:
+				keyb_index_size = len(keyb_index)
+				key_sect_header = 4 * long_size
+			output_size = (header_size
+			    + key_sect_header + keyb_index_size + comp_sizes["key"]
+			    + 4 * long_size + 2 * long_size * records["count"] + comp_sizes["record"])
+			comp_time = 0.0
+			for b in self._blocks.values():
+				if b["sampled_size"]:
+					comp_time += b["sampled_time"][c] * b["decomp_size"] / b["sampled_size"]
+			plan["compression"][c] = {
+				"output_size": output_size,
+				"key_index_size": keyb_index_size,
+				"peak_memory": (memory + comp_sizes["key"] + comp_sizes["record"]
+				    + (keys["count"] + records["count"]) * self._block_overhead
+				    + keyb_index_size + 2 * long_size * records["count"]),
+				"build_time": scan_time + comp_time,
+			}
+		return plan
+
+	def _estimate_comp_size(self, b, c):
+		# Returns the estimated total compressed size of the blocks described by b,
+		# with compression type c.
+		if not b["sampled_size"]:
+			return 8 * b["count"]
+		ratio = float(b["sampled_comp_size"][c]) / b["sampled_size"]
+		return 8 * b["count"] + int(round(ratio * b["decomp_size"]))
+
+	def _sample(self, b, data):
+		# Compresses data, the uncompressed data of a block, with each compression
+		# type, and adds the results to b, the statistics of its block type.
+		b["sampled_size"] += len(data)
+		for c in self._compression_types:
+			start = time.time()
+			comp_size = len(_mdx_compress(data, c)) - 8
+			b["sampled_time"][c] += time.time() - start
+			b["sampled_comp_size"][c] += comp_size
+
+	def _add_record_block(self, entries):
+		b = self._blocks["record"]
+		if b["count"] % self._step == 0:
+			data = _MdxRecordBlock._block_data(entries, self._version)
+			b["decomp_size"] += len(data)
+			self._sample(b, data)
+		else:
+			b["decomp_size"] += sum(len(t.record_null) for t in entries)
+		b["count"] += 1
+		if self._key_block_fanout is None:
+			for t in entries:
+				if self._key_splitter.starts_block(t):
+					self._add_key_block(self._key_block)
+					self._key_block = []
+				self._key_block.append(t)
+			return
+		# As in MDictWriter._build_key_blocks().
+		entries_size = sum(_MdxKeyBlock._len_block_entry(t) for t in entries)
+		if self._group_fanout > 0 and (self._group_fanout >= self._key_block_fanout
+		                               or self._group_size + entries_size > self._block_size):
+			self._add_key_block(self._group)
+			self._group = []
+			self._group_size = 0
+			self._group_fanout = 0
+		if entries_size > self._block_size:
+			splitter = _BlockSplitter(_MdxKeyBlock, self._block_size)
+			key_block = []
+			for t in entries:
+				if splitter.starts_block(t):
+					self._add_key_block(key_block)
+					key_block = []
+				key_block.append(t)
+			self._add_key_block(key_block)
+		else:
+			self._group.extend(entries)
+			self._group_size += entries_size
+			self._group_fanout += 1
+
+	def _add_key_block(self, entries):
+		b = self._blocks["key"]
+		data = _MdxKeyBlock._block_data(entries, self._version)
+		b["decomp_size"] += len(data)
+		if b["count"] % self._step == 0:
+			self._sample(b, data)
+		b["count"] += 1
+		# The index entry, as in _MdxKeyBlock.get_index_entry(), with the
+		# uncompressed size in place of the (unknown) compressed size.
+		first, last = entries[0], entries[-1]
+		if self._version == "2.0":
+			first_key, last_key = first.key_null, last.key_null
+		else:
+			first_key, last_key = first.key, last.key
+		self._keyb_index.append(
+		    _long_short_struct[self._version].pack(len(entries), first.key_len)
+		  + first_key
+		  + _short_struct[self._version].pack(last.key_len)
+		  + last_key
+		  + _long_pair_struct[self._version].pack(len(data), len(data)))
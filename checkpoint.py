@@ -0,0 +1,93 @@
+"""
+checkpoint.py - saves compressed record blocks while MDictWriter builds a file, so that an interrupted build can resume.
+
+Compressing the record blocks takes most of the time of building a large
+dictionary. With checkpoint_dir, MDictWriter saves each record block to that
+directory as soon as it is compressed:
+
+    writer = MDictWriter(resources, "Example", "Resources", is_mdd=True,
+                         checkpoint_dir="build-checkpoint")
+    writer.write(open("resources.mdd", "wb"))
+
+If the process is killed, running the same build again reads the input and splits
+it into blocks as before, but takes each block that was already compressed from the
+checkpoint directory instead of compressing it again, and produces the same file.
+
+Blocks are identified by a hash of their uncompressed data (and the compression
+type), so a block is only reused if it is exactly the same; a build with changed
+input or a different block_size still works, and reuses the blocks that did not
+change. The directory is not deleted after the build, and only one build should
+use it at a time.
+
+The directory contains two files: blocks.dat, the compressed blocks, one after the
+other, and blocks.idx, which has an entry (see _entry) for each complete block in
+blocks.dat: the BLAKE2b-128 hash of its uncompressed data, its compression type,
+position and size in blocks.dat, and the Adler-32 checksum of its compressed data.
+A block is written to blocks.dat before its entry; entries for data that is
+incomplete or damaged are ignored.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib, os, struct, zlib
+
+_entry = struct.Struct(b"<16sLQQL")
+
+class _BlockCheckpoint(object):
+	# The compressed blocks saved in a checkpoint directory.
+
+	def __init__(self, directory):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._data = open(os.path.join(directory, "blocks.dat"), "a+b")
+		self._index = open(os.path.join(directory, "blocks.idx"), "a+b")
+		self._index.seek(0)
+		index_data = self._index.read()
+		complete = len(index_data) - len(index_data) % _entry.size
+		if complete != len(index_data):
+			# The last entry was only partly written.
+			self._index.truncate(complete)
+		self._data.seek(0, 2)
+		data_size = self._data.tell()
+		# Maps (hash, compression type) to (position, size, checksum).
+		self._blocks = {}
+		for pos in range(0, complete, _entry.size):
+			digest, compression_type, block_pos, size, checksum = _entry.unpack_from(index_data, pos)
+			if block_pos + size <= data_size:
+				self._blocks[(digest, compression_type)] = (block_pos, size, checksum)
+		# Statistics.
+		self.reused = 0
+		self.saved = 0
+
+	def close(self):
+		self._data.close()
+		self._index.close()
+
+	def get(self, decomp_data, compression_type):
+		# Returns the saved compressed data of the block with the uncompressed data
+		# decomp_data, or None.
+		key = (hashlib.blake2b(decomp_data, digest_size=16).digest(), compression_type)
+		if key not in self._blocks:
+			return None
+		pos, size, checksum = self._blocks[key]
+		self._data.seek(pos)
+		comp_data = self._data.read(size)
+		if len(comp_data) != size or zlib.adler32(comp_data) & 0xffffffff != checksum:
+			del self._blocks[key]
+			return None
+		self.reused += 1
+		return comp_data
+
+	def put(self, decomp_data, compression_type, comp_data):
+		# Saves comp_data, the compressed data of the block with the uncompressed data
+		# decomp_data.
+		digest = hashlib.blake2b(decomp_data, digest_size=16).digest()
+		checksum = zlib.adler32(comp_data) & 0xffffffff
+		self._data.seek(0, 2)
+		pos = self._data.tell()
+		self._data.write(comp_data)
+		self._data.flush()
+		self._index.write(_entry.pack(digest, compression_type, pos, len(comp_data), checksum))
+		self._index.flush()
+		self._blocks[(digest, compression_type)] = (pos, len(comp_data), checksum)
+		self.saved += 1
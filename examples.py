@@ -6,7 +6,7 @@ from __future__ import unicode_literals, print_function, absolute_import, divisi
 # Run it with "python examples.py". It will create various .mdx files in the example_output/
 # directory.
 
-from writemdict import MDictWriter, encrypt_key
+from writemdict import MDictWriter, encrypt_key, write_key_files
 from ripemd128 import ripemd128
 import io
 
@@ -204,6 +204,14 @@ d_mdd = {"\\red.png": raw_image}
 writer = MDictWriter(d_mdd, "Dictionary with MDD file", "This dictionary tests MDD file handling.", is_mdd=True)
 writer.write(outfile_mdd)
 outfile_mdd.close()
-	
 
+### Example 16: Key files for many users at once, for the dictionary of example 9.
+#               This creates one .key file per email address, e.g. bulk_keys_alice@example.com.key.
+emails = ["alice@example.com", "bob@example.com", "carol@example.com"]
+write_key_files(b"abc", emails, lambda email: "example_output/bulk_keys_" + email + ".key", processes=1)
 
+### Example 17: One licensed copy of a dictionary per user, each with the user's
+#               registration code in the header. The blocks are only compressed once.
+writer = MDictWriter(d, "Licensed dictionary", "This dictionary has one copy per user.",
+                     encrypt_key=b"abc", register_by="email")
+writer.write_variants(emails, lambda email: "example_output/licensed_" + email + ".mdx", processes=1)
@@ -0,0 +1,349 @@
+"""
+fulltext.py - a full-text index of the records of an mdx file, stored in a separate file.
+
+The MDX format only supports looking up records by key. To search inside the records,
+MDictWriter can build an inverted index while it prepares the records, mapping each
+word of the (HTML-stripped) record texts to the entries containing it:
+
+    writer = MDictWriter(dictionary, "Example", "With full-text index", fulltext_index=True)
+    writer.write(open("dictionary.mdx", "wb"))
+    writer.write_fulltext_index(open("dictionary.fts", "wb"))
+
+  The index is then searched together with the mdx file:
+
+    from readmdict import MDictReader
+    from fulltext import FullTextIndex
+
+    reader = MDictReader("dictionary.mdx")
+    index = FullTextIndex("dictionary.fts")
+    for key, record in index.search(reader, "female deer"):
+        print(key)
+
+  A query matches the entries containing all of its words, or with phrase=True,
+  containing them next to each other, in that order. Only the record blocks holding
+  matching entries are decompressed.
+
+  Chinese and Japanese text is split into single characters, since its words are
+  not separated by spaces; search for a word in these languages with phrase=True.
+  Words longer than 65535 bytes in UTF-8 are not indexed.
+
+File layout (all integers big-endian):
+
+    magic                   8 bytes  b"MDXFTS\\x00\\x01"
+    num_entries             8 bytes
+    num_record_blocks       8 bytes
+    num_tokens              8 bytes
+    block_first_entry       8 bytes * num_record_blocks: number of the first entry in
+                            each record block
+    token_offsets           8 bytes * num_tokens: position in the file of each token
+    tokens                  for each token, in sorted order: 2 bytes length, the token
+                            in UTF-8, 8 bytes position and 4 bytes length of its postings
+    postings                for each token, a flag byte (1 if zlib compressed, else 0),
+                            followed by a sequence of varints: for each record block
+                            containing the token, the difference to the previous such
+                            block, the number of matching entries in it, and their entry
+                            numbers, each as the difference to the previous one (or to
+                            the first entry of the block).
+
+Since the postings are grouped by record block, a query finds the record blocks to
+decompress directly from the index, and the file can be used through an mmap without
+loading it.
+"""
+
+from __future__ import unicode_literals
+
+import bisect, itertools, mmap, re, struct, zlib
+from array import array
+
+MAGIC = b"MDXFTS\x00\x01"
+
+_MAX_TOKEN_LENGTH = 0xffff
+
+_tag = re.compile(r"<[^>]*>")
+# Chinese characters and Japanese kana, which are written without spaces between
+# words: each is a word of its own.
+_cjk = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f"
+_word = re.compile("[{0}]|[^\\W{0}]+".format(_cjk), re.UNICODE)
+_entity = re.compile(r"&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z]+);")
+_named_entities = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'", "nbsp": " "}
+
+def _unescape_entity(m):
+	name = m.group(1)
+	try:
+		if name[:2] in ("#x", "#X"):
+			return _unichr(int(name[2:], 16))
+		elif name[0] == "#":
+			return _unichr(int(name[1:]))
+	except (ValueError, OverflowError):
+		return " "
+	return _named_entities.get(name, " ")
+
+try:
+	_unichr = unichr
+except NameError:
+	_unichr = chr
+
+def tokenize(record):
+	"""
+	Returns the list of words in record, an HTML snippet: the text outside of tags,
+	with character references replaced, split into words and lowercased. Each
+	Chinese character or Japanese kana is a word of its own.
+	"""
+	text = _entity.sub(_unescape_entity, _tag.sub(" ", record))
+	return _word.findall(text.lower())
+
+def _write_varint(out, n):
+	# Appends n to the bytearray out, as a varint (7 bits per byte, low bits first).
+	while n >= 0x80:
+		out.append((n & 0x7f) | 0x80)
+		n >>= 7
+	out.append(n)
+
+def _read_varints(data):
+	# Returns the list of varints in the bytearray data.
+	values = []
+	n = 0
+	shift = 0
+	for b in bytearray(data):
+		n |= (b & 0x7f) << shift
+		if b & 0x80:
+			shift += 7
+		else:
+			values.append(n)
+			n = 0
+			shift = 0
+	return values
+
+class _FullTextIndexBuilder(object):
+	# Collects the postings while MDictWriter prepares the records.
+
+	def __init__(self):
+		# Maps each token to an array of the entry numbers containing it, in
+		# increasing order.
+		self._postings = {}
+
+	def add(self, entry, record):
+		# Adds the words of record, which is entry number entry. Entries must be
+		# added in increasing order.
+		postings = self._postings
+		for token in set(tokenize(record)):
+			p = postings.get(token)
+			if p is None:
+				p = postings[token] = array(str("I"))
+			p.append(entry)
+
+	def write(self, outfile, num_entries, block_first_entry):
+		# Writes the index to outfile.
+		#
+		# block_first_entry is a list containing the number of the first entry in
+		# each record block.
+		# The length of a token is stored in 2 bytes: longer tokens are not indexed.
+		tokens = sorted(t for t in self._postings if len(t.encode("utf_8")) <= _MAX_TOKEN_LENGTH)
+		def block_of(entry):
+			return bisect.bisect_right(block_first_entry, entry) - 1
+		postings_data = []
+		for token in tokens:
+			data = bytearray()
+			previous_block = 0
+			for block, entries in itertools.groupby(self._postings[token], block_of):
+				entries = list(entries)
+				_write_varint(data, block - previous_block)
+				_write_varint(data, len(entries))
+				previous_entry = block_first_entry[block]
+				for entry in entries:
+					_write_varint(data, entry - previous_entry)
+					previous_entry = entry
+				previous_block = block
+			data = bytes(data)
+			if len(data) > 64:
+				compressed = zlib.compress(data)
+				if len(compressed) < len(data):
+					postings_data.append(b"\x01" + compressed)
+					continue
+			postings_data.append(b"\x00" + data)
+
+		encoded_tokens = [t.encode("utf_8") for t in tokens]
+		header_size = 32 + 8 * len(block_first_entry) + 8 * len(tokens)
+		directory_size = sum(2 + len(t) + 12 for t in encoded_tokens)
+		outfile.write(MAGIC)
+		outfile.write(struct.pack(b">QQQ", num_entries, len(block_first_entry), len(tokens)))
+		outfile.write(struct.pack(str(">{0}Q".format(len(block_first_entry))), *block_first_entry))
+		token_offsets = []
+		pos = header_size
+		for t in encoded_tokens:
+			token_offsets.append(pos)
+			pos += 2 + len(t) + 12
+		outfile.write(struct.pack(str(">{0}Q".format(len(tokens))), *token_offsets))
+		pos = header_size + directory_size
+		for t, p in zip(encoded_tokens, postings_data):
+			outfile.write(struct.pack(b">H", len(t)) + t + struct.pack(b">QL", pos, len(p)))
+			pos += len(p)
+		for p in postings_data:
+			outfile.write(p)
+
+class FullTextIndex(object):
+
+	def __init__(self, filename):
+		"""
+		Opens a full-text index written by MDictWriter.write_fulltext_index().
+		"""
+		f = open(filename, "rb")
+		try:
+			self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		if self._data[0:8] != MAGIC:
+			self.close()
+			raise ValueError("Not a full-text index")
+		self.num_entries, num_blocks, self._num_tokens = struct.unpack_from(b">QQQ", self._data, 8)
+		self._block_first_entry = struct.unpack_from(
+		    str(">{0}Q".format(num_blocks)), self._data, 32)
+		self._token_offsets_pos = 32 + 8 * num_blocks
+
+	def close(self):
+		self._data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _token_at(self, i):
+		# Returns (token, postings position, postings length) of token number i.
+		pos = struct.unpack_from(b">Q", self._data, self._token_offsets_pos + 8 * i)[0]
+		length = struct.unpack_from(b">H", self._data, pos)[0]
+		token = self._data[pos+2:pos+2+length]
+		postings_pos, postings_len = struct.unpack_from(b">QL", self._data, pos + 2 + length)
+		return token, postings_pos, postings_len
+
+	def postings(self, token):
+		"""
+		Returns the entries containing token (a lowercase word), as a list of pairs
+		(record block number, list of entry numbers in that block).
+		"""
+		token = token.encode("utf_8")
+		lo, hi = 0, self._num_tokens
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._token_at(mid)[0] < token:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo == self._num_tokens:
+			return []
+		found, pos, length = self._token_at(lo)
+		if found != token:
+			return []
+		data = self._data[pos:pos+length]
+		if data[0:1] == b"\x01":
+			data = zlib.decompress(data[1:])
+		else:
+			data = data[1:]
+		values = _read_varints(data)
+		groups = []
+		block = 0
+		i = 0
+		while i < len(values):
+			block += values[i]
+			count = values[i+1]
+			entry = self._block_first_entry[block]
+			entries = []
+			for delta in values[i+2:i+2+count]:
+				entry += delta
+				entries.append(entry)
+			groups.append((block, entries))
+			i += 2 + count
+		return groups
+
+	def search(self, reader, query, phrase=False, limit=None):
+		"""
+		Returns the entries of the mdx file matching query, as a list of (key, record)
+		pairs in key order.
+
+		reader is an MDictReader for the mdx file the index was built for.
+
+		query is a (unicode) string. It is split into words like the records. Entries
+		  match if they contain all the words, or, if phrase is true, if they contain
+		  all the words next to each other in the same order.
+
+		limit is the maximal number of results, or None for no limit.
+		"""
+		tokens = tokenize(query)
+		if not tokens:
+			return []
+		# Intersect the postings, as maps from block to set of entries.
+		candidates = None
+		for token in set(tokens):
+			found = dict((block, set(entries)) for block, entries in self.postings(token))
+			if candidates is None:
+				candidates = found
+			else:
+				candidates = dict(
+				    (block, candidates[block] & entries)
+				    for block, entries in found.items()
+				    if block in candidates and candidates[block] & entries)
+			if not candidates:
+				return []
+		results = []
+		key_block_first_entry = [b.first_entry for b in reader.key_blocks]
+		for block in sorted(candidates):
+			records = self._block_records(reader, key_block_first_entry, block)
+			for entry in sorted(candidates[block]):
+				record = records[entry - self._block_first_entry[block]]
+				if phrase and not _contains(tokenize(record), tokens):
+					continue
+				results.append((_entry_key(reader, key_block_first_entry, entry), record))
+				if limit is not None and len(results) >= limit:
+					return results
+		return results
+
+	def _block_records(self, reader, key_block_first_entry, block):
+		# Returns the records in record block number block, as a list of strings.
+		#
+		# The records are cut out at their offsets in the key blocks, rather than at
+		# null characters, which may also occur inside a record.
+		first = self._block_first_entry[block]
+		if block + 1 < len(self._block_first_entry):
+			stop = self._block_first_entry[block+1]
+		else:
+			stop = self.num_entries
+		record_block = reader.record_blocks[block]
+		data = reader.decompress_block(record_block)
+		offsets = _entry_offsets(reader, key_block_first_entry, first, stop)
+		offsets.append(record_block.decomp_offset + len(data))
+		records = []
+		for start, end in zip(offsets, offsets[1:]):
+			record = data[start-record_block.decomp_offset:end-record_block.decomp_offset].decode(reader.encoding)
+			if record.endswith("\0"):
+				record = record[:-1]
+			records.append(reader._expand_styles(record))
+		return records
+
+def _entry_offsets(reader, key_block_first_entry, start, stop):
+	# Returns the record offsets of entries number start to stop - 1 in the file
+	# opened by reader, an MDictReader.
+	offsets = []
+	i = bisect.bisect_right(key_block_first_entry, start) - 1
+	while len(offsets) < stop - start:
+		block = reader.key_blocks[i]
+		entries = reader.key_block_entries(block)
+		skip = max(0, start - block.first_entry)
+		offsets.extend(offset for offset, key in entries[skip:skip+stop-start-len(offsets)])
+		i += 1
+	return offsets
+
+def _entry_key(reader, key_block_first_entry, entry):
+	# Returns the key of entry number entry in the file opened by reader, an
+	# MDictReader. key_block_first_entry lists the first_entry of its key blocks.
+	block = reader.key_blocks[bisect.bisect_right(key_block_first_entry, entry) - 1]
+	key = reader.key_block_entries(block)[entry - block.first_entry][1]
+	return key.decode(reader.encoding)
+
+def _contains(words, phrase):
+	# Returns True if the list phrase occurs as a contiguous part of the list words.
+	n = len(phrase)
+	for i in range(len(words) - n + 1):
+		if words[i:i+n] == phrase:
+			return True
+	return False
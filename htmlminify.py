@@ -0,0 +1,168 @@
+"""
+htmlminify.py - removes redundant whitespace, comments and attribute quotes from the HTML records of an mdx file.
+
+Records of mdx files are HTML snippets, and when they are generated from templates,
+they often contain indentation, comments and quoted attribute values that make no
+difference to how they are shown, but take up space before and after compression.
+With minify_html=True, MDictWriter passes each record through minify_html() before
+encoding it:
+
+    writer = MDictWriter(dictionary, "Example", "Minified", minify_html=True)
+    writer.write(open("dictionary.mdx", "wb"))
+    print(writer.minify_stats()["bytes_saved"])
+
+minify_html() only makes changes that do not alter how a browser renders the HTML:
+
+  - Comments are removed, except conditional comments (<!--[if ...]>).
+  - In text, each run of whitespace (space, tab, newline, carriage return, form
+    feed; not non-breaking spaces) is replaced by a single space, which renders the
+    same in normal text. Text inside <pre>, <textarea>, <script> and <style>
+    elements is kept as it is.
+  - In tags, whitespace between attributes is replaced by a single space, and
+    quotes are removed from attribute values made of letters, digits and the
+    characters "_", ".", ":", "#" and "-" only.
+
+Tags that cannot be parsed are kept as they are. The one case where collapsing
+whitespace does change the rendering is text styled with the CSS white-space
+property (e.g. "white-space: pre" in the StyleSheet or in a style attribute). For
+such dictionaries, minify the records with minify_html(record,
+collapse_whitespace=False) before giving them to MDictWriter instead.
+
+In transcodemdict.py, records are minified by the worker processes, while other
+workers compress the blocks.
+"""
+
+from __future__ import unicode_literals
+
+import collections, re
+
+_token = re.compile(r"""
+    (?P<comment><!--.*?-->)
+  | (?P<raw><(?P<raw_name>pre|textarea|script|style)\b(?:"[^"]*"|'[^']*'|[^'">])*>.*?</(?P=raw_name)\s*>)
+  | (?P<tag></?[A-Za-z](?:"[^"]*"|'[^']*'|[^'">])*>)
+  | (?P<text>[^<]+)
+  | (?P<other><)
+""", re.S | re.I | re.X)
+
+_start_tag = re.compile(r"""
+    <(?P<name>[A-Za-z][^\s/>]*)
+    (?P<attributes>(?:[ \t\n\r\f]+[^\s"'>/=]+(?:[ \t\n\r\f]*=[ \t\n\r\f]*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*)
+    [ \t\n\r\f]*(?P<close>/?)>$
+""", re.X)
+
+_attribute = re.compile(r"""
+    (?P<name>[^\s"'>/=]+)(?:[ \t\n\r\f]*=[ \t\n\r\f]*(?P<value>"[^"]*"|'[^']*'|[^\s"'=<>`]+))?
+""", re.X)
+
+_end_tag = re.compile(r"</(?P<name>[A-Za-z][^\s/>]*)[ \t\n\r\f]*>$")
+
+_whitespace = re.compile(r"[ \t\n\r\f]+")
+
+_unquoted_value = re.compile(r"[A-Za-z0-9_.:#-]+$")
+
+# The minified forms of recently seen tags. Records of one dictionary mostly use
+# the same few tags, so this saves parsing most of them.
+_tag_cache = {}
+_TAG_CACHE_SIZE = 4096
+
+def _minify_tag(tag):
+	# Returns the start or end tag tag, with redundant whitespace and quotes removed,
+	# or tag itself if it cannot be parsed.
+	m = _end_tag.match(tag)
+	if m:
+		return "</{0}>".format(m.group("name"))
+	m = _start_tag.match(tag)
+	if not m:
+		return tag
+	parts = ["<", m.group("name")]
+	attributes = list(_attribute.finditer(m.group("attributes")))
+	for i, a in enumerate(attributes):
+		parts.append(" ")
+		parts.append(a.group("name"))
+		value = a.group("value")
+		if value is None:
+			continue
+		if value[0] in "\"'":
+			unquoted = value[1:-1]
+			# An unquoted value just before "/>" would take up the "/".
+			if _unquoted_value.match(unquoted) and not (m.group("close") and i == len(attributes) - 1):
+				value = unquoted
+		parts.append("=")
+		parts.append(value)
+	parts.append(m.group("close"))
+	parts.append(">")
+	return "".join(parts)
+
+def minify_html(html, collapse_whitespace=True):
+	"""
+	Returns the HTML snippet html (a (unicode) string), without redundant
+	whitespace, comments and quotes. See the description of this module.
+
+	If collapse_whitespace is false, whitespace in text is kept as it is.
+	"""
+	parts = []
+	# The text since the last tag, which is only collapsed when it is complete, so
+	# that the whitespace around a removed comment is collapsed too.
+	text = []
+	for m in _token.finditer(html):
+		kind = m.lastgroup
+		s = m.group(kind)
+		if kind == "text":
+			text.append(s)
+			continue
+		if kind == "comment" and not (s.startswith("<!--[if") or s.startswith("<!--<![endif]")):
+			continue
+		if text:
+			parts.append(_collapse("".join(text), collapse_whitespace))
+			text = []
+		if kind == "tag":
+			tag = _tag_cache.get(s)
+			if tag is None:
+				if len(_tag_cache) >= _TAG_CACHE_SIZE:
+					_tag_cache.clear()
+				tag = _tag_cache[s] = _minify_tag(s)
+			s = tag
+		parts.append(s)
+	if text:
+		parts.append(_collapse("".join(text), collapse_whitespace))
+	return "".join(parts)
+
+def _collapse(text, collapse_whitespace):
+	return _whitespace.sub(" ", text) if collapse_whitespace else text
+
+def _minify_batch(args):
+	# Worker function: minifies a list of records. Returns the minified records,
+	# and their total encoded size before and after.
+	records, python_encoding, collapse_whitespace = args
+	minified = [minify_html(r, collapse_whitespace) for r in records]
+	return (minified,
+	    sum(len(r.encode(python_encoding)) for r in records),
+	    sum(len(r.encode(python_encoding)) for r in minified))
+
+def _minify_batches(batches, python_encoding, stats, pool=None, collapse_whitespace=True):
+	# Yields the batches of (key, record) pairs in the iterable batches, with the
+	# records minified, and adds the number of records and their sizes before and
+	# after to the dictionary stats. If pool is not None, the batches are minified
+	# by its workers, up to two batches ahead.
+	def minified(batch, result):
+		records, before, after = result
+		stats["records"] += len(records)
+		stats["bytes_before"] += before
+		stats["bytes_after"] += after
+		return [(key, record) for (key, _), record in zip(batch, records)]
+
+	if pool is None:
+		for batch in batches:
+			yield minified(batch, _minify_batch(
+			    ([record for key, record in batch], python_encoding, collapse_whitespace)))
+		return
+	pending = collections.deque()
+	for batch in batches:
+		pending.append((batch, pool.apply_async(_minify_batch,
+		    (([record for key, record in batch], python_encoding, collapse_whitespace),))))
+		if len(pending) > 2:
+			batch, result = pending.popleft()
+			yield minified(batch, result.get())
+	while pending:
+		batch, result = pending.popleft()
+		yield minified(batch, result.get())
@@ -0,0 +1,211 @@
+"""
+indexcache.py - caches the parsed block indexes of an mdx or mdd file in a separate file.
+
+Opening a large dictionary with MDictReader means decompressing (and possibly
+decrypting) the key block index, and parsing an entry for every key block and
+record block. With index_cache, the result is saved to a separate file the first
+time, and later opens read only the header of the dictionary, and map the cache
+file into memory:
+
+    from readmdict import MDictReader
+    reader = MDictReader("dictionary.mdx", index_cache="dictionary.mdx.idx")
+
+The cache is only used if the size and modification time of the dictionary file,
+and the checksum of its header, are the same as when it was written; otherwise it
+is rewritten. The block indexes are then read from the mmap only as they are used,
+so opening the file costs a few page faults, regardless of its size.
+
+File layout (all integers little-endian):
+
+    header             see _header: the magic b"MDXIDXC\\x01", the values used
+                       to validate the cache, and the scalar attributes of the reader
+    preamble           the (decrypted) key section header
+    key blocks         for each key block, see _key_block: offset, comp_size,
+                       decomp_size, num_entries, first_entry, and the position and
+                       lengths of first_key and last_key in the key data
+    record blocks      for each record block, see _record_block: offset, comp_size,
+                       decomp_size, decomp_offset
+    key data           the first and last keys of all key blocks
+"""
+
+from __future__ import unicode_literals
+
+import mmap, os, struct
+
+MAGIC = b"MDXIDXC\x01"
+
+# magic, file size, modification time (ns), header checksum, preamble checksum,
+# whether there is a preamble checksum, preamble length, num_entries,
+# total_record_len, number of key blocks, number of record blocks, and the
+# offsets and sizes of the parts of the file.
+_header = struct.Struct(b"<8sQqLLLLQQQQQQQQQQQ")
+_key_block = struct.Struct(b"<QQQQQQLL")
+_record_block = struct.Struct(b"<QQQQ")
+
+def _file_stamp(filename):
+	# Returns (size, modification time in ns) of filename.
+	st = os.stat(filename)
+	mtime_ns = getattr(st, "st_mtime_ns", None)
+	if mtime_ns is None:
+		mtime_ns = int(st.st_mtime * 1e9)
+	return st.st_size, mtime_ns
+
+def load_index_cache(reader, filename):
+	# Sets the block indexes of reader (an MDictReader whose header has been read)
+	# from the cache file filename, and returns True, if the cache is valid.
+	# Otherwise returns False.
+	try:
+		f = open(filename, "rb")
+	except IOError:
+		return False
+	try:
+		try:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (ValueError, mmap.error):
+			return False # e.g. an empty file
+	finally:
+		f.close()
+	if len(data) < _header.size:
+		data.close()
+		return False
+	(magic, file_size, mtime_ns, header_checksum, preamble_checksum, has_preamble_checksum,
+	 preamble_len, num_entries, total_record_len, num_key_blocks, num_record_blocks,
+	 keyb_index_offset, keyb_index_comp_size, keyb_index_decomp_size, keyblocks_total_size,
+	 record_sect_offset, recordb_index_offset, recordblocks_total_size) = _header.unpack_from(data, 0)
+	if (magic != MAGIC or (file_size, mtime_ns) != _file_stamp(reader.filename)
+	    or header_checksum != reader.header_checksum):
+		data.close()
+		return False
+	pos = _header.size
+	reader._preamble = data[pos:pos+preamble_len]
+	reader.preamble_checksum = preamble_checksum if has_preamble_checksum else None
+	pos += preamble_len
+	key_blocks_pos = pos
+	record_blocks_pos = key_blocks_pos + num_key_blocks * _key_block.size
+	key_data_pos = record_blocks_pos + num_record_blocks * _record_block.size
+
+	reader._index_cache = data
+	reader.num_entries = num_entries
+	reader.total_record_len = total_record_len
+	reader.file_size = file_size
+	reader._keyb_index_offset = keyb_index_offset
+	reader._keyb_index_comp_size = keyb_index_comp_size
+	reader._keyb_index_decomp_size = keyb_index_decomp_size
+	reader._keyblocks_total_size = keyblocks_total_size
+	reader._record_sect_offset = record_sect_offset
+	reader._recordb_index_offset = recordb_index_offset
+	reader._recordblocks_total_size = recordblocks_total_size
+	reader.key_blocks = _KeyBlockList(data, key_blocks_pos, num_key_blocks, key_data_pos)
+	reader.record_blocks = _RecordBlockList(data, record_blocks_pos, num_record_blocks)
+	reader._record_offsets = _FieldView(reader.record_blocks, "decomp_offset")
+	reader._key_ranges = (
+	    _FieldView(reader.key_blocks, "first_key", reader.encoding),
+	    _FieldView(reader.key_blocks, "last_key", reader.encoding))
+	return True
+
+def write_index_cache(reader, filename):
+	# Writes the block indexes of reader, an MDictReader opened from a file, to
+	# the cache file filename. The file is replaced atomically, so that concurrent
+	# readers never see a partial cache.
+	file_size, mtime_ns = _file_stamp(reader.filename)
+	key_data = []
+	key_data_len = 0
+	key_blocks = []
+	for b in reader.key_blocks:
+		key_blocks.append(_key_block.pack(b.offset, b.comp_size, b.decomp_size, b.num_entries,
+		    b.first_entry, key_data_len, len(b.first_key), len(b.last_key)))
+		key_data.append(b.first_key)
+		key_data.append(b.last_key)
+		key_data_len += len(b.first_key) + len(b.last_key)
+	record_blocks = [
+	    _record_block.pack(b.offset, b.comp_size, b.decomp_size, b.decomp_offset)
+	    for b in reader.record_blocks]
+	tmp_name = "{0}.{1}.tmp".format(filename, os.getpid())
+	f = open(tmp_name, "wb")
+	try:
+		f.write(_header.pack(MAGIC, file_size, mtime_ns, reader.header_checksum,
+		    reader.preamble_checksum or 0, reader.preamble_checksum is not None,
+		    len(reader._preamble), reader.num_entries, reader.total_record_len,
+		    len(reader.key_blocks), len(reader.record_blocks),
+		    reader._keyb_index_offset, reader._keyb_index_comp_size,
+		    reader._keyb_index_decomp_size, reader._keyblocks_total_size,
+		    reader._record_sect_offset, reader._recordb_index_offset,
+		    reader._recordblocks_total_size))
+		f.write(reader._preamble)
+		f.write(b"".join(key_blocks))
+		f.write(b"".join(record_blocks))
+		f.write(b"".join(key_data))
+	finally:
+		f.close()
+	getattr(os, "replace", os.rename)(tmp_name, filename)
+
+class _BlockList(object):
+	# A read-only list of BlockInfo objects, which are created from the cache file
+	# as they are accessed.
+
+	def __init__(self, data, pos, n):
+		self._data = data
+		self._pos = pos
+		self._n = n
+
+	def __len__(self):
+		return self._n
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(self._n))]
+		if i < 0:
+			i += self._n
+		if not 0 <= i < self._n:
+			raise IndexError("block index out of range")
+		return self._block(i)
+
+class _KeyBlockList(_BlockList):
+
+	def __init__(self, data, pos, n, key_data_pos):
+		_BlockList.__init__(self, data, pos, n)
+		self._key_data_pos = key_data_pos
+
+	def _block(self, i):
+		from readmdict import BlockInfo
+		(offset, comp_size, decomp_size, num_entries, first_entry, key_pos, first_len,
+		 last_len) = _key_block.unpack_from(self._data, self._pos + i * _key_block.size)
+		key_pos += self._key_data_pos
+		return BlockInfo(
+		    offset=offset,
+		    comp_size=comp_size,
+		    decomp_size=decomp_size,
+		    num_entries=num_entries,
+		    first_entry=first_entry,
+		    first_key=self._data[key_pos:key_pos+first_len],
+		    last_key=self._data[key_pos+first_len:key_pos+first_len+last_len])
+
+class _RecordBlockList(_BlockList):
+
+	def _block(self, i):
+		from readmdict import BlockInfo
+		offset, comp_size, decomp_size, decomp_offset = _record_block.unpack_from(
+		    self._data, self._pos + i * _record_block.size)
+		return BlockInfo(
+		    offset=offset,
+		    comp_size=comp_size,
+		    decomp_size=decomp_size,
+		    decomp_offset=decomp_offset)
+
+class _FieldView(object):
+	# A read-only list of one attribute of the blocks in a _BlockList (decoded with
+	# encoding, if given), which can be searched with bisect.
+
+	def __init__(self, blocks, name, encoding=None):
+		self._blocks = blocks
+		self._name = name
+		self._encoding = encoding
+
+	def __len__(self):
+		return len(self._blocks)
+
+	def __getitem__(self, i):
+		value = getattr(self._blocks[i], self._name)
+		if self._encoding is not None:
+			value = value.decode(self._encoding)
+		return value
@@ -0,0 +1,167 @@
+"""
+lookupservice.py - an asyncio service for looking up keys in mdx and mdd files.
+
+Requires Python 3.7 or later.
+
+A LookupService answers lookups on one MDictReader from many concurrent tasks. The
+reader reads with os.pread() (or an mmap), so concurrent lookups never share a file
+position and need no lock. Decompression runs in a bounded thread pool, and when
+several lookups need the same block at the same time, it is read and decompressed
+only once, and the result is shared between them.
+
+serve() exposes one or more services over HTTP, and fetch() is a matching client:
+
+    import asyncio
+    from readmdict import MDictReader
+    from lookupservice import LookupService, serve, fetch
+
+    async def main():
+        services = {"dict": LookupService(MDictReader("dictionary.mdx"))}
+        server = await serve(services, "127.0.0.1", 8080)
+        status, body = await fetch("127.0.0.1", 8080, "dict", "doe")
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(main())
+
+  The HTTP API is "GET /<name>?q=<key>". It responds with the records for key (for
+  an mdx file, as UTF-8 HTML, separated by <hr/> if there are several; for an mdd
+  file, the first record as binary data), with status 404 if key is not found, or
+  with status 500 if the lookup fails, e.g. because a block of the file is damaged
+  (the error is logged).
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import urllib.parse
+
+class LookupService(object):
+
+	def __init__(self, reader, max_workers=4):
+		"""
+		reader is an MDictReader, which is used by this service only.
+
+		max_workers is the number of threads used for decompressing blocks.
+		"""
+		self._reader = reader
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+		# Maps ("key", i) or ("record", i) to the future of block i being decompressed.
+		self._pending = {}
+
+	def close(self):
+		self._executor.shutdown()
+		self._reader.close()
+
+	def _load_key_block(self, i):
+		return self._reader.key_block_entries(self._reader.key_blocks[i])
+
+	def _load_record_block(self, i):
+		return self._reader.decompress_block(self._reader.record_blocks[i])
+
+	async def _block(self, kind, i):
+		# Returns the decompressed record block i, or the entries of key block i.
+		#
+		# If the same block is already being loaded for another lookup, waits for
+		# that instead of loading it again.
+		future = self._pending.get((kind, i))
+		if future is None:
+			load = self._load_key_block if kind == "key" else self._load_record_block
+			future = asyncio.get_running_loop().run_in_executor(self._executor, load, i)
+			self._pending[(kind, i)] = future
+			future.add_done_callback(lambda f: self._pending.pop((kind, i), None))
+		# A lookup that is cancelled must not cancel the load for the other lookups.
+		return await asyncio.shield(future)
+
+	async def lookup(self, key):
+		"""
+		Returns a list of all records for key, as MDictReader.lookup().
+		"""
+		reader = self._reader
+		try:
+			key_enc = key.encode(reader.encoding)
+		except UnicodeEncodeError:
+			return [] # not a key of a dictionary in this encoding
+		if reader._bloom_filter is not None and not reader._bloom_filter.might_contain(key):
+			return []
+		records = []
+		for i in reader.key_blocks_for(key):
+			entries = await self._block("key", i)
+			for j, (offset, entry_key) in enumerate(entries):
+				if entry_key != key_enc:
+					continue
+				end = reader._record_end(i, entries, j)
+				if end is None:
+					end = (await self._block("key", i + 1))[0][0]
+				block_index = reader.record_block_for(offset)
+				data = await self._block("record", block_index)
+				records.append(reader._record_from_block(block_index, data, offset, end))
+		return records
+
+async def _handle(services, stream_reader, stream_writer):
+	# Handles one HTTP request.
+	try:
+		request_line = await stream_reader.readline()
+		while (await stream_reader.readline()) not in (b"\r\n", b"\n", b""):
+			pass # skip the request headers
+		try:
+			method, target, _ = request_line.decode("latin_1").split(" ", 2)
+		except ValueError:
+			method, target = None, ""
+		url = urllib.parse.urlsplit(target)
+		name = urllib.parse.unquote(url.path.lstrip("/"))
+		query = urllib.parse.parse_qs(url.query)
+		if method != "GET" or name not in services or "q" not in query:
+			status, content_type, body = "400 Bad Request", "text/plain", b"Bad request"
+		else:
+			service = services[name]
+			try:
+				records = await service.lookup(query["q"][0])
+			except Exception:
+				# E.g. a FormatError from a damaged block: the client still gets a
+				# response, and the server keeps running.
+				logging.getLogger(__name__).exception("Lookup of %r in %r failed", query["q"][0], name)
+				records = None
+			if records is None:
+				status, content_type, body = "500 Internal Server Error", "text/plain", b"Internal server error"
+			elif not records:
+				status, content_type, body = "404 Not Found", "text/plain", b"Not found"
+			elif service._reader.is_mdd:
+				status, content_type, body = "200 OK", "application/octet-stream", records[0]
+			else:
+				status, content_type = "200 OK", "text/html; charset=utf-8"
+				body = "<hr/>".join(records).encode("utf_8")
+		stream_writer.write(
+		    "HTTP/1.0 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n\r\n".format(
+		        status, content_type, len(body)).encode("latin_1") + body)
+		await stream_writer.drain()
+	finally:
+		stream_writer.close()
+
+async def serve(services, host="127.0.0.1", port=8080):
+	"""
+	Starts an HTTP server for the LookupServices in services, a dictionary mapping
+	the name used in the URL to the service. Returns the asyncio server.
+	"""
+	return await asyncio.start_server(
+	    lambda r, w: _handle(services, r, w), host, port)
+
+async def fetch(host, port, name, key):
+	"""
+	Looks up key in the service called name, on the server at host and port.
+
+	Returns (status, body), where status is the HTTP status code, and body is the
+	response body, as bytes.
+	"""
+	stream_reader, stream_writer = await asyncio.open_connection(host, port)
+	try:
+		target = "/{0}?q={1}".format(urllib.parse.quote(name), urllib.parse.quote(key))
+		stream_writer.write("GET {0} HTTP/1.0\r\nHost: {1}\r\n\r\n".format(
+		    target, host).encode("latin_1"))
+		await stream_writer.drain()
+		response = await stream_reader.read()
+	finally:
+		stream_writer.close()
+	head, _, body = response.partition(b"\r\n\r\n")
+	status = int(head.split(b" ", 2)[1])
+	return status, body
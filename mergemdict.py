@@ -0,0 +1,147 @@
+"""
+mergemdict.py - merges several mdx (or mdd) files, covering separate key ranges, into one.
+
+Each record block depends only on the records it contains, and the key blocks refer
+to records by their offset into the concatenation of all (decompressed) record
+blocks. So the record blocks of the shards can be copied into the merged file as
+they are, without being decompressed or compressed again. Only the offsets in the
+key blocks are changed, after which the key blocks and both block indexes are
+rebuilt.
+
+Usage example:
+
+    from mergemdict import merge_mdict
+
+    outfile = open("dictionary.mdx", "wb")
+    merge_mdict(["a-m.mdx", "n-z.mdx"], outfile, title="Merged", description="A to Z")
+    outfile.close()
+
+  or, from the command line:
+
+    python mergemdict.py dictionary.mdx a-m.mdx n-z.mdx
+
+The key ranges of the shards must not overlap, but the shards may be given in any
+order. All shards must use the same encoding (and StyleSheet, for compact mdx
+files), and be either all mdx or all mdd files.
+"""
+
+from __future__ import unicode_literals
+
+import sys
+
+from writemdict import MDictWriter, ParameterError, _OffsetTableEntry, _MdxRecordBlock
+from readmdict import MDictReader
+
+def merge_mdict(shards, outfile, title=None, description=None, shard_encrypt_key=None, **kwargs):
+	"""
+	Merges the mdx or mdd files shards into one, and writes it to outfile.
+
+	shards is a list of file names.
+
+	outfile is a file-like object, opened in binary mode.
+
+	title and description are as for MDictWriter. If not given, they are taken from
+	  the header of the first shard.
+
+	shard_encrypt_key is the dictionary key of the shards, if they are encrypted.
+
+	Any other keyword arguments (e.g. version, compression_type, encrypt_key) are
+	passed on to MDictWriter, and apply to the merged file. compression_type only
+	applies to the rebuilt key blocks; the record blocks keep their compression.
+	"""
+	readers = []
+	try:
+		for shard in shards:
+			readers.append(MDictReader(shard, encrypt_key=shard_encrypt_key))
+		readers = _sort_shards(readers)
+		first = readers[0]
+		if title is None:
+			title = first.header.get("Title", "")
+		if description is None:
+			description = first.header.get("Description", "")
+		kwargs["is_mdd"] = first.is_mdd
+		if not first.is_mdd:
+			kwargs["encoding"] = first.header.get("Encoding", "UTF-8").lower()
+		writer = _MergingWriter(readers, title, description, **kwargs)
+		# The records are copied with the styles of the compact format, if any.
+		writer._styles = first.stylesheet or {}
+		writer.write(outfile)
+	finally:
+		for reader in readers:
+			reader.close()
+
+def _sort_shards(readers):
+	# Returns readers, sorted by key range. Raises ParameterError if the shards
+	# cannot be merged.
+	if not readers:
+		raise ParameterError("No shards to merge")
+	for reader in readers:
+		if reader.is_mdd != readers[0].is_mdd or reader.encoding != readers[0].encoding:
+			raise ParameterError("Shards must all be mdx or all be mdd files, with the same encoding")
+		if reader.stylesheet != readers[0].stylesheet:
+			raise ParameterError("Shards must all have the same StyleSheet")
+	def key_range(reader):
+		if not reader.key_blocks:
+			return None
+		return (reader.key_blocks[0].first_key.decode(reader.encoding),
+		        reader.key_blocks[-1].last_key.decode(reader.encoding))
+	nonempty = [r for r in readers if r.key_blocks]
+	nonempty.sort(key=key_range)
+	for previous, reader in zip(nonempty, nonempty[1:]):
+		if key_range(previous)[1] > key_range(reader)[0]:
+			raise ParameterError("The key ranges of {0} and {1} overlap".format(
+			    previous.filename, reader.filename))
+	return nonempty or readers[:1]
+
+class _MergingWriter(MDictWriter):
+	# An MDictWriter which takes its entries from a sorted list of MDictReaders,
+	# instead of a dictionary. The records are not read; instead, the record
+	# blocks are copied from the readers.
+
+	def _build_offset_table(self, readers):
+		# As MDictWriter._build_offset_table, but record_null is None for all
+		# entries. Also sets self._source_record_blocks to a list of
+		# (reader, BlockInfo) for all the record blocks to copy.
+		null = "\0".encode(self._python_encoding)
+		self._offset_table = []
+		self._source_record_blocks = []
+		base = 0
+		for reader in readers:
+			for block in reader.key_blocks:
+				for offset, key in reader.key_block_entries(block):
+					self._offset_table.append(_OffsetTableEntry(
+					    key=key,
+					    key_null=key + null,
+					    key_len=len(key) // self._encoding_length,
+					    offset=base + offset,
+					    record_null=None))
+			for block in reader.record_blocks:
+				self._source_record_blocks.append((reader, block))
+			base += reader.total_record_len
+		self._total_record_len = base
+		self._num_entries = len(self._offset_table)
+
+	def _build_record_blocks(self):
+		self._record_blocks = [
+		    _CopiedRecordBlock(reader, block, self._version)
+		    for reader, block in self._source_record_blocks]
+
+class _CopiedRecordBlock(_MdxRecordBlock):
+	# A record block copied from an existing file. The compressed data is only
+	# read when the block is written.
+	def __init__(self, reader, block, version):
+		self._reader = reader
+		self._block = block
+		self._comp_size = block.comp_size
+		self._decomp_size = block.decomp_size
+		self._version = version
+
+	def get_block(self):
+		return self._reader.read_block(self._block)
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3:
+		sys.stderr.write("Usage: python mergemdict.py OUTPUT SHARD [SHARD ...]\n")
+		sys.exit(2)
+	with open(sys.argv[1], "wb") as outfile:
+		merge_mdict(sys.argv[2:], outfile)
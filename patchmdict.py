@@ -0,0 +1,204 @@
+"""
+patchmdict.py - block-level patches between two versions of an mdx or mdd file.
+
+Each block of an MDict file is compressed on its own, and a record block only
+depends on the records in it. When a dictionary is rebuilt after a small change,
+most of its blocks are therefore identical (byte for byte) to blocks of the
+previous build. make_patch() finds these by hashing the compressed blocks of both
+files, and writes a patch which only contains the blocks that changed, together
+with the parts of the new file between blocks (the header and the block indexes).
+apply_patch() then rebuilds the new file from the old one and the patch, writing
+it sequentially, and copying unchanged ranges of the old file with
+os.copy_file_range() where available.
+
+Usage example:
+
+    from patchmdict import make_patch, apply_patch
+
+    with open("update.mdxpatch", "wb") as patch:
+        make_patch("dictionary-v1.mdd", "dictionary-v2.mdd", patch)
+
+    # On the user's machine:
+    with open("update.mdxpatch", "rb") as patch, open("dictionary-v2.mdd", "wb") as outfile:
+        apply_patch("dictionary-v1.mdd", patch, outfile)
+
+  or, from the command line:
+
+    python patchmdict.py diff OLD NEW PATCH
+    python patchmdict.py apply OLD PATCH NEW
+
+Blocks are only reused if they are identical, so a change early in the file that
+moves the boundaries of all following record blocks makes them all differ. (Key
+blocks store record offsets, so they change whenever the length of an earlier
+record changes, but they are small.)
+
+Patch format (integers big-endian):
+
+    magic            8 bytes  b"MDXPATCH"
+    old size         8 bytes
+    old digest       16 bytes: BLAKE2b-128 of the whole old file
+    new size         8 bytes
+    new digest       16 bytes: BLAKE2b-128 of the whole new file
+    operations       each either b"C", 8 bytes offset, 8 bytes length: copy that range
+                     of the old file; or b"D", 8 bytes length, data: write data; or
+                     b"E": end of patch.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib, os, struct, sys
+
+from writemdict import ParameterError, _copy_range
+from readmdict import MDictReader
+
+MAGIC = b"MDXPATCH"
+
+_header = struct.Struct(b">8sQ16sQ16s")
+_copy = struct.Struct(b">QQ")
+_length = struct.Struct(b">Q")
+
+# Size of the pieces in which files are read for hashing and verified copying.
+_CHUNK_SIZE = 1 << 20
+
+def _digest(filename):
+	# Returns the BLAKE2b-128 digest of the file called filename.
+	h = hashlib.blake2b(digest_size=16)
+	with open(filename, "rb") as f:
+		while True:
+			data = f.read(_CHUNK_SIZE)
+			if not data:
+				return h.digest()
+			h.update(data)
+
+def _regions(reader, file_size):
+	# Returns the parts of the file opened by reader, of size file_size, in order, as
+	# a list of (offset, size, is_block): each key and record block, and the data
+	# between and after them.
+	blocks = sorted((b.offset, b.comp_size) for b in list(reader.key_blocks) + list(reader.record_blocks))
+	regions = []
+	pos = 0
+	for offset, size in blocks:
+		if offset > pos:
+			regions.append((pos, offset - pos, False))
+		regions.append((offset, size, True))
+		pos = offset + size
+	if file_size > pos:
+		regions.append((pos, file_size - pos, False))
+	return regions
+
+def _block_hash(data):
+	return hashlib.blake2b(data, digest_size=16).digest()
+
+def make_patch(old, new, patchfile, encrypt_key=None):
+	"""
+	Writes a patch that turns the mdx or mdd file old into new to patchfile.
+
+	old and new are file names. patchfile is a file-like object, opened in binary mode.
+
+	encrypt_key is the dictionary key of the files, if they are encrypted.
+
+	Returns a dictionary with the number of bytes of the new file that are copied
+	from the old one ("copied"), and that are contained in the patch ("added").
+	"""
+	with MDictReader(old, encrypt_key=encrypt_key) as old_reader:
+		old_blocks = {}
+		for offset, size, is_block in _regions(old_reader, os.path.getsize(old)):
+			if is_block:
+				old_blocks.setdefault(_block_hash(old_reader._read(offset, size)), offset)
+	patchfile.write(_header.pack(MAGIC, os.path.getsize(old), _digest(old),
+	    os.path.getsize(new), _digest(new)))
+	stats = {"copied": 0, "added": 0}
+	# The copy operation being built, as [offset, length], to merge copies of
+	# adjacent ranges.
+	copy = None
+	with MDictReader(new, encrypt_key=encrypt_key) as new_reader:
+		for offset, size, is_block in _regions(new_reader, os.path.getsize(new)):
+			data = new_reader._read(offset, size)
+			old_offset = old_blocks.get(_block_hash(data)) if is_block else None
+			if old_offset is not None:
+				stats["copied"] += size
+				if copy is not None and copy[0] + copy[1] == old_offset:
+					copy[1] += size
+					continue
+				if copy is not None:
+					patchfile.write(b"C" + _copy.pack(*copy))
+				copy = [old_offset, size]
+			else:
+				stats["added"] += size
+				if copy is not None:
+					patchfile.write(b"C" + _copy.pack(*copy))
+					copy = None
+				patchfile.write(b"D" + _length.pack(size) + data)
+	if copy is not None:
+		patchfile.write(b"C" + _copy.pack(*copy))
+	patchfile.write(b"E")
+	return stats
+
+def _read_exactly(f, size):
+	data = f.read(size)
+	if len(data) != size:
+		raise ParameterError("Truncated patch")
+	return data
+
+def apply_patch(old, patchfile, outfile, verify=True):
+	"""
+	Applies a patch written by make_patch() to the mdx or mdd file old, and writes
+	the new file to outfile.
+
+	old is a file name. patchfile and outfile are file-like objects, opened in
+	binary mode; outfile must be a real file, for copying from old.
+
+	If verify is true, old is checked to be the file the patch was made for, and
+	the result to be identical to the new file, by their digests; the data copied
+	from old then passes through Python. Otherwise, it is copied by the operating
+	system where possible. Raises ParameterError if the check fails.
+	"""
+	magic, old_size, old_digest, new_size, new_digest = _header.unpack(
+	    _read_exactly(patchfile, _header.size))
+	if magic != MAGIC:
+		raise ParameterError("Not a patch")
+	if os.path.getsize(old) != old_size or (verify and _digest(old) != old_digest):
+		raise ParameterError("The patch does not apply to {0}".format(old))
+	h = hashlib.blake2b(digest_size=16)
+	written = 0
+	with open(old, "rb") as src:
+		while True:
+			op = _read_exactly(patchfile, 1)
+			if op == b"E":
+				break
+			elif op == b"C":
+				offset, size = _copy.unpack(_read_exactly(patchfile, _copy.size))
+				if verify:
+					src.seek(offset)
+					remaining = size
+					while remaining > 0:
+						data = _read_exactly(src, min(remaining, _CHUNK_SIZE))
+						h.update(data)
+						outfile.write(data)
+						remaining -= len(data)
+				else:
+					_copy_range(src, outfile, offset, size)
+			elif op == b"D":
+				size = _length.unpack(_read_exactly(patchfile, _length.size))[0]
+				data = _read_exactly(patchfile, size)
+				if verify:
+					h.update(data)
+				outfile.write(data)
+			else:
+				raise ParameterError("Bad patch operation {0!r}".format(op))
+			written += size
+	if written != new_size or (verify and h.digest() != new_digest):
+		raise ParameterError("The patched file does not match the new file")
+
+if __name__ == "__main__":
+	if len(sys.argv) != 5 or sys.argv[1] not in ("diff", "apply"):
+		sys.stderr.write("Usage: python patchmdict.py diff OLD NEW PATCH\n"
+		                 "       python patchmdict.py apply OLD PATCH NEW\n")
+		sys.exit(2)
+	if sys.argv[1] == "diff":
+		with open(sys.argv[4], "wb") as patch:
+			stats = make_patch(sys.argv[2], sys.argv[3], patch)
+		sys.stdout.write("{0} bytes copied, {1} bytes added\n".format(stats["copied"], stats["added"]))
+	else:
+		with open(sys.argv[3], "rb") as patch, open(sys.argv[4], "wb") as outfile:
+			apply_patch(sys.argv[2], patch, outfile)
@@ -0,0 +1,164 @@
+"""
+prefixindex.py - a compact index of the keys of an mdx or mdd file, for autocompletion.
+
+Finding all keys starting with a given prefix by scanning the key blocks of an mdx
+file means decompressing them. Instead, MDictWriter can write the sorted keys to a
+separate file, in a compact form that can be searched through an mmap:
+
+    writer = MDictWriter(dictionary, "Example", "With prefix index")
+    writer.write(open("dictionary.mdx", "wb"))
+    writer.write_prefix_index(open("dictionary.pfx", "wb"))
+
+    from prefixindex import PrefixIndex
+    index = PrefixIndex("dictionary.pfx")
+    index.complete("do", 10)   # e.g. [("doe", 0), ("dog", 1), ...]
+
+complete() returns the first keys (in the sorted order of the dictionary) starting
+with the prefix, together with their entry numbers.
+
+The keys are front coded: they are stored in buckets of bucket_size consecutive keys,
+where the first key of each bucket is stored in full, and each following key only as
+the length of the prefix it shares with the previous key, and the rest of it. A
+lookup binary searches the first keys of the buckets, and then decodes at most a few
+buckets, so it costs a handful of page accesses. The keys are stored in UTF-8, in
+which the byte order is the same as the order of the (unicode) keys.
+
+File layout (integers are big-endian, unless they are varints):
+
+    magic            8 bytes  b"MDXPFX\\x00\\x01"
+    num_keys         8 bytes
+    bucket_size      4 bytes
+    num_buckets      4 bytes
+    bucket_offsets   8 bytes * num_buckets: position of each bucket in the file
+    buckets          for each bucket, for each key in it: varint shared prefix length
+                     (0 for the first key), varint suffix length, suffix
+"""
+
+from __future__ import unicode_literals
+
+import mmap, struct
+
+from fulltext import _write_varint
+
+MAGIC = b"MDXPFX\x00\x01"
+
+def _read_varint(data, pos):
+	# Returns (value, position after it) for the varint at pos in data, as written
+	# by fulltext._write_varint.
+	n = 0
+	shift = 0
+	while True:
+		b = bytearray(data[pos:pos+1])[0]
+		pos += 1
+		n |= (b & 0x7f) << shift
+		if not b & 0x80:
+			return n, pos
+		shift += 7
+
+def _common_prefix_length(a, b):
+	n = min(len(a), len(b))
+	i = 0
+	while i < n and a[i:i+1] == b[i:i+1]:
+		i += 1
+	return i
+
+def _write_prefix_index(outfile, keys, bucket_size=16):
+	# Writes a prefix index of keys, a sorted list of UTF-8 encoded keys, to outfile.
+	buckets = []
+	for start in range(0, len(keys), bucket_size):
+		data = bytearray()
+		previous = b""
+		for key in keys[start:start+bucket_size]:
+			shared = _common_prefix_length(previous, key) if data else 0
+			_write_varint(data, shared)
+			_write_varint(data, len(key) - shared)
+			data += key[shared:]
+			previous = key
+		buckets.append(bytes(data))
+	pos = 24 + 8 * len(buckets)
+	offsets = []
+	for b in buckets:
+		offsets.append(pos)
+		pos += len(b)
+	outfile.write(MAGIC)
+	outfile.write(struct.pack(b">QLL", len(keys), bucket_size, len(buckets)))
+	outfile.write(struct.pack(str(">{0}Q".format(len(offsets))), *offsets))
+	for b in buckets:
+		outfile.write(b)
+
+class PrefixIndex(object):
+
+	def __init__(self, filename):
+		"""
+		Opens a prefix index written by MDictWriter.write_prefix_index().
+		"""
+		f = open(filename, "rb")
+		try:
+			self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		if self._data[0:8] != MAGIC:
+			self.close()
+			raise ValueError("Not a prefix index")
+		self.num_keys, self._bucket_size, self._num_buckets = struct.unpack_from(
+		    b">QLL", self._data, 8)
+
+	def close(self):
+		self._data.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _bucket_offset(self, i):
+		return struct.unpack_from(b">Q", self._data, 24 + 8 * i)[0]
+
+	def _first_key(self, i):
+		# Returns the first key of bucket i.
+		pos = self._bucket_offset(i)
+		shared, pos = _read_varint(self._data, pos)
+		length, pos = _read_varint(self._data, pos)
+		return self._data[pos:pos+length]
+
+	def _keys_from(self, bucket):
+		# Yields the keys from the start of bucket i onwards, as pairs (key, entry number).
+		entry = bucket * self._bucket_size
+		pos = self._bucket_offset(bucket) if bucket < self._num_buckets else len(self._data)
+		key = b""
+		while entry < self.num_keys:
+			shared, pos = _read_varint(self._data, pos)
+			length, pos = _read_varint(self._data, pos)
+			key = key[:shared] + self._data[pos:pos+length]
+			pos += length
+			yield key, entry
+			entry += 1
+
+	def complete(self, prefix, n=10):
+		"""
+		Returns up to n keys starting with prefix, a (unicode) string, as a list of
+		pairs (key, entry number), in key order.
+		"""
+		prefix = prefix.encode("utf_8")
+		# Find the last bucket whose first key is less than prefix; keys starting
+		# with prefix can only begin there or later.
+		lo, hi = 0, self._num_buckets
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._first_key(mid) < prefix:
+				lo = mid + 1
+			else:
+				hi = mid
+		bucket = max(lo - 1, 0)
+		results = []
+		if n <= 0:
+			return results
+		for key, entry in self._keys_from(bucket):
+			if key.startswith(prefix):
+				results.append((key.decode("utf_8"), entry))
+				if len(results) >= n:
+					break
+			elif key > prefix:
+				break
+		return results
@@ -0,0 +1,563 @@
+"""
+readmdict.py - reads the structure of dictionary files in the MDict file format.
+
+This reads files as written by writemdict.py (see fileformat.md for a description of
+the format). An MDictReader parses the header and the two block indexes when it is
+opened. The blocks themselves are only read when they are asked for.
+
+Usage example:
+
+    from readmdict import MDictReader
+
+    reader = MDictReader("dictionary.mdx")
+    print(reader.header["Title"])
+    for block in reader.record_blocks:
+        data = reader.decompress_block(block)
+    reader.close()
+
+  If the dictionary is encrypted (the encrypt_key parameter of MDictWriter), the
+  same dictionary key must be given as MDictReader("dictionary.mdx", encrypt_key=b"...").
+
+Records can be looked up by key:
+
+    records = reader.lookup("doe")
+
+  returns a list of the records for "doe" (usually of length 0 or 1): (unicode)
+  strings for an mdx file, and bytes objects for an mdd file.
+
+Files are read with os.pread() where available (and through an mmap otherwise),
+so an MDictReader never depends on a shared file position.
+"""
+
+from __future__ import unicode_literals
+
+import struct, zlib, re, os, mmap, bisect
+
+from writemdict import ParameterError, _salsa_encrypt, _ripemd128, _lzo
+from stylesheet import parse_stylesheet, expand_styles
+
+class FormatError(Exception):
+	# Raised when a file is not a valid MDict file. message is the description of
+	# the problem, and offset is the position in the file where it was found, or
+	# None if unknown.
+	def __init__(self, message, offset=None):
+		if offset is None:
+			Exception.__init__(self, message)
+		else:
+			Exception.__init__(self, "{0} (at offset {1})".format(message, offset))
+		self.message = message
+		self.offset = offset
+
+def _mdx_decompress(comp_block, decomp_size=None, check=True):
+	# Inverse of writemdict._mdx_compress.
+	#
+	# decomp_size is the expected decompressed size, as found in the block index.
+	# It is required for LZO compression. If check is true, the size and the
+	# ADLER32 checksum of the result are verified, and ValueError is raised if
+	# they do not match.
+	if len(comp_block) < 8:
+		raise ValueError("Block too short")
+	compression_type = struct.unpack(b"<L", comp_block[0:4])[0]
+	checksum = struct.unpack(b">L", comp_block[4:8])[0]
+	data = comp_block[8:]
+	if compression_type == 0:
+		pass
+	elif compression_type == 2:
+		try:
+			data = zlib.decompress(data)
+		except zlib.error as e:
+			raise ValueError("zlib error: {0}".format(e))
+	elif compression_type == 1:
+		lzo = _lzo()
+		if lzo is None:
+			raise NotImplementedError()
+		if decomp_size is None:
+			raise ValueError("Decompressed size needed for LZO")
+		try:
+			data = lzo.decompress(b"\xf0" + struct.pack(b">L", decomp_size) + data)
+		except lzo.error as e:
+			raise ValueError("lzo error: {0}".format(e))
+	else:
+		raise ValueError("Unknown compression type {0}".format(compression_type))
+	if check:
+		if decomp_size is not None and len(data) != decomp_size:
+			raise ValueError("Decompressed size is {0}, expected {1}".format(len(data), decomp_size))
+		if zlib.adler32(data) & 0xffffffff != checksum:
+			raise ValueError("Checksum mismatch")
+	return bytes(data)
+
+def _fast_decrypt(data, key):
+	# Inverse of writemdict._fast_encrypt.
+	b = bytearray(data)
+	key = bytearray(key)
+	previous = 0x36
+	for i in range(len(b)):
+		t = ((b[i]>>4)|(b[i]<<4)) & 0xff
+		t = t ^ previous ^ (i&0xff) ^ key[i%len(key)]
+		previous = b[i]
+		b[i] = t
+	return bytes(b)
+
+def _mdx_decrypt(comp_block):
+	# Inverse of writemdict._mdx_encrypt.
+	key = _ripemd128(comp_block[4:8] + struct.pack(b"<L", 0x3695))
+	return comp_block[0:8] + _fast_decrypt(comp_block[8:], key)
+
+def _parse_key_block(data, version, encoding_length):
+	# Parses a decompressed key block.
+	#
+	# Returns a list of pairs (offset, key), where key is the encoded key, without
+	# the null terminator.
+	if version == "2.0":
+		offset_format = struct.Struct(b">Q")
+	else:
+		offset_format = struct.Struct(b">L")
+	null = b"\0" * encoding_length
+	entries = []
+	pos = 0
+	while pos < len(data):
+		offset = offset_format.unpack_from(data, pos)[0]
+		pos += offset_format.size
+		end = data.find(null, pos)
+		while end != -1 and (end - pos) % encoding_length != 0:
+			end = data.find(null, end + 1)
+		if end == -1:
+			raise ValueError("Unterminated key")
+		entries.append((offset, data[pos:end]))
+		pos = end + encoding_length
+	return entries
+
+_header_attribute = re.compile(r'(\w+)="(.*?)"', re.DOTALL)
+
+def _unescape(s):
+	# Inverse of the escaping applied to header attributes by writemdict.
+	return (s.replace("&lt;", "<").replace("&gt;", ">")
+	         .replace("&quot;", '"').replace("&#x27;", "'").replace("&amp;", "&"))
+
+_python_encodings = {
+	"UTF-8": ("utf_8", 1),
+	"UTF-16": ("utf_16_le", 2),
+	"GBK": ("gbk", 1),
+	"BIG5": ("big5", 1),
+}
+
+class BlockInfo(object):
+	# Describes one key block or record block, as given by the key block index or
+	# the record block index.
+	#
+	#  offset: position of the (compressed) block in the file
+	#  comp_size: size of the block in the file
+	#  decomp_size: size of the block after decompression
+	#
+	# For key blocks:
+	#  num_entries: number of keys in the block
+	#  first_entry: number of keys in all preceding key blocks
+	#  first_key, last_key: first and last key in the block, encoded, without null terminator
+	#
+	# For record blocks:
+	#  decomp_offset: total decompressed size of all preceding record blocks, i.e. the
+	#    offset (as stored in the key blocks) of the first record in this block.
+	def __init__(self, offset, comp_size, decomp_size, num_entries=None, first_entry=None,
+	             first_key=None, last_key=None, decomp_offset=None):
+		self.offset = offset
+		self.comp_size = comp_size
+		self.decomp_size = decomp_size
+		self.num_entries = num_entries
+		self.first_entry = first_entry
+		self.first_key = first_key
+		self.last_key = last_key
+		self.decomp_offset = decomp_offset
+
+class MDictReader(object):
+
+	def __init__(self, f, encrypt_key=None, cache=None, bloom_filter=None, index_cache=None):
+		"""
+		Opens an mdx or mdd file, and reads its header and block indexes.
+
+		f is either the name of the file, or a bytes-like object (such as a bytes
+		  object or an mmap) containing the whole file.
+
+		encrypt_key is the dictionary key, as given to MDictWriter. It is needed
+		  if and only if the file was written with encrypt_key set.
+
+		cache is None, or a blockcache.SharedBlockCache, in which decompressed blocks
+		  are looked up before decompressing them, and stored afterwards.
+
+		bloom_filter is None, or a bloomfilter.BloomFilter of the keys of the file,
+		  which lookup() uses to answer most lookups of missing keys without reading
+		  the file.
+
+		index_cache is None, or the name of a file in which the parsed block indexes
+		  are cached, so that later opens of f need not parse them again (see
+		  indexcache.py). f must then be a file name.
+
+		Raises FormatError if the file could not be parsed.
+		"""
+		self._encrypt_key = encrypt_key
+		self._fd = None
+		self._mmap = None
+		self._key_ranges = None
+		self._cache = cache
+		self._bloom_filter = bloom_filter
+		self._index_cache = None
+		if isinstance(f, (bytes, bytearray, memoryview, mmap.mmap)):
+			self.filename = None
+			self._buffer = f
+		else:
+			self.filename = f
+			self._fd = os.open(f, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+			if hasattr(os, "pread"):
+				self._buffer = None
+			else:
+				self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+				self._buffer = self._mmap
+		try:
+			if cache is not None:
+				from blockcache import file_id
+				if self.filename is not None:
+					self._file_id = file_id(filename=f)
+				else:
+					self._file_id = file_id(data=f)
+			self._read_header()
+			if index_cache is not None:
+				if self.filename is None:
+					raise ParameterError("index_cache requires f to be a file name")
+				from indexcache import load_index_cache, write_index_cache
+				if not load_index_cache(self, index_cache):
+					self._read_key_sect()
+					self._read_record_sect()
+					write_index_cache(self, index_cache)
+			else:
+				self._read_key_sect()
+				self._read_record_sect()
+		except:
+			self.close()
+			raise
+
+	def close(self):
+		if self._index_cache is not None:
+			self._index_cache.close()
+			self._index_cache = None
+		if self._mmap is not None:
+			self._mmap.close()
+			self._mmap = None
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _read(self, offset, size):
+		# Returns size bytes from the file, starting at offset.
+		if self._buffer is not None:
+			data = bytes(self._buffer[offset:offset+size])
+		else:
+			data = os.pread(self._fd, size, offset)
+		if len(data) != size:
+			raise FormatError("Unexpected end of file", offset)
+		return data
+
+	def _read_header(self):
+		# Sets self.header to a dictionary of the attributes in the header, as well as
+		# self.version, self.is_mdd, self.encoding, and the encryption flags.
+		header_len = struct.unpack(b">L", self._read(0, 4))[0]
+		self._header_string = self._read(4, header_len)
+		self.header_checksum = struct.unpack(b"<L", self._read(4 + header_len, 4))[0]
+		self._key_sect_offset = 4 + header_len + 4
+		try:
+			header_text = self._header_string.decode("utf_16_le")
+		except UnicodeDecodeError:
+			raise FormatError("Header is not valid UTF-16", 4)
+		if header_text.startswith("<Dictionary "):
+			self.is_mdd = False
+		elif header_text.startswith("<Library_Data "):
+			self.is_mdd = True
+		else:
+			raise FormatError("Unknown header tag", 4)
+		self.header = dict(
+		    (name, _unescape(value)) for name, value in _header_attribute.findall(header_text))
+
+		self.version = self.header.get("GeneratedByEngineVersion")
+		if self.version not in ["2.0", "1.2"]:
+			raise FormatError("Unknown version {0}".format(self.version), 4)
+		encrypted = int(self.header.get("Encrypted") or 0)
+		self._encrypt = bool(encrypted & 1)
+		self._encrypt_index = bool(encrypted & 2)
+		if self._encrypt and self._encrypt_key is None:
+			raise ParameterError("The file is encrypted, encrypt_key must be specified")
+		if self.is_mdd:
+			self.encoding = "utf_16_le"
+			self._encoding_length = 2
+		else:
+			try:
+				self.encoding, self._encoding_length = _python_encodings[
+				    self.header.get("Encoding", "UTF-8").upper()]
+			except KeyError:
+				raise FormatError("Unknown encoding", 4)
+		# The styles of the compact format (see stylesheet.py), which are expanded in
+		# the records, or None.
+		self.stylesheet = None
+		if (not self.is_mdd and self.header.get("StyleSheet")
+		    and "Yes" in (self.header.get("Compact"), self.header.get("Compat"))):
+			self.stylesheet = parse_stylesheet(self.header["StyleSheet"])
+
+	def _read_key_sect(self):
+		# Reads the key section header and the key block index.
+		#
+		# Sets self.num_entries and self.key_blocks, a list of BlockInfo objects.
+		pos = self._key_sect_offset
+		if self.version == "2.0":
+			preamble = self._read(pos, 40)
+			if self._encrypt:
+				preamble = _salsa_encrypt(preamble, self._encrypt_key)
+			self.preamble_checksum = struct.unpack(b">L", self._read(pos + 40, 4))[0]
+			self._preamble = preamble
+			(num_blocks, self.num_entries, keyb_index_decomp_size,
+			 keyb_index_comp_size, keyblocks_total_size) = struct.unpack(b">QQQQQ", preamble)
+			pos += 44
+			self._keyb_index_offset = pos
+			keyb_index = self._read(pos, keyb_index_comp_size)
+			if self._encrypt_index:
+				keyb_index = _mdx_decrypt(keyb_index)
+			try:
+				decomp_data = _mdx_decompress(keyb_index, keyb_index_decomp_size)
+			except ValueError as e:
+				raise FormatError("Bad key block index: {0}".format(e), pos)
+			pos += keyb_index_comp_size
+			long_format = struct.Struct(b">Q")
+			short_format = struct.Struct(b">H")
+			sizes_format = struct.Struct(b">QQ")
+			null_len = self._encoding_length
+		else:
+			preamble = self._read(pos, 16)
+			if self._encrypt:
+				preamble = _salsa_encrypt(preamble, self._encrypt_key)
+			self.preamble_checksum = None
+			self._preamble = preamble
+			(num_blocks, self.num_entries, keyb_index_decomp_size,
+			 keyblocks_total_size) = struct.unpack(b">LLLL", preamble)
+			keyb_index_comp_size = keyb_index_decomp_size
+			pos += 16
+			self._keyb_index_offset = pos
+			decomp_data = self._read(pos, keyb_index_decomp_size)
+			pos += keyb_index_decomp_size
+			long_format = struct.Struct(b">L")
+			short_format = struct.Struct(b">B")
+			sizes_format = struct.Struct(b">LL")
+			null_len = 0
+		self._keyb_index_comp_size = keyb_index_comp_size
+		self._keyb_index_decomp_size = keyb_index_decomp_size
+		self._keyblocks_total_size = keyblocks_total_size
+
+		self.key_blocks = []
+		index_pos = 0
+		block_offset = pos
+		first_entry = 0
+		try:
+			for i in range(num_blocks):
+				num_entries = long_format.unpack_from(decomp_data, index_pos)[0]
+				index_pos += long_format.size
+				keys = []
+				for j in range(2):
+					key_len = short_format.unpack_from(decomp_data, index_pos)[0] * self._encoding_length
+					index_pos += short_format.size
+					keys.append(decomp_data[index_pos:index_pos+key_len])
+					index_pos += key_len + null_len
+				comp_size, decomp_size = sizes_format.unpack_from(decomp_data, index_pos)
+				index_pos += sizes_format.size
+				self.key_blocks.append(BlockInfo(
+				    offset=block_offset,
+				    comp_size=comp_size,
+				    decomp_size=decomp_size,
+				    num_entries=num_entries,
+				    first_entry=first_entry,
+				    first_key=keys[0],
+				    last_key=keys[1]))
+				block_offset += comp_size
+				first_entry += num_entries
+		except struct.error:
+			raise FormatError("Truncated key block index", self._keyb_index_offset)
+		if index_pos != len(decomp_data):
+			raise FormatError("Trailing data in key block index", self._keyb_index_offset)
+		if block_offset - pos != keyblocks_total_size:
+			raise FormatError("Key block sizes do not add up", pos)
+		if first_entry != self.num_entries:
+			raise FormatError("Key block entry counts do not add up", self._keyb_index_offset)
+		self._record_sect_offset = block_offset
+
+	def _read_record_sect(self):
+		# Reads the record section header and the record block index.
+		#
+		# Sets self.record_blocks, a list of BlockInfo objects.
+		pos = self._record_sect_offset
+		if self.version == "2.0":
+			format = b">QQQQ"
+			pair_format = b">QQ"
+		else:
+			format = b">LLLL"
+			pair_format = b">LL"
+		size = struct.calcsize(format)
+		num_blocks, num_entries, index_len, blocks_len = struct.unpack(format, self._read(pos, size))
+		if num_entries != self.num_entries:
+			raise FormatError("Number of records does not match number of keys", pos)
+		pos += size
+		self._recordb_index_offset = pos
+		if index_len != num_blocks * struct.calcsize(pair_format):
+			raise FormatError("Wrong size of record block index", pos)
+		recordb_index = self._read(pos, index_len)
+		pos += index_len
+		self.record_blocks = []
+		decomp_offset = 0
+		block_offset = pos
+		for i in range(num_blocks):
+			comp_size, decomp_size = struct.unpack_from(
+			    pair_format, recordb_index, i * struct.calcsize(pair_format))
+			self.record_blocks.append(BlockInfo(
+			    offset=block_offset,
+			    comp_size=comp_size,
+			    decomp_size=decomp_size,
+			    decomp_offset=decomp_offset))
+			block_offset += comp_size
+			decomp_offset += decomp_size
+		if block_offset - pos != blocks_len:
+			raise FormatError("Record block sizes do not add up", pos)
+		self._recordblocks_total_size = blocks_len
+		self._record_offsets = [b.decomp_offset for b in self.record_blocks]
+		self.total_record_len = decomp_offset
+		self.file_size = block_offset
+
+	def read_block(self, block):
+		"""
+		Returns the compressed data of block (a BlockInfo from key_blocks or
+		record_blocks), as stored in the file.
+		"""
+		return self._read(block.offset, block.comp_size)
+
+	def decompress_block(self, block):
+		"""
+		Returns the decompressed data of block (a BlockInfo from key_blocks or
+		record_blocks).
+
+		Raises FormatError if the block is corrupt.
+		"""
+		if self._cache is not None:
+			data = self._cache.get(self._file_id, block.offset)
+			if data is not None:
+				return data
+		try:
+			data = _mdx_decompress(self.read_block(block), block.decomp_size)
+		except ValueError as e:
+			raise FormatError("Bad block: {0}".format(e), block.offset)
+		if self._cache is not None:
+			self._cache.put(self._file_id, block.offset, data)
+		return data
+
+	def key_block_entries(self, block):
+		"""
+		Returns the entries of a key block (a BlockInfo from key_blocks), as a list of
+		pairs (offset, key). key is the encoded key, and offset is the position of the
+		corresponding record among the decompressed records.
+		"""
+		try:
+			return _parse_key_block(
+			    self.decompress_block(block), self.version, self._encoding_length)
+		except ValueError as e:
+			raise FormatError("Bad key block: {0}".format(e), block.offset)
+
+	def key_blocks_for(self, key):
+		"""
+		Returns the indices (into key_blocks) of the key blocks that may contain key,
+		a (unicode) string, as a range.
+		"""
+		if self._key_ranges is None:
+			# The keys are sorted as (unicode) strings, which is not the same as the
+			# order of the encoded keys for all encodings.
+			self._key_ranges = (
+			    [b.first_key.decode(self.encoding) for b in self.key_blocks],
+			    [b.last_key.decode(self.encoding) for b in self.key_blocks])
+		first_keys, last_keys = self._key_ranges
+		return range(bisect.bisect_left(last_keys, key), bisect.bisect_right(first_keys, key))
+
+	def record_block_for(self, offset):
+		"""
+		Returns the index (into record_blocks) of the record block containing the record
+		at offset, as stored in the key blocks.
+		"""
+		return bisect.bisect_right(self._record_offsets, offset) - 1
+
+	def lookup(self, key):
+		"""
+		Returns a list of all records for key, a (unicode) string. For an mdx file the
+		records are (unicode) strings, and for an mdd file they are bytes objects.
+		"""
+		try:
+			key_enc = key.encode(self.encoding)
+		except UnicodeEncodeError:
+			return [] # not a key of a dictionary in this encoding
+		if self._bloom_filter is not None and not self._bloom_filter.might_contain(key):
+			return []
+		records = []
+		for i in self.key_blocks_for(key):
+			entries = self.key_block_entries(self.key_blocks[i])
+			for j, (offset, entry_key) in enumerate(entries):
+				if entry_key != key_enc:
+					continue
+				end = self._record_end(i, entries, j)
+				if end is None:
+					end = self.key_block_entries(self.key_blocks[i+1])[0][0]
+				block_index = self.record_block_for(offset)
+				data = self.decompress_block(self.record_blocks[block_index])
+				records.append(self._record_from_block(block_index, data, offset, end))
+		return records
+
+	def _record_end(self, i, entries, j):
+		# Returns the offset where the record of entry j of key block i ends, if it can
+		# be told from entries (the entries of that key block). Otherwise returns None.
+		#
+		# For an mdx file, -1 may be returned, meaning that the record ends at its
+		# null terminator. None means that the record ends at the first record of
+		# key block i+1.
+		if j + 1 < len(entries):
+			return entries[j+1][0]
+		elif i + 1 == len(self.key_blocks):
+			return self.total_record_len
+		elif not self.is_mdd:
+			return -1
+		else:
+			return None
+
+	def _record_from_block(self, block_index, data, offset, end):
+		# Returns the record from offset to end, given the decompressed data of the
+		# record block with index block_index, which contains it. end is as returned
+		# by _record_end().
+		block = self.record_blocks[block_index]
+		start = offset - block.decomp_offset
+		if end == -1:
+			null = b"\0" * self._encoding_length
+			stop = data.find(null, start)
+			while stop != -1 and (stop - start) % self._encoding_length != 0:
+				stop = data.find(null, stop + 1)
+			if stop == -1:
+				raise FormatError("Unterminated record", block.offset)
+		else:
+			stop = end - block.decomp_offset
+			if stop > len(data):
+				raise FormatError("Record extends beyond its record block", block.offset)
+		record = data[start:stop]
+		if self.is_mdd:
+			return record
+		record = record.decode(self.encoding)
+		if record.endswith("\0"):
+			record = record[:-1]
+		return self._expand_styles(record)
+
+	def _expand_styles(self, record):
+		# Returns record, with the styles of the compact format expanded, if the
+		# file uses them.
+		if self.stylesheet is None:
+			return record
+		return expand_styles(record, self.stylesheet)
@@ -0,0 +1,167 @@
+"""
+scanmdict.py - reads all entries of an mdx or mdd file in order, decompressing on several processes.
+
+Exporting, reindexing or checking a dictionary needs every (key, record) pair, in
+key order. scan_mdict() reads the key blocks in the calling process, and hands the
+record blocks to a pool of worker processes, which decompress them and cut out the
+records. A bounded number of record blocks is kept in flight ahead of the entry
+being yielded, so the memory used does not grow with the size of the file.
+
+Usage example:
+
+    from scanmdict import scan_mdict
+
+    for key, record in scan_mdict("dictionary.mdx"):
+        print(key, len(record))
+
+  For an mdx file, the records are (unicode) strings; for an mdd file, they are
+  bytes objects.
+
+benchmarks.py measures the throughput of scan_mdict() against a budget.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+
+from readmdict import MDictReader, FormatError, _mdx_decompress
+from stylesheet import expand_styles
+
+# The file opened by each worker process, see _init_worker().
+_worker_file = None
+
+def _init_worker(filename):
+	global _worker_file
+	_worker_file = open(filename, "rb")
+
+def _split_records(comp_block, block, spans, encoding, stylesheet=None):
+	# Decompresses a record block, and returns the list of records in it.
+	#
+	# block is (offset, decomp_size, decomp_offset) of the record block, and spans
+	# is a list of (start, end) offsets of the records, as in the key blocks.
+	# encoding is the encoding of the records for an mdx file, or None for an mdd
+	# file. stylesheet is the styles to expand in the records of a compact mdx
+	# file, or None.
+	offset, decomp_size, decomp_offset = block
+	try:
+		data = _mdx_decompress(comp_block, decomp_size)
+	except ValueError as e:
+		raise FormatError("Bad block: {0}".format(e), offset)
+	records = []
+	for start, end in spans:
+		if end - decomp_offset > len(data):
+			raise FormatError("Record extends beyond its record block", offset)
+		record = data[start-decomp_offset:end-decomp_offset]
+		if encoding is not None:
+			record = record.decode(encoding)
+			if record.endswith("\0"):
+				record = record[:-1]
+			if stylesheet is not None:
+				record = expand_styles(record, stylesheet)
+		records.append(record)
+	return records
+
+def _read_records(args):
+	# Worker function: reads a record block from _worker_file, and returns the
+	# records in it, as _split_records().
+	block, comp_size, spans, encoding, stylesheet = args
+	_worker_file.seek(block[0])
+	return _split_records(_worker_file.read(comp_size), block, spans, encoding, stylesheet)
+
+def _jobs(reader):
+	# Yields (keys, block index, spans) for each record block of reader in order,
+	# where keys are the (decoded) keys of the entries whose records start in that
+	# block, and spans the (start, end) offsets of these records.
+	#
+	# The end of a record is the start of the next one, which may be in the next
+	# key block.
+	def entries():
+		for block in reader.key_blocks:
+			for offset, key in reader.key_block_entries(block):
+				yield offset, key
+		yield reader.total_record_len, None
+
+	keys = []
+	spans = []
+	current = None
+	previous = None
+	for offset, key in entries():
+		if previous is not None:
+			start, previous_key = previous
+			block_index = reader.record_block_for(start)
+			if block_index != current and keys:
+				yield keys, current, spans
+				keys = []
+				spans = []
+			current = block_index
+			keys.append(previous_key.decode(reader.encoding))
+			spans.append((start, offset))
+		previous = (offset, key)
+	if keys:
+		yield keys, current, spans
+
+def scan_mdict(f, encrypt_key=None, processes=None, read_ahead=None):
+	"""
+	Returns an iterator over all entries of an mdx or mdd file, as pairs (key,
+	record), in the order in which they are stored (i.e. sorted by key).
+
+	f is either the name of the file, or a bytes-like object containing the whole
+	  file, as for MDictReader.
+
+	encrypt_key is the dictionary key, needed if the file was written with encrypt_key set.
+
+	processes is the number of worker processes decompressing record blocks. If
+	  None, the number of CPUs is used. If 1, or if f is not a file name, all blocks
+	  are decompressed in the calling process.
+
+	read_ahead is the maximal number of record blocks being decompressed, or
+	  decompressed and waiting to be yielded, at any time. If None, twice the
+	  number of processes is used.
+
+	Raises readmdict.FormatError if the file is damaged.
+	"""
+	reader = MDictReader(f, encrypt_key=encrypt_key)
+	try:
+		encoding = None if reader.is_mdd else reader.encoding
+		if processes is None:
+			from verifymdict import _cpu_count
+			processes = _cpu_count()
+		if reader.filename is None or processes <= 1:
+			for keys, i, spans in _jobs(reader):
+				block = reader.record_blocks[i]
+				records = _split_records(reader.read_block(block),
+				    (block.offset, block.decomp_size, block.decomp_offset), spans, encoding,
+				    reader.stylesheet)
+				for entry in zip(keys, records):
+					yield entry
+			return
+
+		import multiprocessing
+		if read_ahead is None:
+			read_ahead = 2 * processes
+		pool = multiprocessing.Pool(processes, _init_worker, (reader.filename,))
+		pending = collections.deque()
+		try:
+			for keys, i, spans in _jobs(reader):
+				block = reader.record_blocks[i]
+				args = ((block.offset, block.decomp_size, block.decomp_offset),
+				        block.comp_size, spans, encoding, reader.stylesheet)
+				pending.append((keys, pool.apply_async(_read_records, (args,))))
+				while len(pending) >= read_ahead:
+					keys, result = pending.popleft()
+					for entry in zip(keys, result.get()):
+						yield entry
+			while pending:
+				keys, result = pending.popleft()
+				for entry in zip(keys, result.get()):
+					yield entry
+		finally:
+			# If the iterator was closed early, let the blocks in flight finish
+			# rather than calling pool.terminate(), which can deadlock while
+			# tasks are still being handed to the workers.
+			for keys, result in pending:
+				result.wait()
+			pool.close()
+			pool.join()
+	finally:
+		reader.close()
@@ -0,0 +1,189 @@
+"""
+shardmdict.py - splits one dictionary into several independent mdx (or mdd) files by key range.
+
+Each shard is a complete dictionary file of its own, covering a contiguous range
+of keys, and is built by an MDictWriter in a separate process. A manifest (a JSON
+file) lists the key range of each shard, so that lookups can be routed to the
+right file.
+
+Usage example:
+
+    from shardmdict import shard_mdict, load_manifest, find_shard
+
+    # One file per initial letter:
+    shard_mdict(dictionary, "dictionary-{0:02d}.mdx", "Example", "Sharded by letter",
+                boundaries=["b", "c", "d", ...], manifest="dictionary.json")
+
+    # Or files of about 50 MB of (uncompressed) entries each:
+    shard_mdict(dictionary, "dictionary-{0:02d}.mdx", "Example", "Sharded by size",
+                shard_size=50*1024*1024, manifest="dictionary.json")
+
+    manifest = load_manifest("dictionary.json")
+    print(find_shard(manifest, "doe")["filename"])
+
+The manifest has the form
+
+    {"shards": [{"filename": ..., "lower": ..., "upper": ...,
+                 "first_key": ..., "last_key": ..., "num_entries": ...}, ...]}
+
+where a shard holds the keys k with lower <= k < upper (lower is null for the first
+shard, and upper is null for the last one), and first_key and last_key are the
+keys actually present.
+"""
+
+from __future__ import unicode_literals
+
+import bisect, collections, io, json, operator
+
+from writemdict import MDictWriter, ParameterError
+
+def _partition(items, boundaries, shard_size):
+	# Splits the sorted (key, record) pairs in items into consecutive lists.
+	#
+	# Yields (lower, upper, entries) for each non-empty part, where lower and upper
+	# are as in the manifest.
+	boundaries = list(boundaries or [])
+	lower = None
+	entries = []
+	size = 0
+	for key, record in items:
+		upper = None
+		# A new shard starts when key passes the next boundary...
+		while boundaries and key >= boundaries[0]:
+			upper = boundaries.pop(0)
+		# ...or when the current shard has reached the target size.
+		if upper is None and shard_size is not None and size >= shard_size:
+			if key != entries[-1][0]:
+				upper = key
+		if upper is not None and entries:
+			yield lower, upper, entries
+			entries = []
+			size = 0
+		if upper is not None:
+			lower = upper
+		entries.append((key, record))
+		size += len(key) + len(record)
+	if entries:
+		yield lower, None, entries
+
+def _build_shard(args):
+	# Worker function: builds one shard, and returns its manifest entry.
+	filename, entries, title, description, kwargs = args
+	writer = MDictWriter(entries, title, description, **kwargs)
+	outfile = open(filename, "wb")
+	try:
+		writer.write(outfile)
+	finally:
+		outfile.close()
+	return {
+		"filename": filename,
+		"first_key": entries[0][0],
+		"last_key": entries[-1][0],
+		"num_entries": len(entries),
+	}
+
+def shard_mdict(d, filename_pattern, title, description,
+                boundaries=None,
+                shard_size=None,
+                manifest=None,
+                processes=None,
+                **kwargs):
+	"""
+	Writes the entries of d to several dictionary files, split by key range.
+
+	d is a dictionary, or a sorted iterable of (key, value) pairs, as for MDictWriter.
+
+	filename_pattern is a format string for the names of the shards, e.g.
+	  "dictionary-{0:02d}.mdx". It is formatted with the number of the shard (from 0).
+
+	title and description are used for all shards. Any other keyword arguments
+	  (e.g. encoding, compression_type, is_mdd) are passed on to MDictWriter.
+
+	Exactly one of boundaries and shard_size should be specified:
+
+	boundaries is a sorted list of keys at which a new shard starts. (Empty shards
+	  are skipped.)
+
+	shard_size is the approximate total length of the keys and values (in characters
+	  for mdx files, in bytes for mdd files) of each shard. Entries with equal keys are
+	  never split between shards.
+
+	manifest is the name of a file to write the manifest to (see above), or None.
+
+	processes is the number of shards built at the same time, each in its own process.
+	  If None, the number of CPUs is used. If 1, all shards are built in the calling
+	  process.
+
+	Returns the manifest, as a dictionary.
+	"""
+	if (boundaries is None) == (shard_size is None):
+		raise ParameterError("Expected exactly one of boundaries and shard_size")
+	if shard_size is not None and not shard_size > 0:
+		raise ParameterError("shard_size must be positive")
+	if hasattr(d, "items"):
+		items = sorted(d.items(), key=operator.itemgetter(0))
+	else:
+		items = d
+	ranges = []
+	def jobs():
+		# Yields the arguments of _build_shard for each shard, recording its key range.
+		for i, (lower, upper, entries) in enumerate(_partition(items, boundaries, shard_size)):
+			ranges.append((lower, upper))
+			yield (filename_pattern.format(i), entries, title, description, kwargs)
+
+	import multiprocessing
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	if processes <= 1:
+		shards = [_build_shard(job) for job in jobs()]
+	else:
+		pool = multiprocessing.Pool(processes)
+		# Only as many shards as there are processes are partitioned ahead, so that
+		# the entries of the other shards are not all held in memory at once.
+		pending = collections.deque()
+		shards = []
+		try:
+			for job in jobs():
+				pending.append(pool.apply_async(_build_shard, (job,)))
+				if len(pending) >= processes:
+					shards.append(pending.popleft().get())
+			while pending:
+				shards.append(pending.popleft().get())
+		finally:
+			# As in scanmdict.py, let the shards in flight finish rather than calling
+			# pool.terminate().
+			for result in pending:
+				result.wait()
+			pool.close()
+			pool.join()
+	for shard, (lower, upper) in zip(shards, ranges):
+		shard["lower"] = lower
+		shard["upper"] = upper
+
+	result = {"shards": shards}
+	if manifest is not None:
+		f = io.open(manifest, "w", encoding="utf_8")
+		try:
+			f.write(json.dumps(result, ensure_ascii=False, indent=1))
+		finally:
+			f.close()
+	return result
+
+def load_manifest(filename):
+	"""
+	Reads a manifest written by shard_mdict().
+	"""
+	f = io.open(filename, "r", encoding="utf_8")
+	try:
+		return json.load(f)
+	finally:
+		f.close()
+
+def find_shard(manifest, key):
+	"""
+	Returns the entry of manifest (as returned by shard_mdict() or load_manifest())
+	for the shard whose key range contains key.
+	"""
+	shards = manifest["shards"]
+	lowers = [s["lower"] for s in shards[1:]]
+	return shards[bisect.bisect_right(lowers, key)]
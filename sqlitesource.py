@@ -0,0 +1,136 @@
+"""
+sqlitesource.py - reads dictionary entries from an SQLite database, for use with MDictWriter.
+
+An SQLiteSource runs a single "ORDER BY key" query, and hands the rows to MDictWriter
+in batches of fetchmany(), in the order in which they will be written. This avoids
+first exporting the whole table into a Python dictionary, and then sorting it again.
+
+Usage example:
+
+    import sqlite3
+    from writemdict import MDictWriter
+    from sqlitesource import SQLiteSource
+
+    conn = sqlite3.connect("entries.db")
+    source = SQLiteSource(conn, "entries", key_column="headword", record_column="definition")
+    writer = MDictWriter(source, title="Example Dictionary", description="Read from SQLite.")
+    outfile = open("dictionary.mdx", "wb")
+    writer.write(outfile)
+    outfile.close()
+
+  For mdd files, pass incremental_blobs=True to read each record with the incremental
+  blob I/O of sqlite3 (Python 3.11 and later) when its record block is compressed,
+  instead of loading all the blobs up front:
+
+    source = SQLiteSource(conn, "resources", key_column="path", record_column="data",
+                          incremental_blobs=True)
+    writer = MDictWriter(source, title="Resources", description="", is_mdd=True)
+
+The keys are sorted using the BINARY collation. For a database with the default UTF-8
+encoding, this is the same order as the sorting of (unicode) strings in Python, which
+MDictWriter expects.
+"""
+
+from __future__ import unicode_literals
+
+from writemdict import ParameterError
+
+def _quote_identifier(name):
+	# Returns name quoted for use as an identifier in an SQL statement.
+	return '"' + name.replace('"', '""') + '"'
+
+class SQLiteSource(object):
+
+	def __init__(self, connection, table,
+	             key_column="key",
+	             record_column="record",
+	             batch_size=1000,
+	             incremental_blobs=False):
+		"""
+		Prepares to read the entries of a table in an SQLite database.
+
+		connection is an sqlite3.Connection.
+
+		table is the name of the table containing the entries.
+
+		key_column and record_column are the names of the columns containing the
+		  keys and the records. The keys should be text. For an mdx file the records
+		  should also be text, and for an mdd file they should be blobs. Records may
+		  not be NULL.
+
+		batch_size is the number of rows fetched from the database at a time.
+
+		incremental_blobs is true if the records should not be loaded when the
+		  entries are read, but only when MDictWriter compresses them. Only useful
+		  for mdd files.
+		"""
+		self._connection = connection
+		self._table = _quote_identifier(table)
+		self._key_column = _quote_identifier(key_column)
+		self._record_column = _quote_identifier(record_column)
+		self._raw_table = table
+		self._raw_record_column = record_column
+		self._batch_size = batch_size
+		self._incremental_blobs = incremental_blobs
+
+	def __len__(self):
+		cursor = self._connection.execute(
+		    "SELECT COUNT(*) FROM {0}".format(self._table))
+		return cursor.fetchone()[0]
+
+	def __iter__(self):
+		# Yields (key, record) pairs, sorted by key.
+		if self._incremental_blobs:
+			query = "SELECT {key}, rowid, length({record}) FROM {table} ORDER BY {key} COLLATE BINARY"
+		else:
+			query = "SELECT {key}, {record} FROM {table} ORDER BY {key} COLLATE BINARY"
+		cursor = self._connection.execute(query.format(
+		    key=self._key_column,
+		    record=self._record_column,
+		    table=self._table))
+		try:
+			while True:
+				rows = cursor.fetchmany(self._batch_size)
+				if not rows:
+					break
+				for row in rows:
+					if row[-1] is None:
+						# A NULL record (or its length, with incremental_blobs).
+						raise ParameterError("Record of key {0!r} is NULL".format(row[0]))
+					if self._incremental_blobs:
+						yield row[0], _SQLiteBlob(self, row[1], row[2])
+					else:
+						yield row[0], row[1]
+		finally:
+			cursor.close()
+
+	def _read_blob(self, rowid):
+		# Returns the record in the given row, as a bytes object.
+		if hasattr(self._connection, "blobopen"):
+			blob = self._connection.blobopen(
+			    self._raw_table, self._raw_record_column, rowid, readonly=True)
+			try:
+				return blob.read()
+			finally:
+				blob.close()
+		else:
+			cursor = self._connection.execute(
+			    "SELECT {record} FROM {table} WHERE rowid = ?".format(
+			        record=self._record_column, table=self._table),
+			    (rowid,))
+			return bytes(cursor.fetchone()[0])
+
+class _SQLiteBlob(object):
+	# A record of an mdd file, which is not read from the database until it is
+	# needed. The length is known in advance, so that MDictWriter can compute
+	# the offsets of the records without reading them.
+	def __init__(self, source, rowid, length):
+		self._source = source
+		self._rowid = rowid
+		self._length = length
+
+	def __len__(self):
+		return self._length
+
+	def read(self):
+		return self._source._read_blob(self._rowid)
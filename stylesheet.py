@@ -0,0 +1,220 @@
+"""
+stylesheet.py - replaces tags that are repeated in many records of an mdx file by the numbered styles of the MDict compact format.
+
+If the Compact attribute of the header of an mdx file is "Yes", its StyleSheet
+attribute holds a list of numbered styles, each a piece of HTML to put before and
+after a text. In the records, `N` (a number between backticks) marks the start of a
+text to show with style N; the text extends up to the next marker, or the end of
+the record. Dictionary records repeat the same markup for every headword,
+pronunciation or example, so replacing it with markers makes the records much
+shorter. With extract_stylesheet=True, MDictWriter finds the most frequent pairs of
+start and end tags around a text, in the first records, and writes the records with
+markers for them:
+
+    writer = MDictWriter(dictionary, "Example", "Compact", extract_stylesheet=True)
+    writer.write(open("dictionary.mdx", "wb"))
+
+  so that a record
+
+    <span class="hw">doe</span> <i>noun</i> a deer, a female deer
+
+  is written as `2`doe`1` `3`noun`1` a deer, a female deer, with the styles
+
+    1: "" and ""  (ends the preceding style)
+    2: <span class="hw"> and </span>
+    3: <i> and </i>
+
+MDictReader (and the modules that use it) replaces the markers in the records of
+such a file by the styles again, with expand_styles().
+
+When a text that follows a marker ends with a newline, MDict replaces all the
+whitespace at its end by "\\r\\n". A record is only written with markers if they
+expand to the same record, or if only its trailing whitespace changes, after its
+last tag. Backticks in records are written as "&#96;", which renders the same, so
+that they are not mistaken for markers. This is not possible inside <script> and
+<style> elements: if such an element contains the marker of one of the styles
+(e.g. `1`), the record cannot be written to a compact file, and MDictWriter raises
+ParameterError.
+"""
+
+from __future__ import unicode_literals
+
+import collections, itertools, re
+
+from writemdict import ParameterError
+
+# The style number that ends the preceding style: its start and end are empty.
+NULL_STYLE = "1"
+
+_marker = re.compile(r"`(\d+)`")
+_line_break = re.compile(r"\r?\n")
+
+# One or more start tags, a text without tags, and one or more end tags.
+_element = re.compile(r"((?:<[A-Za-z][^<>`\r\n]*>)+)([^<>`]*)((?:</[A-Za-z][^<>`\r\n]*>)+)")
+_tag = re.compile(r"<[^<>]*>")
+_tag_name = re.compile(r"</?([A-Za-z][^\s/>]*)")
+
+_raw_element = re.compile(r"(<(script|style)\b.*?</\2\s*>)", re.S | re.I)
+
+# The number of records used to choose the styles.
+_SAMPLE_SIZE = 20000
+
+# The largest number of styles, not counting NULL_STYLE. With two-digit numbers,
+# each marker takes 4 characters.
+_MAX_STYLES = 98
+
+def parse_stylesheet(text):
+	"""
+	Returns the styles in text, the value of the StyleSheet attribute of an mdx
+	header, as a dictionary mapping each style number (a string) to a pair of
+	strings: what to put before and after the text.
+	"""
+	# Not str.splitlines(), which also splits at characters such as "\x85" and
+	# "\u2028", which may occur in the styles.
+	lines = _line_break.split(text)
+	return dict((lines[i].strip(), (lines[i+1], lines[i+2])) for i in range(0, len(lines) - 2, 3))
+
+def format_stylesheet(styles):
+	"""
+	Returns the value of the StyleSheet attribute for styles, as returned by
+	parse_stylesheet().
+	"""
+	return "\r\n".join("{0}\r\n{1}\r\n{2}".format(number, start, end)
+	    for number, (start, end) in sorted(styles.items(), key=lambda item: int(item[0])))
+
+def expand_styles(record, styles):
+	"""
+	Returns record, a record of a compact mdx file with the styles styles (as
+	returned by parse_stylesheet()), with the style markers replaced by the styles,
+	as in the MDict client. Markers of unknown styles are left as they are.
+	"""
+	parts = _marker.split(record)
+	if len(parts) == 1:
+		return record
+	result = [parts[0]]
+	for i in range(1, len(parts), 2):
+		number, text = parts[i], parts[i+1]
+		if number not in styles:
+			result.append("`{0}`{1}".format(number, text))
+			continue
+		start, end = styles[number]
+		if text.endswith("\n"):
+			result.extend((start, text.rstrip(), end, "\r\n"))
+		else:
+			result.extend((start, text, end))
+	return "".join(result)
+
+def _escape_backticks(record):
+	# Returns record, with backticks outside of <script> and <style> elements
+	# replaced by a character reference.
+	parts = _raw_element.split(record)
+	# parts are: text, raw element, tag name, text, ...
+	for i in range(0, len(parts), 3):
+		parts[i] = parts[i].replace("`", "&#96;")
+	return "".join(parts[i] for i in range(len(parts)) if i % 3 != 2)
+
+def _candidates(record):
+	# Yields (start, end, style start, text, style end) for each text in record
+	# enclosed in matching start and end tags, where record[start:end] is the text
+	# with its tags.
+	for m in _element.finditer(record):
+		starts = _tag.findall(m.group(1))
+		ends = _tag.findall(m.group(3))
+		k = 0
+		while (k < len(starts) and k < len(ends) and
+		       _tag_name.match(starts[-1-k]).group(1).lower() == _tag_name.match(ends[k]).group(1).lower()):
+			k += 1
+		if k == 0:
+			continue
+		start = "".join(starts[-k:])
+		end = "".join(ends[:k])
+		yield m.start(2) - len(start), m.end(2) + len(end), start, m.group(2), end
+
+class _StyleExtractor(object):
+	# Chooses styles from a sample of records, and writes records with them.
+
+	def __init__(self, records):
+		# records is an iterable of the records used to choose the styles.
+		counts = collections.defaultdict(int)
+		for record in records:
+			for _, _, start, _, end in _candidates(record):
+				counts[(start, end)] += 1
+		# Each use saves the tags, but costs a marker, and often a NULL_STYLE marker
+		# after it; the style also takes up space in the header.
+		savings = []
+		for (start, end), count in counts.items():
+			saving = count * (len(start) + len(end) - 7) - (len(start) + len(end) + 8)
+			if saving > 0:
+				savings.append((-saving, start, end))
+		savings.sort()
+		self.styles = {NULL_STYLE: ("", "")}
+		self._numbers = {}
+		for i, (_, start, end) in enumerate(savings[:_MAX_STYLES]):
+			number = str(i + 2)
+			self.styles[number] = (start, end)
+			self._numbers[(start, end)] = number
+
+	def compact(self, record):
+		# Returns record, written with the styles. Raises ParameterError if record
+		# has the marker of a style inside a <script> or <style> element, so that
+		# it would not expand to itself.
+		if "`" in record:
+			record = _escape_backticks(record)
+		parts = []
+		pos = 0
+		styled = False
+		for start, end, style_start, text, style_end in _candidates(record):
+			number = self._numbers.get((style_start, style_end))
+			if number is None:
+				continue
+			if start > pos:
+				if styled:
+					parts.append("`{0}`".format(NULL_STYLE))
+				parts.append(record[pos:start])
+			parts.append("`{0}`".format(number))
+			parts.append(text)
+			styled = True
+			pos = end
+		if pos < len(record):
+			if styled:
+				parts.append("`{0}`".format(NULL_STYLE))
+			parts.append(record[pos:])
+		compacted = "".join(parts)
+		if compacted != record and self._expands_to(compacted, record):
+			return compacted
+		if expand_styles(record, self.styles) != record:
+			raise ParameterError("Record cannot be written with styles, since it has a style "
+			    "marker inside a <script> or <style> element: {0!r}".format(record[:100]))
+		return record
+
+	def _expands_to(self, compacted, record):
+		# Returns True if compacted expands to record, except maybe for whitespace
+		# after the last tag of record.
+		expanded = expand_styles(compacted, self.styles)
+		if expanded == record:
+			return True
+		stripped = record.rstrip()
+		return stripped.endswith(">") and "\n" in record[len(stripped):] and expanded == stripped + "\r\n"
+
+def _compact_batches(batches, writer):
+	# Yields the batches of (key, record) pairs in the iterable batches, with the
+	# records written with styles chosen from the first _SAMPLE_SIZE records, and
+	# sets writer._styles to these styles (or to {}, if none are worth using).
+	batches = iter(batches)
+	sample = []
+	num_records = 0
+	for batch in batches:
+		sample.append(batch)
+		num_records += len(batch)
+		if num_records >= _SAMPLE_SIZE:
+			break
+	extractor = _StyleExtractor(record for batch in sample for key, record in batch)
+	if len(extractor.styles) == 1:
+		# No tags are repeated enough: the records are written as they are.
+		writer._styles = {}
+		for batch in itertools.chain(sample, batches):
+			yield batch
+		return
+	writer._styles = extractor.styles
+	for batch in itertools.chain(sample, batches):
+		yield [(key, extractor.compact(record)) for key, record in batch]
@@ -0,0 +1,38 @@
+"""
+test_writemdict.py - tests for writemdict.py.
+
+Usage:
+    python test_writemdict.py
+or  python -m pytest test_writemdict.py
+"""
+
+from __future__ import unicode_literals
+
+import io, unittest
+
+from writemdict import MDictWriter
+from readmdict import MDictReader
+
+class KeyBlockAlignmentTest(unittest.TestCase):
+
+	def test_empty_record_at_block_boundary(self):
+		# "b" and "d" are empty resources at the end of a full record block, so their
+		# offsets are those of the first record of the next block.
+		d = {"a": b"x" * 64, "b": b"", "c": b"y" * 64, "d": b"", "e": b"z" * 10}
+		writer = MDictWriter(d, "Title", "Description", is_mdd=True, block_size=64,
+		                     key_block_fanout=1)
+		self.assertEqual([b._num_entries for b in writer._record_blocks], [2, 2, 1])
+		self.assertEqual(writer._record_block_first_entries(), [0, 2, 4])
+		self.assertEqual([b._num_entries for b in writer._key_blocks], [2, 2, 1])
+		fanout = writer.block_fanout()
+		self.assertEqual(fanout["max_fanout"], 1)
+		self.assertEqual(fanout["shared_record_blocks"], 0)
+
+		outfile = io.BytesIO()
+		writer.write(outfile)
+		reader = MDictReader(outfile.getvalue())
+		for key, record in d.items():
+			self.assertEqual(reader.lookup(key), [record])
+
+if __name__ == "__main__":
+	unittest.main()
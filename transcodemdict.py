@@ -0,0 +1,230 @@
+"""
+transcodemdict.py - rewrites an mdx or mdd file with different options, streaming it block by block.
+
+Changing the version, compression, block size or encryption of an existing
+dictionary would otherwise mean reading all of it into a dictionary, and giving
+that to an MDictWriter, which keeps all records (and all compressed blocks) in
+memory. transcode_mdict() instead reads the entries in order (with
+scanmdict.scan_mdict()), compresses each new record block as soon as it is full,
+on a pool of worker processes, and spools the compressed blocks to a temporary
+file. Only the keys are kept in memory. When all entries have been read, the key
+section is built, and the file is written, copying the record blocks from the
+temporary file.
+
+Usage example:
+
+    from transcodemdict import transcode_mdict
+
+    outfile = open("new.mdx", "wb")
+    transcode_mdict("old.mdx", outfile, version="2.0", compression_type=2, block_size=32768)
+    outfile.close()
+
+  Records can also be changed on the way, with a function that is given each key
+  and record, and returns the new record:
+
+    transcode_mdict("old.mdx", outfile, transform=lambda key, record: record.replace("http:", "https:"))
+
+  or, from the command line:
+
+    python transcodemdict.py old.mdx new.mdx [--version 2.0] [--compression-type 2] [--block-size 65536] [--minify-html]
+"""
+
+from __future__ import unicode_literals
+
+import collections, itertools, tempfile
+
+from writemdict import (MDictWriter, ParameterError, _OffsetTableEntry, _MdxRecordBlock,
+    _mdx_compress, _encode_all, _ENCODE_BATCH_SIZE)
+from readmdict import MDictReader
+from scanmdict import scan_mdict
+
+def transcode_mdict(source, outfile, title=None, description=None, transform=None,
+                    source_encrypt_key=None, processes=None, **kwargs):
+	"""
+	Reads the mdx or mdd file source, and writes it again to outfile, with the
+	options given in kwargs.
+
+	source is the name of the file to read.
+
+	outfile is a file-like object, opened in binary mode.
+
+	title and description are as for MDictWriter. If not given, they are taken from
+	  the header of source.
+
+	transform is None, or a function that is called as transform(key, record) for
+	  each entry, and returns the record to write instead. (The keys cannot be
+	  changed, as the entries must stay in order.)
+
+	source_encrypt_key is the dictionary key of source, if it is encrypted.
+
+	processes is the number of worker processes for reading and for compressing
+	  blocks. If None, the number of CPUs is used. If 1, everything is done in the
+	  calling process.
+
+	Any other keyword arguments (e.g. version, compression_type, block_size,
+	encrypt_key, encoding) are passed on to MDictWriter, and apply to the new file.
+	By default, the encoding of source is kept.
+	"""
+	reader = MDictReader(source, encrypt_key=source_encrypt_key)
+	try:
+		if title is None:
+			title = reader.header.get("Title", "")
+		if description is None:
+			description = reader.header.get("Description", "")
+		kwargs["is_mdd"] = reader.is_mdd
+		if not reader.is_mdd:
+			kwargs.setdefault("encoding", reader.header.get("Encoding", "UTF-8").lower())
+	finally:
+		reader.close()
+	if processes is None:
+		from verifymdict import _cpu_count
+		processes = _cpu_count()
+	entries = scan_mdict(source, encrypt_key=source_encrypt_key, processes=processes)
+	if transform is not None:
+		entries = ((key, transform(key, record)) for key, record in entries)
+	writer = _TranscodingWriter(entries, title, description, processes=processes, **kwargs)
+	try:
+		writer.write(outfile)
+	finally:
+		writer._spool.close()
+
+def _compress_block(args):
+	# Worker function: compresses one record block.
+	data, compression_type = args
+	return _mdx_compress(data, compression_type)
+
+class _TranscodingWriter(MDictWriter):
+	# An MDictWriter which compresses its record blocks while reading the entries,
+	# and keeps them in a temporary file instead of in memory.
+
+	def __init__(self, entries, title, description, processes=1, **kwargs):
+		self._processes = processes
+		self._spool = tempfile.TemporaryFile()
+		try:
+			MDictWriter.__init__(self, entries, title, description, **kwargs)
+		except:
+			self._spool.close()
+			raise
+
+	def _build_offset_table(self, entries):
+		# As MDictWriter._build_offset_table, but record_null is None for all
+		# entries. Instead, the records are split into blocks in the same way as by
+		# _split_blocks(), and each block is compressed and appended to self._spool.
+		# Sets self._spooled_blocks to a list of (position in self._spool, comp_size,
+		# decomp_size, number of entries) for each record block.
+		self._offset_table = []
+		self._spooled_blocks = []
+		null = "\0".encode(self._python_encoding)
+		pool = None
+		if self._processes > 1:
+			import multiprocessing
+			pool = multiprocessing.Pool(self._processes)
+		# Blocks being compressed, as (decomp_size, number of entries, result).
+		pending = collections.deque()
+		spool_pos = [0]
+
+		def finish(decomp_size, num_entries, comp_data):
+			self._spool.write(comp_data)
+			self._spooled_blocks.append((spool_pos[0], len(comp_data), decomp_size, num_entries))
+			spool_pos[0] += len(comp_data)
+
+		def flush(block):
+			data = b"".join(block)
+			if pool is None:
+				finish(len(data), len(block), _mdx_compress(data, self._compression_type))
+				return
+			pending.append((len(data), len(block),
+			    pool.apply_async(_compress_block, ((data, self._compression_type),))))
+			while len(pending) > 2 * self._processes:
+				decomp_size, num_entries, result = pending.popleft()
+				finish(decomp_size, num_entries, result.get())
+
+		try:
+			offset = 0
+			previous_key = None
+			block = []
+			block_size = 0
+			entries = iter(entries)
+			batches = iter(lambda: list(itertools.islice(entries, _ENCODE_BATCH_SIZE)), [])
+			if self._minify_html:
+				batches = self._minify_batches(batches, pool)
+			if self._extract_stylesheet:
+				from stylesheet import _compact_batches
+				batches = _compact_batches(batches, self)
+			for batch in batches:
+				keys_enc = _encode_all([key for key, record in batch], self._python_encoding)
+				if not self._is_mdd:
+					records_enc = _encode_all([record for key, record in batch], self._python_encoding)
+				for i, (key, record) in enumerate(batch):
+					if previous_key is not None and key < previous_key:
+						raise ParameterError("Entries are not sorted by key")
+					previous_key = key
+					key_enc = keys_enc[i]
+					if self._is_mdd:
+						record_null = record
+					else:
+						record_null = records_enc[i] + null
+						if self._fulltext is not None:
+							self._fulltext.add(len(self._offset_table), self._expand_styles(record))
+					if block and block_size + len(record_null) > self._block_size:
+						flush(block)
+						block = []
+						block_size = 0
+					block.append(record_null)
+					block_size += len(record_null)
+					self._offset_table.append(_OffsetTableEntry(
+					    key=key_enc,
+					    key_null=key_enc + null,
+					    key_len=len(key_enc) // self._encoding_length,
+					    record_null=None,
+					    offset=offset))
+					offset += len(record_null)
+			if block:
+				flush(block)
+			while pending:
+				decomp_size, num_entries, result = pending.popleft()
+				finish(decomp_size, num_entries, result.get())
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+		self._total_record_len = offset
+		self._num_entries = len(self._offset_table)
+
+	def _build_record_blocks(self):
+		self._record_blocks = [
+		    _SpooledRecordBlock(self._spool, pos, comp_size, decomp_size, num_entries, self._version)
+		    for pos, comp_size, decomp_size, num_entries in self._spooled_blocks]
+
+class _SpooledRecordBlock(_MdxRecordBlock):
+	# A record block that was compressed in advance, and is read from the spool
+	# file when it is written.
+	def __init__(self, spool, pos, comp_size, decomp_size, num_entries, version):
+		self._spool = spool
+		self._pos = pos
+		self._comp_size = comp_size
+		self._decomp_size = decomp_size
+		self._num_entries = num_entries
+		self._version = version
+
+	def get_block(self):
+		self._spool.seek(self._pos)
+		return self._spool.read(self._comp_size)
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Rewrites an mdx or mdd file with different options.")
+	parser.add_argument("source")
+	parser.add_argument("output")
+	parser.add_argument("--version", choices=["2.0", "1.2"])
+	parser.add_argument("--compression-type", type=int, choices=[0, 1, 2])
+	parser.add_argument("--block-size", type=int)
+	parser.add_argument("--minify-html", action="store_true")
+	args = parser.parse_args()
+	options = dict((name, value) for name, value in [
+	    ("version", args.version),
+	    ("compression_type", args.compression_type),
+	    ("block_size", args.block_size),
+	    ("minify_html", args.minify_html or None)] if value is not None)
+	with open(args.output, "wb") as outfile:
+		transcode_mdict(args.source, outfile, **options)
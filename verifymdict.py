@@ -0,0 +1,165 @@
+"""
+verifymdict.py - checks the integrity of mdx and mdd files.
+
+Every compressed block in an MDict file starts with an ADLER32 checksum of its
+decompressed data, and the block indexes record the size of each block before and
+after compression. The header and the key section header have checksums of their
+own. verify_mdict() checks all of these, spreading the block checks over several
+processes.
+
+Usage example:
+
+    from verifymdict import verify_mdict, VerificationError
+
+    try:
+        verify_mdict("dictionary.mdx")
+    except VerificationError as e:
+        print("Corrupt at offset", e.offset)
+
+  It can also be run from the command line:
+
+    python verifymdict.py dictionary.mdx [dictionary.mdd ...]
+
+The same checks are run by MDictWriter.write(outfile, verify=True) after writing.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import zlib, mmap, os, sys
+
+from readmdict import MDictReader, FormatError, _mdx_decompress
+
+# Below this number of blocks, the blocks are checked in the calling process.
+_MIN_BLOCKS_FOR_POOL = 64
+
+class VerificationError(Exception):
+	# Raised when a file fails verification. offset is the position in the file
+	# of the first damaged part (for a damaged block, the start of the block).
+	def __init__(self, message, offset):
+		Exception.__init__(self, "{0} (at offset {1})".format(message, offset))
+		self.offset = offset
+
+def _check_blocks(data, blocks):
+	# Checks the given blocks of data (a bytes-like object containing the whole
+	# file).
+	#
+	# blocks is a list of (name, offset, comp_size, decomp_size). Returns a list of
+	# (offset, message) for the damaged blocks.
+	errors = []
+	for name, offset, comp_size, decomp_size in blocks:
+		comp_block = data[offset:offset+comp_size]
+		if len(comp_block) != comp_size:
+			errors.append((offset, "{0} extends beyond end of file".format(name)))
+			continue
+		try:
+			_mdx_decompress(comp_block, decomp_size)
+		except ValueError as e:
+			errors.append((offset, "{0}: {1}".format(name, e)))
+	return errors
+
+def _check_blocks_in_file(args):
+	# Worker function: like _check_blocks, but memory-maps the file itself.
+	filename, blocks = args
+	with open(filename, "rb") as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return _check_blocks(data, blocks)
+		finally:
+			data.close()
+
+def _check_structure(reader):
+	# Checks the checksums that are not part of a block, i.e. those of the header,
+	# the key section header, and the key block index. Raises VerificationError.
+	if zlib.adler32(reader._header_string) & 0xffffffff != reader.header_checksum:
+		raise VerificationError("Header checksum mismatch", 4)
+	if reader.preamble_checksum is not None:
+		if zlib.adler32(reader._preamble) & 0xffffffff != reader.preamble_checksum:
+			raise VerificationError("Key section header checksum mismatch", reader._key_sect_offset)
+	# For version 2.0, the key block index was already decompressed and checked
+	# when the reader was opened.
+
+def _block_list(reader):
+	blocks = []
+	for i, b in enumerate(reader.key_blocks):
+		blocks.append(("key block {0}".format(i), b.offset, b.comp_size, b.decomp_size))
+	for i, b in enumerate(reader.record_blocks):
+		blocks.append(("record block {0}".format(i), b.offset, b.comp_size, b.decomp_size))
+	return blocks
+
+def verify_mdict(f, encrypt_key=None, processes=None):
+	"""
+	Verifies the integrity of an mdx or mdd file.
+
+	f is either the name of the file, or a bytes-like object containing the whole file.
+
+	encrypt_key is the dictionary key, needed if the file was written with encrypt_key set.
+
+	processes is the number of worker processes used to check the blocks. If None,
+	  the number of CPUs is used. If 1, or if f is not a file name, all blocks are
+	  checked in the calling process.
+
+	Returns the number of blocks checked. If the file is damaged, raises
+	VerificationError, whose offset attribute is the position of the first damaged part.
+	"""
+	if isinstance(f, (bytes, bytearray, memoryview, mmap.mmap)):
+		filename = None
+		data = f
+	else:
+		filename = f
+		data = None
+	try:
+		reader = MDictReader(f, encrypt_key=encrypt_key)
+	except FormatError as e:
+		raise VerificationError(e.message, e.offset or 0)
+	try:
+		_check_structure(reader)
+		blocks = _block_list(reader)
+		if filename is not None:
+			file_size = os.path.getsize(filename)
+		else:
+			file_size = len(data)
+	finally:
+		reader.close()
+	if file_size != reader.file_size:
+		raise VerificationError("File size is {0}, expected {1}".format(
+		    file_size, reader.file_size), min(file_size, reader.file_size))
+
+	if processes is None:
+		processes = _cpu_count()
+	if filename is None or processes <= 1 or len(blocks) < _MIN_BLOCKS_FOR_POOL:
+		if filename is None:
+			errors = _check_blocks(data, blocks)
+		else:
+			errors = _check_blocks_in_file((filename, blocks))
+	else:
+		import multiprocessing
+		chunk_size = max(1, len(blocks) // (processes * 4))
+		chunks = [(filename, blocks[i:i+chunk_size]) for i in range(0, len(blocks), chunk_size)]
+		pool = multiprocessing.Pool(processes)
+		try:
+			errors = [e for result in pool.map(_check_blocks_in_file, chunks) for e in result]
+		finally:
+			pool.close()
+			pool.join()
+	if errors:
+		offset, message = min(errors)
+		raise VerificationError(message, offset)
+	return len(blocks)
+
+def _cpu_count():
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except (ImportError, NotImplementedError):
+		return 1
+
+if __name__ == "__main__":
+	status = 0
+	for filename in sys.argv[1:]:
+		try:
+			n = verify_mdict(filename)
+			print("{0}: OK ({1} blocks)".format(filename, n))
+		except VerificationError as e:
+			print("{0}: {1}".format(filename, e))
+			status = 1
+	sys.exit(status)
@@ -4,6 +4,9 @@ writemdict.py - a library for creating dictionary files in the MDict file format
 Optional dependencies:
   python-lzo: Required to write dictionaries using LZO compression. (Other compression schemes are available.)
 
+The encryption modules (ripemd128, pureSalsa20) and python-lzo are only imported when
+they are first used, so that importing this module stays cheap. See benchmarks.py.
+
 Simple usage example: 
 
     from __future__ import unicode_literals
@@ -27,17 +30,64 @@ Simple usage example:
 
 from __future__ import unicode_literals
 
-import struct, zlib, operator, sys, datetime
+import struct, zlib, operator, sys, os, itertools, bisect
+
+# The following modules are imported on first use, see _ripemd128, _salsa20
+# and _lzo below.
+_lzo_module = None
+
+def _ripemd128(message):
+	from ripemd128 import ripemd128
+	return ripemd128(message)
+
+def _salsa20(**kwargs):
+	# Returns a new pureSalsa20.Salsa20 object.
+	from pureSalsa20 import Salsa20
+	return Salsa20(**kwargs)
+
+def _lzo():
+	# Returns the lzo module, or None if python-lzo is not installed. Also sets
+	# HAVE_LZO.
+	global _lzo_module, HAVE_LZO
+	if _lzo_module is None:
+		try:
+			import lzo
+			_lzo_module = lzo
+		except ImportError:
+			_lzo_module = False
+		HAVE_LZO = bool(_lzo_module)
+	return _lzo_module or None
 
-from ripemd128 import ripemd128
-from cgi import escape
-from pureSalsa20 import Salsa20
+def __getattr__(name):
+	# HAVE_LZO is a plain module attribute once _lzo() has been called. Before
+	# that, it is computed on first access, so that importing this module does
+	# not import lzo.
+	if name == "HAVE_LZO":
+		return _lzo() is not None
+	raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
-try:
-	import lzo
-	HAVE_LZO = True
-except ImportError:
-	HAVE_LZO = False
+if sys.version_info < (3, 7):
+	# Module __getattr__ is only supported from Python 3.7: set HAVE_LZO now.
+	_lzo()
+
+def _escape(s):
+	# Escapes s for use as an attribute value in the header. Same as
+	# cgi.escape(s, quote=True), which is not available in recent Python versions.
+	return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+# Precompiled structs for the binary fields whose width depends on the version of
+# the file format. "long" fields hold offsets, sizes and counts, and "short" fields
+# hold key lengths in the key block index.
+_long_struct = {"2.0": struct.Struct(b">Q"), "1.2": struct.Struct(b">L")}
+_short_struct = {"2.0": struct.Struct(b">H"), "1.2": struct.Struct(b">B")}
+_long_short_struct = {"2.0": struct.Struct(b">QH"), "1.2": struct.Struct(b">LB")}
+_long_pair_struct = {"2.0": struct.Struct(b">QQ"), "1.2": struct.Struct(b">LL")}
+
+def _pack_longs(values, version):
+	# Packs the list of integers values as consecutive "long" fields (see above),
+	# using a single call to struct.pack.
+	format = ">{0}{1}".format(len(values), "Q" if version == "2.0" else "L")
+	return struct.pack(str(format), *values)
 
 class ParameterError(Exception):
 	### Raised when some parameter to MdxWriter is invalid or uninterpretable.
@@ -51,7 +101,8 @@ def _mdx_compress(data, compression_type=2):
 	elif compression_type == 2:
 		return header + zlib.compress(data)
 	elif compression_type == 1:
-		if HAVE_LZO:
+		lzo = _lzo()
+		if lzo is not None:
 			return header + lzo.compress(data)[5:] #python-lzo adds a 5-byte header.
 		else:
 			raise NotImplementedError()
@@ -68,14 +119,14 @@ def _fast_encrypt(data, key):
 	return bytes(b)
 	
 def _mdx_encrypt(comp_block):
-	key = ripemd128(comp_block[4:8] + struct.pack(b"<L", 0x3695))
+	key = _ripemd128(comp_block[4:8] + struct.pack(b"<L", 0x3695))
 	return comp_block[0:8] + _fast_encrypt(comp_block[8:], key)
 	
 def _salsa_encrypt(plaintext, dict_key):
 	assert(type(dict_key) == bytes)
 	assert(type(plaintext) == bytes)
-	encrypt_key = ripemd128(dict_key)
-	s20 = Salsa20(key=encrypt_key,IV=b"\x00"*8,rounds=8)
+	encrypt_key = _ripemd128(dict_key)
+	s20 = _salsa20(key=encrypt_key,IV=b"\x00"*8,rounds=8)
 	return s20.encryptBytes(plaintext)
 
 def _hexdump(bytes_blob):
@@ -119,22 +170,161 @@ def encrypt_key(dict_key, **kwargs):
 
 
 	if "email" in kwargs:
-		owner_info_digest = ripemd128(kwargs["email"].encode("ascii"))
+		owner_info = kwargs["email"]
 	else:
-		owner_info_digest = ripemd128(kwargs["device_id"].encode("ascii"))
+		owner_info = kwargs["device_id"]
 
-	dict_key_digest = ripemd128(dict_key)
-	
-	s20 = Salsa20(key=owner_info_digest,IV=b"\x00"*8,rounds=8)
-	output_key = s20.encryptBytes(dict_key_digest)
-	return _hexdump(output_key)
+	dict_key_digest = _ripemd128(dict_key)
+	return _encrypt_key_digests(dict_key_digest, [owner_info])[0]
+
+def _encrypt_key_digests(dict_key_digest, owner_infos):
+	# Returns the keys of encrypt_key() for each of owner_infos (a list of emails or
+	# device IDs), given dict_key_digest = ripemd128(dict_key).
+	keys = []
+	for owner_info in owner_infos:
+		owner_info_digest = _ripemd128(owner_info.encode("ascii"))
+		s20 = _salsa20(key=owner_info_digest,IV=b"\x00"*8,rounds=8)
+		keys.append(_hexdump(s20.encryptBytes(dict_key_digest)))
+	return keys
+
+def _encrypt_key_chunk(args):
+	# Worker function for encrypt_keys().
+	dict_key_digest, owner_infos = args
+	return _encrypt_key_digests(dict_key_digest, owner_infos)
+
+def encrypt_keys(dict_key, users, processes=None, chunk_size=256):
+	"""
+	Generates the keys of encrypt_key() for many users at once.
+
+	Parameters:
+	  dict_key: a bytes object, representing the dictionary password.
+	  users: an iterable of (unicode) strings, each being either a user's email address
+	    or a device ID, as for the email and device_id parameters of encrypt_key(). (The
+	    key does not depend on which of the two is used.)
+
+	Keyword parameters:
+	  processes: the number of worker processes. If None, the number of CPUs is used.
+	    If 1, all keys are generated in the calling process.
+	  chunk_size: the number of users handed to a worker process at a time.
+
+	Return value:
+	  an iterator of pairs (user, key), in the same order as users, where key is
+	  encrypt_key(dict_key, email=user). users is consumed lazily, so this can be used
+	  on more users than fit in memory.
+
+	Example usage:
+		for email, key in encrypt_keys(b"password", open("emails.txt").read().split()):
+			print(email, key)
+	"""
+	import collections, multiprocessing
+	dict_key_digest = _ripemd128(dict_key)
+	users = iter(users)
+	def chunks():
+		while True:
+			chunk = list(itertools.islice(users, chunk_size))
+			if not chunk:
+				return
+			yield chunk
+
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	if processes <= 1:
+		for chunk in chunks():
+			for user, key in zip(chunk, _encrypt_key_digests(dict_key_digest, chunk)):
+				yield user, key
+		return
+
+	pool = multiprocessing.Pool(processes)
+	pending = collections.deque()
+	try:
+		for chunk in chunks():
+			pending.append((chunk, pool.apply_async(_encrypt_key_chunk, ((dict_key_digest, chunk),))))
+			# Keep a bounded number of chunks in flight, so that users is read lazily.
+			while len(pending) > 2 * processes:
+				done_chunk, result = pending.popleft()
+				for user, key in zip(done_chunk, result.get()):
+					yield user, key
+		while pending:
+			done_chunk, result = pending.popleft()
+			for user, key in zip(done_chunk, result.get()):
+				yield user, key
+	finally:
+		# As in scanmdict.py, let the chunks in flight finish rather than calling
+		# pool.terminate(), which can deadlock while tasks are being handed out.
+		for done_chunk, result in pending:
+			result.wait()
+		pool.close()
+		pool.join()
+
+def write_key_files(dict_key, users, key_file_name, processes=None):
+	"""
+	Writes a .key file (see encrypt_key()) for each of many users.
+
+	Parameters:
+	  dict_key: a bytes object, representing the dictionary password.
+	  users: an iterable of (unicode) strings, each being either an email address or
+	    a device ID, as for encrypt_keys().
+	  key_file_name: a function that is given a user, and returns the name of the
+	    file to write the key for that user to.
+
+	Keyword parameters:
+	  processes: the number of worker processes, as for encrypt_keys().
+
+	Return value:
+	  the number of files written.
+
+	Example usage:
+		write_key_files(b"password", emails, lambda email: "keys/" + email + ".key")
+	"""
+	import io
+	n = 0
+	for user, key in encrypt_keys(dict_key, users, processes=processes):
+		keyfile = io.open(key_file_name(user), "w", encoding="ascii")
+		try:
+			keyfile.write(key)
+		finally:
+			keyfile.close()
+		n += 1
+	return n
 	
 
+# The number of entries whose keys (or records) are encoded with one codec call,
+# in MDictWriter._build_offset_table().
+_ENCODE_BATCH_SIZE = 4096
+
+def _encode_all(strings, python_encoding):
+	# Returns [s.encode(python_encoding) for s in strings], but calls the codec only
+	# once, on the strings joined by NUL characters, and splits the result. The
+	# codecs used are stateless, so this gives the same bytes.
+	#
+	# Falls back to encoding the strings one by one if one of them contains a NUL
+	# character, or (for UTF-16) a character outside the Basic Multilingual Plane.
+	joined = "\0".join(strings)
+	if len(strings) > 1 and joined.count("\0") == len(strings) - 1:
+		encoded = joined.encode(python_encoding)
+		if python_encoding != "utf_16_le":
+			# In UTF-8, GBK and Big5, a zero byte only occurs in the encoding of NUL.
+			return encoded.split(b"\0")
+		elif len(encoded) == 2 * len(joined):
+			# In UTF-16, b"\0\0" may also straddle two characters, so the result is
+			# cut at the lengths of the strings instead. These are known as long as
+			# there are no surrogate pairs, i.e. each character takes 2 bytes.
+			parts = []
+			pos = 0
+			for s in strings:
+				end = pos + 2 * len(s)
+				parts.append(encoded[pos:end])
+				pos = end + 2
+			return parts
+	return [s.encode(python_encoding) for s in strings]
+
 class _OffsetTableEntry(object):
 	# Each OffsetTableEntry represents one key/record pair of the dictionary.
 	# In addition to the values themselves, it contains information about
 	# the offset at which this entry will be placed (i.e. the total length
 	# of records before it) which is required by the MDX format.
+	__slots__ = ("key", "key_null", "key_len", "offset", "record_null")
+
 	def __init__(self, key, key_null, key_len, offset, record_null):
 		self.key = key
 		self.key_null = key_null
@@ -154,7 +344,12 @@ class MDictWriter(object):
 	             register_by = None,
 	             user_email = None,
 	             user_device_id = None,
-	             is_mdd=False):
+	             is_mdd=False,
+	             fulltext_index=False,
+	             key_block_fanout=None,
+	             checkpoint_dir=None,
+	             minify_html=False,
+	             extract_stylesheet=False):
 		"""
 		Prepares the records. A subsequent call to write() writes 
 		the mdx or mdd file.
@@ -165,6 +360,11 @@ class MDictWriter(object):
 		  file (the parameter is_mdd is True), then the values should be binary 
 		  strings (bytes objects), containing the raw data for the corresponding 
 		  file object.
+		  Instead of a dictionary, d may also be an iterable of (key, value) pairs
+		  which are already sorted by key, such as a sqlitesource.SQLiteSource. 
+		  The pairs are then consumed in order, without being sorted again. For
+		  mdd files, a value may also be an object with a __len__() and a read()
+		  method, which is only read when its record block is compressed.
 		
 		title is a (unicode) string, with the title of the dictionary
 		  description is a (unicode) string, with a short description of the
@@ -212,9 +412,37 @@ class MDictWriter(object):
 		is_mdd is a boolean specifying whether the file written will be an mdx file
 		  or an mdd file. By default this is False, meaning that an mdd file will
 		  be written.
+
+		fulltext_index is true if a full-text index of the records should be built
+		  while preparing them. It can then be written with write_fulltext_index().
+		  See fulltext.py. Not supported for mdd files.
+
+		key_block_fanout is None, or the maximal number of record blocks that the
+		  entries of one key block may have their records in. If it is not None,
+		  key blocks are aligned with record blocks: each key block starts with the
+		  first entry of a record block, and takes the entries of at most
+		  key_block_fanout consecutive record blocks (fewer if their keys exceed
+		  block_size). A client looking up keys from one key block then needs to
+		  decompress few record blocks, and no record block is needed for two key
+		  blocks. (The exception is a record block with more keys than fit into one
+		  key block.) block_fanout() reports the resulting layout.
+
+		checkpoint_dir is None, or the name of a directory where each record block
+		  is saved as soon as it is compressed. If the build is interrupted,
+		  running it again with the same checkpoint_dir reuses the saved blocks
+		  instead of compressing them again. See checkpoint.py.
+
+		minify_html is true if redundant whitespace, comments and attribute quotes
+		  should be removed from the records before they are encoded, in a way
+		  that does not change how they are rendered. minify_stats() reports the
+		  bytes saved. See htmlminify.py. Not supported for mdd files.
+
+		extract_stylesheet is true if tags that are repeated in many records
+		  should be replaced by numbered styles, listed in the StyleSheet attribute
+		  of the header (the MDict compact format). The styles are chosen from the
+		  first records. See stylesheet.py. Not supported for mdd files.
 		"""
 
-		self._num_entries = len(d)
 		self._title=title
 		self._description=description
 		self._block_size = block_size
@@ -257,14 +485,45 @@ class MDictWriter(object):
 		else:
 			self._python_encoding="utf_16_le"
 			self._encoding_length=2
+		if key_block_fanout is not None and key_block_fanout < 1:
+			raise ParameterError("key_block_fanout must be at least 1")
+		self._key_block_fanout = key_block_fanout
 		if version not in ["2.0", "1.2"]:
 			raise ParameterError("Unknown version")
 		self._version = version
+		if fulltext_index:
+			if is_mdd:
+				raise ParameterError("Full-text index not supported for mdd files")
+			from fulltext import _FullTextIndexBuilder
+			self._fulltext = _FullTextIndexBuilder()
+		else:
+			self._fulltext = None
+		if minify_html and is_mdd:
+			raise ParameterError("HTML minification not supported for mdd files")
+		self._minify_html = minify_html
+		self._minify_stats = {"records": 0, "bytes_before": 0, "bytes_after": 0}
+		if extract_stylesheet and is_mdd:
+			raise ParameterError("StyleSheet extraction not supported for mdd files")
+		self._extract_stylesheet = extract_stylesheet
+		# The styles of the compact format, as returned by stylesheet.parse_stylesheet(),
+		# or an empty dictionary if the records are not written with styles.
+		self._styles = {}
 		self._build_offset_table(d)
+		if checkpoint_dir is not None:
+			from checkpoint import _BlockCheckpoint
+			self._checkpoint = _BlockCheckpoint(checkpoint_dir)
+		else:
+			self._checkpoint = None
+		# The record blocks are built first, since with key_block_fanout, the key
+		# blocks are aligned with them.
+		try:
+			self._build_record_blocks()
+		finally:
+			if self._checkpoint is not None:
+				self._checkpoint.close()
+		self._build_recordb_index()
 		self._build_key_blocks()
 		self._build_keyb_index()
-		self._build_record_blocks()
-		self._build_recordb_index()
 		
 	def _build_offset_table(self,d):
 		# Sets self._offset_table to a table of entries _OffsetTableEntry objects e.
@@ -277,33 +536,84 @@ class MDictWriter(object):
 		#  e.offset: the cumulative sum of len(record_null) for preceding records
 		#  e.record_null: encoded version of the record, null-terminated
 		#
-		# Also sets self._total_record_len to the total length of all record fields.
-		items = list(d.items())
-		items.sort(key=operator.itemgetter(0))
+		# Also sets self._total_record_len to the total length of all record fields,
+		# and self._num_entries to the number of entries.
+		#
+		# d is either a dictionary, or an iterable of (key, record) pairs that is
+		# already sorted by key (see __init__).
+		if hasattr(d, "items"):
+			items = list(d.items())
+			items.sort(key=operator.itemgetter(0))
+		else:
+			items = d
 		
 		self._offset_table = []
 		offset = 0
-		for key, record in items:
-			key_enc = key.encode(self._python_encoding)
-			key_null = (key+"\0").encode(self._python_encoding)
-			key_len = len(key_enc) // self._encoding_length
-			
-			# set record_null to a the the value of the record. If it's
-			# an MDX file, append an extra null character.
+		previous_key = None
+		null = "\0".encode(self._python_encoding)
+		items = iter(items)
+		batches = iter(lambda: list(itertools.islice(items, _ENCODE_BATCH_SIZE)), [])
+		if self._minify_html:
+			batches = self._minify_batches(batches)
+		if self._extract_stylesheet:
+			from stylesheet import _compact_batches
+			batches = _compact_batches(batches, self)
+		for batch in batches:
+			keys_enc = _encode_all([key for key, record in batch], self._python_encoding)
 			if self._is_mdd:
-				record_null = record
+				records_enc = None
 			else:
-				record_null = (record+"\0").encode(self._python_encoding) 
-			self._offset_table.append(_OffsetTableEntry(
-			    key=key_enc,
-			    key_null=key_null,
-			    key_len=key_len,
-			    record_null=record_null,
-			    offset=offset))
-			offset += len(record_null)
+				records_enc = _encode_all([record for key, record in batch], self._python_encoding)
+			for i, (key, record) in enumerate(batch):
+				if previous_key is not None and key < previous_key:
+					raise ParameterError("Entries are not sorted by key")
+				previous_key = key
+				key_enc = keys_enc[i]
+				
+				# set record_null to a the the value of the record. If it's
+				# an MDX file, append an extra null character.
+				if self._is_mdd:
+					record_null = record
+				else:
+					record_null = records_enc[i] + null
+					if self._fulltext is not None:
+						self._fulltext.add(len(self._offset_table), self._expand_styles(record))
+				self._offset_table.append(_OffsetTableEntry(
+				    key=key_enc,
+				    key_null=key_enc + null,
+				    key_len=len(key_enc) // self._encoding_length,
+				    record_null=record_null,
+				    offset=offset))
+				offset += len(record_null)
 		self._total_record_len = offset
+		self._num_entries = len(self._offset_table)
 	
-	def _split_blocks(self, block_type):
+	def _expand_styles(self, record):
+		# Returns record, with the styles of the compact format (if any) expanded.
+		if not self._styles:
+			return record
+		from stylesheet import expand_styles
+		return expand_styles(record, self._styles)
+
+	def _minify_batches(self, batches, pool=None):
+		# Returns an iterator over the batches of (key, record) pairs in batches, with
+		# the records minified (see htmlminify.py), by the workers of pool if it is
+		# not None.
+		from htmlminify import _minify_batches
+		return _minify_batches(batches, self._python_encoding, self._minify_stats, pool)
+
+	def minify_stats(self):
+		"""
+		Returns statistics on the HTML minification of the records (see minify_html
+		in the constructor), as a dictionary with the number of records, and their
+		total encoded size before and after minification, and the difference:
+		records, bytes_before, bytes_after, bytes_saved.
+		"""
+		stats = dict(self._minify_stats)
+		stats["bytes_saved"] = stats["bytes_before"] - stats["bytes_after"]
+		return stats
+
+	def _split_blocks(self, block_type, offset_table=None, **kwargs):
 		# Split either the records or the keys into blocks for compression.
 		# 
 		# Returns a list of _MdxBlock, where the decompressed size of each block is (as
@@ -311,43 +621,142 @@ class MDictWriter(object):
 		#
 		# block_type should be a subclass of _MdxBlock, i.e. either _MdxRecordBlock or 
 		# _MdxKeyBlock.
+		#
+		# offset_table is the list of entries to split, by default self._offset_table.
+		#
+		# Any keyword arguments are passed on to block_type.
 		
+		if offset_table is None:
+			offset_table = self._offset_table
+		splitter = _BlockSplitter(block_type, self._block_size)
 		this_block_start = 0
-		cur_size = 0
 		blocks = []
-		for ind in range(len(self._offset_table)+1):
-			if ind != len(self._offset_table):
-				t = self._offset_table[ind]
-			else:
-				t = None
-			
-			if ind == 0:
-				flush = False 
-				# nothing to flush yet
-				# this part is needed in case the first entry is longer than
-				# self._block_size.
-			elif ind == len(self._offset_table):
-				flush = True #always flush the last block
-			elif cur_size + block_type._len_block_entry(t) > self._block_size:
-				flush = True #Adding this entry to make us larger than
-				             #self._block_size, so flush now.
-			else:
-				flush = False
-			if flush:
+		for ind, t in enumerate(offset_table):
+			if splitter.starts_block(t):
 				blocks.append(block_type(
-				    self._offset_table[this_block_start:ind], self._compression_type, self._version))
-				cur_size = 0
+				    offset_table[this_block_start:ind], self._compression_type, self._version, **kwargs))
 				this_block_start = ind
-			if t is not None: #mentally add this entry to list of things 
-				cur_size += block_type._len_block_entry(t)
+		if offset_table:
+			#always flush the last block
+			blocks.append(block_type(
+			    offset_table[this_block_start:], self._compression_type, self._version, **kwargs))
 		return blocks
 		
 	def _build_key_blocks(self):
 		# Sets self._key_blocks to a list of _MdxKeyBlocks.
-		self._key_blocks = self._split_blocks(_MdxKeyBlock)
+		if self._key_block_fanout is None:
+			self._key_blocks = self._split_blocks(_MdxKeyBlock)
+			return
+		# Aligned layout: group whole record blocks into key blocks, as long as
+		# their keys fit into self._block_size, and there are at most
+		# self._key_block_fanout of them.
+		first_entries = self._record_block_first_entries()
+		first_entries.append(len(self._offset_table))
+		self._key_blocks = []
+		start = 0
+		size = 0
+		fanout = 0
+		for i in range(len(first_entries) - 1):
+			entries = self._offset_table[first_entries[i]:first_entries[i+1]]
+			entries_size = sum(_MdxKeyBlock._len_block_entry(t) for t in entries)
+			if fanout > 0 and (fanout >= self._key_block_fanout or size + entries_size > self._block_size):
+				self._key_blocks.append(_MdxKeyBlock(
+				    self._offset_table[start:first_entries[i]], self._compression_type, self._version))
+				start = first_entries[i]
+				size = 0
+				fanout = 0
+			if entries_size > self._block_size:
+				# The keys of this record block alone do not fit into one key block.
+				self._key_blocks.extend(self._split_blocks(_MdxKeyBlock, entries))
+				start = first_entries[i+1]
+			else:
+				size += entries_size
+				fanout += 1
+		if fanout > 0:
+			self._key_blocks.append(_MdxKeyBlock(
+			    self._offset_table[start:], self._compression_type, self._version))
+
+	def _record_block_first_entries(self):
+		# Returns a list with the number of the first entry of each record block.
+		# (Not found from the record offsets, which do not tell in which block an
+		# empty record at a block boundary is.)
+		first_entries = []
+		entry = 0
+		for b in self._record_blocks:
+			first_entries.append(entry)
+			entry += b._num_entries
+		return first_entries
+
+	def block_fanout(self):
+		"""
+		Returns statistics on how the key blocks map to the record blocks, as a
+		dictionary with the following entries:
+
+		  key_blocks, record_blocks: the number of key and record blocks.
+		  max_fanout, mean_fanout: the maximal and mean number of record blocks
+		    holding the records of the entries of one key block. A lookup of a range
+		    of keys from one key block needs to decompress at most that many record
+		    blocks.
+		  shared_record_blocks: the number of record blocks holding records for more
+		    than one key block.
+
+		See key_block_fanout in the constructor.
+		"""
+		record_block_first_entries = self._record_block_first_entries()
+		def record_block(entry):
+			return bisect.bisect_right(record_block_first_entries, entry) - 1
+		fanouts = []
+		shared = set()
+		entry = 0
+		previous_last = None
+		for b in self._key_blocks:
+			if b._num_entries == 0:
+				continue
+			first = record_block(entry)
+			last = record_block(entry + b._num_entries - 1)
+			fanouts.append(last - first + 1)
+			if first == previous_last:
+				shared.add(first)
+			previous_last = last
+			entry += b._num_entries
+		return {
+			"key_blocks": len(self._key_blocks),
+			"record_blocks": len(self._record_blocks),
+			"max_fanout": max(fanouts) if fanouts else 0,
+			"mean_fanout": float(sum(fanouts)) / len(fanouts) if fanouts else 0.0,
+			"shared_record_blocks": len(shared),
+		}
 	
+	@classmethod
+	def plan(cls, d, title, description, sample_fraction=0.05, compression_types=None, **kwargs):
+		"""
+		Estimates the result of building a file from d, without building it. The
+		arguments are as for the constructor, and are checked in the same way.
+
+		sample_fraction is the approximate fraction of the key and record blocks
+		  that are compressed to estimate the compressed sizes and times.
+
+		compression_types is a list of the compression types to estimate for. By
+		  default, all supported types.
+
+		Returns a dictionary with the following entries:
+
+		  num_entries, key_blocks, record_blocks: the number of entries and blocks.
+		  key_data_size, record_data_size: the total uncompressed size of the key
+		    blocks and of the record blocks.
+		  key_index_size: the uncompressed size of the key block index.
+		  scan_time: the time taken to read and encode the entries, in seconds.
+		  compression: a dictionary mapping each compression type to a dictionary
+		    with the estimated output_size, compressed key_index_size and
+		    peak_memory (in bytes), and build_time (in seconds).
+
+		See buildplan.py.
+		"""
+		from buildplan import _plan
+		return _plan(cls, d, title, description, sample_fraction, compression_types, kwargs)
+
 	def _build_record_blocks(self):
-		self._record_blocks = self._split_blocks(_MdxRecordBlock)
+		self._record_blocks = self._split_blocks(_MdxRecordBlock, checkpoint=self._checkpoint)
 		
 	def _build_keyb_index(self):
 		# Sets self._keyb_index to a bytes object, containing the index of key blocks, in
@@ -373,8 +782,12 @@ class MDictWriter(object):
 		
 		# Also sets self._recordb_index_size.
 		
-		self._recordb_index = b"".join(
-		    (b.get_index_entry() for b in self._record_blocks))
+		# Equivalent to joining b.get_index_entry() for all blocks, but packed in one go.
+		sizes = []
+		for b in self._record_blocks:
+			sizes.append(b._comp_size)
+			sizes.append(b._decomp_size)
+		self._recordb_index = _pack_longs(sizes, self._version)
 		self._recordb_index_size = len(self._recordb_index)
 	
 	def _write_key_sect(self, outfile):
@@ -383,7 +796,7 @@ class MDictWriter(object):
 		
 		# outfile: a file-like object, opened in binary mode.
 		
-		keyblocks_total_size = sum(len(b.get_block()) for b in self._key_blocks)
+		keyblocks_total_size = sum(b._comp_size for b in self._key_blocks)
 		if self._version == "2.0":
 			preamble = struct.pack(b">QQQQQ",
 			    len(self._key_blocks),
@@ -416,8 +829,7 @@ class MDictWriter(object):
 		#
 		# outfile: a file-like object, opened in binary mode.
 		
-		recordblocks_total_size = sum(
-		    (len(b.get_block()) for b in self._record_blocks))
+		recordblocks_total_size = sum(b._comp_size for b in self._record_blocks)
 		if self._version == "2.0":
 			format = b">QQQQ"
 		else:
@@ -431,19 +843,185 @@ class MDictWriter(object):
 		for b in self._record_blocks:
 			outfile.write(b.get_block())
 		    
-	def write(self, outfile):
+	def write(self, outfile, verify=False):
 		""" 
 		Write the mdx file to outfile.
 		
 		outfile: a file-like object, opened in binary mode.
+
+		verify: if true, the written file is checked afterwards with
+		  verifymdict.verify_mdict(), which raises verifymdict.VerificationError
+		  if it is damaged. outfile must then either be an io.BytesIO, or a file
+		  with a name, to which nothing was written before the dictionary.
 		"""
 		
+		if verify:
+			start = outfile.tell()
 		self._write_header(outfile)
 		self._write_key_sect(outfile)
 		self._write_record_sect(outfile)
+		if verify:
+			self._verify(outfile, start)
+
+	def write_fulltext_index(self, outfile):
+		"""
+		Write the full-text index of the records to outfile, a file-like object opened
+		in binary mode. Requires fulltext_index=True in the constructor.
+		"""
+		if self._fulltext is None:
+			raise ParameterError("No full-text index was built")
+		self._fulltext.write(outfile, self._num_entries, self._record_block_first_entries())
+
+	def write_prefix_index(self, outfile, bucket_size=16):
+		"""
+		Write a prefix index of the keys, for autocompletion, to outfile, a file-like
+		object opened in binary mode. See prefixindex.py.
+
+		bucket_size is the number of keys per front coded bucket. Larger buckets make
+		the index smaller, but lookups slower.
+		"""
+		from prefixindex import _write_prefix_index
+		if self._python_encoding == "utf_8":
+			keys = [t.key for t in self._offset_table]
+		else:
+			keys = [t.key.decode(self._python_encoding).encode("utf_8") for t in self._offset_table]
+		_write_prefix_index(outfile, keys, bucket_size)
+
+	def write_bloom_filter(self, outfile, false_positive_rate=0.01):
+		"""
+		Write a Bloom filter of the keys to outfile, a file-like object opened in
+		binary mode. See bloomfilter.py.
+
+		false_positive_rate is the fraction of keys not in the dictionary for which
+		the filter cannot tell that they are not in it.
+		"""
+		if not 0 < false_positive_rate < 1:
+			raise ParameterError("false_positive_rate must be between 0 and 1")
+		from bloomfilter import _write_bloom_filter
+		_write_bloom_filter(outfile, [t.key for t in self._offset_table],
+		    self._python_encoding, false_positive_rate)
+
+	def write_positional(self, filename, threads=4, verify=False):
+		"""
+		Write the mdx file to a file named filename, which is created or overwritten.
+
+		Since all blocks are compressed when the MDictWriter is constructed, the
+		position of every part of the file is known in advance. The file is therefore
+		first extended to its final size, and then each block is written directly at
+		its position, with os.pwrite(), by several threads at once. (Where os.pwrite()
+		is not available, the blocks are copied into an mmap of the file instead.)
+
+		threads: the number of writing threads.
+
+		verify: if true, the written file is checked afterwards, as for write().
+		"""
+		chunks = self._chunks()
+		jobs = []
+		size = 0
+		for chunk in chunks:
+			jobs.append((size, chunk))
+			size += len(chunk)
+		fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+		try:
+			_preallocate(fd, size)
+			if hasattr(os, "pwrite"):
+				_pwrite_parallel(fd, jobs, threads)
+			elif size > 0:
+				import mmap
+				m = mmap.mmap(fd, size)
+				try:
+					for offset, chunk in jobs:
+						m[offset:offset+len(chunk)] = chunk
+					m.flush()
+				finally:
+					m.close()
+		finally:
+			os.close(fd)
+		if verify:
+			from verifymdict import verify_mdict
+			verify_mdict(filename, encrypt_key=self._encrypt_key)
+
+	def write_variants(self, users, file_name, processes=None):
+		"""
+		Write one licensed copy of the mdx file for each of many users, each with
+		its own registration code in the header (see user_email and user_device_id
+		in the constructor).
+
+		All copies are identical apart from the header, so the key and record
+		sections are only written once, to the first file. The other files get
+		their own header, followed by a copy of those sections, made with
+		os.copy_file_range() where available, so that the data is copied by the
+		operating system (or shared on disk, on file systems that support it)
+		instead of passing through Python. Writing an extra copy therefore only
+		costs I/O.
+
+		Requires encrypt_key and register_by in the constructor.
+
+		users: an iterable of (unicode) strings, each being either an email address or
+		  a device ID, depending on register_by.
+		file_name: a function that is given a user, and returns the name of the
+		  file to write the copy for that user to.
+		processes: the number of worker processes for generating the registration
+		  codes, as for encrypt_keys().
+
+		Returns the number of files written.
+
+		Example usage:
+			writer.write_variants(emails, lambda email: "licensed/" + email + "/dictionary.mdx")
+		"""
+		if not self._encrypt or self._register_by is None:
+			raise ParameterError("write_variants() requires encrypt_key and register_by")
+		template_name = None
+		n = 0
+		template = None
+		try:
+			for user, regcode in encrypt_keys(self._encrypt_key, users, processes=processes):
+				outfile = open(file_name(user), "wb")
+				try:
+					self._write_header(outfile, regcode)
+					if template_name is None:
+						body_start = outfile.tell()
+						self._write_key_sect(outfile)
+						self._write_record_sect(outfile)
+						body_size = outfile.tell() - body_start
+						template_name = file_name(user)
+					else:
+						if template is None:
+							template = open(template_name, "rb")
+						_copy_range(template, outfile, body_start, body_size)
+				finally:
+					outfile.close()
+				n += 1
+		finally:
+			if template is not None:
+				template.close()
+		return n
 
+	def _chunks(self):
+		# Returns a list of bytes objects, which together (in order) make up the
+		# file written by write().
+		chunks = _ChunkList()
+		self._write_header(chunks)
+		self._write_key_sect(chunks)
+		self._write_record_sect(chunks)
+		return chunks
 
-	def _write_header(self, f):
+	def _verify(self, outfile, start):
+		# Verifies the dictionary that was written to outfile, starting at position start.
+		from verifymdict import verify_mdict
+		if hasattr(outfile, "getvalue"):
+			verify_mdict(outfile.getvalue()[start:], encrypt_key=self._encrypt_key, processes=1)
+		elif start == 0 and hasattr(outfile, "name"):
+			outfile.flush()
+			verify_mdict(outfile.name, encrypt_key=self._encrypt_key)
+		else:
+			raise ParameterError("Cannot verify a dictionary written to this outfile")
+
+
+	def _write_header(self, f, regcode=None):
+		# regcode: the registration code to write in the header. If None, it is
+		# computed from user_email or user_device_id, if given.
+		import datetime
 		encrypted = 0
 		if self._encrypt_index:
 			encrypted = encrypted | 2
@@ -452,19 +1030,25 @@ class MDictWriter(object):
 		
 		if self._encrypt and self._register_by == "email":
 			register_by_str = "EMail"
-			if self._user_email is not None:
+			if regcode is None and self._user_email is not None:
 				regcode = encrypt_key(self._encrypt_key, email=self._user_email)
-			else:
-				regcode = ""
 		elif self._encrypt and self._register_by == "device_id":
 			register_by_str = "DeviceID"
-			if self._user_device_id is not None:
+			if regcode is None and self._user_device_id is not None:
 				regcode = encrypt_key(self._encrypt_key, device_id=self._user_device_id)
-			else:
-				regcode = ""
 		else:
 			register_by_str = ""
 			regcode = ""
+		if regcode is None:
+			regcode = ""
+		
+		if self._styles:
+			from stylesheet import format_stylesheet
+			compact = "Yes"
+			stylesheet = format_stylesheet(self._styles)
+		else:
+			compact = "No"
+			stylesheet = ""
 		
 		if not self._is_mdd:
 			header_string = (
@@ -475,21 +1059,23 @@ class MDictWriter(object):
 			"""Encoding="{encoding}" """
 			"""Format="Html" """
 			"""CreationDate="{date.year}-{date.month}-{date.day}" """
-			"""Compact="No" """
-			"""Compat="No" """
+			"""Compact="{compact}" """
+			"""Compat="{compact}" """
 			"""KeyCaseSensitive="No" """
 			"""Description="{description}" """
 			"""Title="{title}" """
 			"""DataSourceFormat="106" """
-			"""StyleSheet="" """
+			"""StyleSheet="{stylesheet}" """
 			"""RegisterBy="{register_by_str}" """
 			"""RegCode="{regcode}"/>\r\n\x00""").format(
 			    version = self._version,
 			    encrypted = encrypted,
 			    encoding = self._encoding, 
+			    compact = compact,
+			    stylesheet = _escape(stylesheet),
 			    date = datetime.date.today(), 
-			    description=escape(self._description, quote=True),
-			    title=escape(self._title, quote=True),
+			    description=_escape(self._description),
+			    title=_escape(self._title),
 			    register_by_str=register_by_str,
 			    regcode=regcode
 			).encode("utf_16_le")
@@ -513,8 +1099,8 @@ class MDictWriter(object):
 			    version = self._version,
 			    encrypted = encrypted, 
 			    date = datetime.date.today(), 
-			    description=escape(self._description, quote=True),
-			    title=escape(self._title, quote=True),
+			    description=_escape(self._description),
+			    title=_escape(self._title),
 			    register_by_str=register_by_str,
 			    regcode=regcode
 			).encode("utf_16_le")
@@ -522,6 +1108,116 @@ class MDictWriter(object):
 		f.write(header_string)
 		f.write(struct.pack(b"<L",zlib.adler32(header_string) & 0xffffffff))
 
+class _ChunkList(list):
+	# A list that can be used as outfile for the MDictWriter._write_... methods,
+	# collecting the written bytes objects without copying them.
+	write = list.append
+
+def _preallocate(fd, size):
+	# Extends the file fd to size bytes, reserving disk space for it if possible.
+	if size > 0 and hasattr(os, "posix_fallocate"):
+		try:
+			os.posix_fallocate(fd, 0, size)
+			return
+		except OSError:
+			pass # e.g. not supported by the file system
+	os.ftruncate(fd, size)
+
+def _copy_range(src, dst, offset, size):
+	# Copies size bytes, starting at offset in the file object src, to the current
+	# position of the file object dst. Uses os.copy_file_range() if possible, which
+	# copies inside the kernel, and may share the data on disk instead of copying it.
+	dst.flush()
+	dst_offset = dst.tell()
+	if hasattr(os, "copy_file_range"):
+		try:
+			while size > 0:
+				n = os.copy_file_range(src.fileno(), dst.fileno(), size, offset, dst_offset)
+				if n == 0:
+					break
+				offset += n
+				dst_offset += n
+				size -= n
+		except OSError:
+			pass # e.g. not supported between these file systems; copy the rest below
+		dst.seek(dst_offset)
+	src.seek(offset)
+	while size > 0:
+		data = src.read(min(size, 1 << 20))
+		if not data:
+			raise IOError("Unexpected end of file")
+		dst.write(data)
+		size -= len(data)
+
+def _pwrite_all(fd, jobs):
+	# Writes each (offset, data) in jobs to fd with os.pwrite.
+	for offset, data in jobs:
+		data = memoryview(data)
+		while len(data) > 0:
+			n = os.pwrite(fd, data, offset)
+			data = data[n:]
+			offset += n
+
+def _pwrite_parallel(fd, jobs, threads):
+	# Writes each (offset, data) in jobs to fd, using the given number of threads.
+	# Each thread is given a contiguous range of jobs of roughly equal total size.
+	total = sum(len(data) for offset, data in jobs)
+	if threads <= 1 or len(jobs) < 2:
+		_pwrite_all(fd, jobs)
+		return
+	import threading
+	groups = [[]]
+	group_size = 0
+	for job in jobs:
+		groups[-1].append(job)
+		group_size += len(job[1])
+		if group_size * threads >= total and len(groups) < threads:
+			groups.append([])
+			group_size = 0
+	errors = []
+	def run(group):
+		try:
+			_pwrite_all(fd, group)
+		except Exception as e:
+			errors.append(e)
+	workers = [threading.Thread(target=run, args=(group,)) for group in groups if group]
+	for w in workers:
+		w.start()
+	for w in workers:
+		w.join()
+	if errors:
+		raise errors[0]
+
+class _BlockSplitter(object):
+	# Decides where a sequence of entries is split into blocks of one type. Used by
+	# MDictWriter._split_blocks(), and by buildplan.py to count the blocks without
+	# building them.
+
+	def __init__(self, block_type, block_size):
+		# block_type is a subclass of _MdxBlock, whose _len_block_entry() gives the
+		# size of each entry.
+		self._len_block_entry = block_type._len_block_entry
+		self._block_size = block_size
+		self._cur_size = None
+
+	def starts_block(self, t):
+		# Adds the _OffsetTableEntry t, the next entry, and returns True if it starts
+		# a new block, i.e. the block so far should be flushed before it.
+		size = self._len_block_entry(t)
+		if self._cur_size is None:
+			# nothing to flush yet
+			# this part is needed in case the first entry is longer than
+			# self._block_size.
+			self._cur_size = size
+			return False
+		if self._cur_size + size > self._block_size:
+			#Adding this entry to make us larger than
+			#self._block_size, so flush now.
+			self._cur_size = size
+			return True
+		self._cur_size += size
+		return False
+
 class _MdxBlock(object):
 	# Abstract base class for _MdxRecordBlock and _MdxKeyBlock.
 	#
@@ -541,16 +1237,24 @@ class _MdxBlock(object):
 	# be built in a uniform manner.
 	#
 	
-	def __init__(self, offset_table, compression_type, version):
+	def __init__(self, offset_table, compression_type, version, checkpoint=None):
 		# Builds the data from offset_table.
 		#
 		# offset_table is a iterable containing _OffsetTableEntry objects.
+		#
+		# checkpoint is None, or a checkpoint._BlockCheckpoint, which is used to
+		# save the compressed data, or to get it without compressing.
 		
-		decomp_data = b"".join(
-		    type(self)._block_entry(t, version)
-		    for t in offset_table)
+		decomp_data = type(self)._block_data(offset_table, version)
+		self._num_entries = len(offset_table)
 		self._decomp_size = len(decomp_data)
-		self._comp_data = _mdx_compress(decomp_data, compression_type)
+		self._comp_data = None
+		if checkpoint is not None:
+			self._comp_data = checkpoint.get(decomp_data, compression_type)
+		if self._comp_data is None:
+			self._comp_data = _mdx_compress(decomp_data, compression_type)
+			if checkpoint is not None:
+				checkpoint.put(decomp_data, compression_type, self._comp_data)
 		self._comp_size = len(self._comp_data)
 		self._version = version
 	
@@ -571,6 +1275,14 @@ class _MdxBlock(object):
 		# t is an _OffsetTableEntry object
 		
 		raise NotImplementedError()
+
+	@classmethod
+	def _block_data(cls, offset_table, version):
+		# Returns the (uncompressed) data of a block containing the entries of
+		# offset_table, i.e. the concatenation of _block_entry() for each of them.
+		#
+		# Subclasses may override this with a faster equivalent.
+		return b"".join([cls._block_entry(t, version) for t in offset_table])
 	
 	@staticmethod
 	def _len_block_entry(t):
@@ -586,28 +1298,28 @@ class _MdxRecordBlock(_MdxBlock):
 	# both the block itself, as well as the entry in the record block index for that
 	# block.
 
-	def __init__(self, offset_table, compression_type, version):
+	def __init__(self, offset_table, compression_type, version, checkpoint=None):
 		# Builds the data for offset_table.
 		#
 		# offset_table is a iterable containing _OffsetTableEntry objects.
 		#
 		# Actually only uses the record parts.
 		
-		_MdxBlock.__init__(self, offset_table, compression_type, version)
+		_MdxBlock.__init__(self, offset_table, compression_type, version, checkpoint)
 		
 	def get_index_entry(self):
 		# Returns a bytes object, containing the entry for this block in the record
 		# block index.
 		
-		if self._version == "2.0":
-			format = b">QQ"
-		else:
-			format = b">LL"
-		return struct.pack(format, self._comp_size, self._decomp_size)
+		return _long_pair_struct[self._version].pack(self._comp_size, self._decomp_size)
 	
 	@staticmethod
 	def _block_entry(t, version):
-		return t.record_null
+		if isinstance(t.record_null, bytes):
+			return t.record_null
+		else:
+			# a lazily loaded mdd record, see MDictWriter.__init__
+			return t.record_null.read()
 	
 	@staticmethod
 	def _len_block_entry(t):
@@ -627,7 +1339,6 @@ class _MdxKeyBlock(_MdxBlock):
 		# Only uses the key, key_len, key_null and offset fields, and effectively ignores record_null.
 
 		_MdxBlock.__init__(self, offset_table, compression_type, version)
-		self._num_entries = len(offset_table)
 		if version=="2.0":
 			self._first_key = offset_table[0].key_null
 			self._last_key = offset_table[len(offset_table)-1].key_null
@@ -639,11 +1350,12 @@ class _MdxKeyBlock(_MdxBlock):
 	
 	@staticmethod
 	def _block_entry(t, version):
-		if version == "2.0":
-			format = b">Q"
-		else:
-			format = b">L"
-		return struct.pack(format, t.offset)+t.key_null
+		return _long_struct[version].pack(t.offset)+t.key_null
+
+	@classmethod
+	def _block_data(cls, offset_table, version):
+		pack = _long_struct[version].pack
+		return b"".join([pack(t.offset)+t.key_null for t in offset_table])
 	
 	@staticmethod
 	def _len_block_entry(t):
@@ -651,20 +1363,12 @@ class _MdxKeyBlock(_MdxBlock):
 	
 	def get_index_entry(self):
 		# Returns a bytes object, containing the header data for this block
-		if self._version == "2.0":
-			long_format = b">Q"
-			short_format = b">H"
-		else:
-			long_format = b">L"
-			short_format = b">B"
 		return (
-		    struct.pack(long_format, self._num_entries)
-		  + struct.pack(short_format, self._first_key_len)
+		    _long_short_struct[self._version].pack(self._num_entries, self._first_key_len)
 		  + self._first_key
-		  + struct.pack(short_format, self._last_key_len)
+		  + _short_struct[self._version].pack(self._last_key_len)
 		  + self._last_key
-		  + struct.pack(long_format, self._comp_size)
-		  + struct.pack(long_format, self._decomp_size)
+		  + _long_pair_struct[self._version].pack(self._comp_size, self._decomp_size)
 		  )
 		
 	